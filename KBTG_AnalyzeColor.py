@@ -2,9 +2,27 @@ import tkinter as tk
 from tkinter import filedialog, ttk, messagebox
 from PIL import Image, ImageTk
 import numpy as np
-import math
 import os
 
+from grid_sampling import parse_sample_window
+from analysis_worker import AnalysisWorker
+from display_pyramid import DisplayPyramid
+from grid_detection import detect_grid
+from image_source import ImageSource
+from color_metrics import METRICS
+from grid_analysis import analyze_grid
+from grid_overlay import heatmap_colors, render_grid_overlay, render_heatmap
+from palette_index import get_palette_index
+from profiling import PROFILER, PROFILE_ENV, count, span
+from result_cache import ResultCache, file_digest
+from results_view import VirtualResultsView
+
+PALETTE_TOP_K = 3  # Palette candidates reported per cell
+WORKER_POLL_MS = 50  # How often the Tk loop checks on a running analysis
+RESIZE_DEBOUNCE_MS = 80  # Redraw once the window has stopped resizing for this long
+AUTO_GRID_MIN_CONFIDENCE = 0.3  # Below this the detected grid is reported but not drawn
+STATS_REFRESH_MS = 500  # How often the open stats panel updates
+
 class ColorGridAnalyzer:
     def __init__(self, root):
         self.root = root
@@ -12,17 +30,43 @@ class ColorGridAnalyzer:
         self.root.geometry("1200x800")
         
         # Variables
-        self.image = None
+        self.image = None  # Displayed image: a reduced copy; the full-resolution pixels are only in the sampler
+        self.image_source = None  # Full-resolution pixels and sampler, possibly still decoding
+        self.image_size = None  # Full-resolution (width, height); canvas coordinates map to this
+        self.sample_window = "7"  # Sampled pixels per cell: "7" for 7x7, "80%" for 80% of the cell
         self.image_tk = None  # Renamed from display_image to avoid method name conflict
         self.photo = None
+        self.pyramid = None  # Downscaled copies of the image, built once per load
+        self.image_item = None  # Canvas image item reused across redraws
+        self.resize_job = None  # Pending debounced redraw
         self.reference_color = None
+        self.hover_reference = None  # Color under the cursor while live mode previews it
+        self.hover_point = None
+        self.hover_job = None  # Pending idle callback that scores the latest hover point
         self.rect_start_x = None
         self.rect_start_y = None
         self.rect_end_x = None
         self.rect_end_y = None
         self.drawing = False
-        self.grid_colors = []
+        self.detected_dims = None  # (rows, cols) found by Auto Grid, offered as dialog defaults
+        self.cell_canvas_boxes = None  # (N, 4) canvas x1, y1, x2, y2 of every cell, by cell index
+        self.grid_result = None  # Headless GridResult for the last analysis
+        self.palette_index = None  # Named palette matched against every cell
+        self.result_cache = ResultCache()  # Cell colors and scores of earlier analyses, by image content
+        self.worker = None  # Background AnalysisWorker while an analysis runs
+        self.overlay_item = None  # Canvas image item holding the rendered grid overlay
+        self.overlay_key = None  # What the current overlay was rendered for
+        self.overlay_photo = None
+        self.heatmap_item = None  # Separate canvas layer so score changes redraw only the heatmap
+        self.heatmap_key = None
+        self.heatmap_photo = None
+        self.highlight_item = None
+        self.result_order = None  # Cell indices of the filtered ranking shown in the results view
+        self.result_similarities = None
         self.scale_factor = 1.0
+        self.stats_window = None  # Timing stats panel, while open
+        self.stats_tree = None
+        self.stats_job = None
         
         # Create main layout
         self.create_layout()
@@ -45,12 +89,24 @@ class ColorGridAnalyzer:
         self.sample_ref_btn = tk.Button(self.control_frame, text="Sample Reference Color", command=self.enable_reference_sampling)
         self.sample_ref_btn.pack(side=tk.LEFT, padx=5)
         
+        self.load_palette_btn = tk.Button(self.control_frame, text="Load Palette", command=self.load_palette)
+        self.load_palette_btn.pack(side=tk.LEFT, padx=5)
+        
         self.clear_btn = tk.Button(self.control_frame, text="Clear Selection", command=self.clear_selection)
         self.clear_btn.pack(side=tk.LEFT, padx=5)
         
+        self.auto_grid_btn = tk.Button(self.control_frame, text="Auto Grid", command=self.auto_detect_grid)
+        self.auto_grid_btn.pack(side=tk.LEFT, padx=5)
+        
         self.analyze_btn = tk.Button(self.control_frame, text="Analyze Grid", command=self.analyze_grid)
         self.analyze_btn.pack(side=tk.LEFT, padx=5)
         
+        self.cancel_btn = tk.Button(self.control_frame, text="Cancel", command=self.cancel_analysis, state=tk.DISABLED)
+        self.cancel_btn.pack(side=tk.LEFT, padx=5)
+        
+        self.stats_btn = tk.Button(self.control_frame, text="Stats", command=self.show_stats_panel)
+        self.stats_btn.pack(side=tk.LEFT, padx=5)
+        
         self.status_label = tk.Label(self.control_frame, text="Load an image to begin")
         self.status_label.pack(side=tk.RIGHT, padx=10)
         
@@ -70,6 +126,27 @@ class ColorGridAnalyzer:
         self.ref_hex_label = tk.Label(self.ref_frame, text="HEX: -")
         self.ref_hex_label.pack(side=tk.LEFT, padx=5)
         
+        # Color difference metric used for scoring and ranking
+        self.metric_label = tk.Label(self.ref_frame, text="Metric:")
+        self.metric_label.pack(side=tk.LEFT, padx=(20, 5))
+        
+        self.metric_var = tk.StringVar(value="RGB")
+        self.metric_combo = ttk.Combobox(self.ref_frame, textvariable=self.metric_var, state="readonly",
+                                         values=[metric.upper() for metric in METRICS], width=10)
+        self.metric_combo.pack(side=tk.LEFT)
+        self.metric_combo.bind("<<ComboboxSelected>>", self.on_metric_change)
+        
+        self.heatmap_var = tk.BooleanVar(value=False)
+        self.heatmap_check = tk.Checkbutton(self.ref_frame, text="Heatmap", variable=self.heatmap_var,
+                                            command=self.update_overlay)
+        self.heatmap_check.pack(side=tk.LEFT, padx=10)
+        
+        # Live mode: the color under the cursor previews as the reference
+        self.live_var = tk.BooleanVar(value=False)
+        self.live_check = tk.Checkbutton(self.ref_frame, text="Live reference", variable=self.live_var,
+                                         command=self.on_live_toggle)
+        self.live_check.pack(side=tk.LEFT)
+        
         # Canvas for image display
         self.canvas_frame = tk.Frame(self.left_frame)
         self.canvas_frame.pack(fill=tk.BOTH, expand=True, pady=5)
@@ -79,17 +156,46 @@ class ColorGridAnalyzer:
         self.canvas.bind("<ButtonPress-1>", self.on_mouse_down)
         self.canvas.bind("<B1-Motion>", self.on_mouse_drag)
         self.canvas.bind("<ButtonRelease-1>", self.on_mouse_up)
+        self.canvas.bind("<Motion>", self.on_canvas_hover)
+        self.canvas.bind("<Leave>", self.on_canvas_leave)
         
         # Right frame - Results
         self.results_label = tk.Label(self.right_frame, text="Color Matching Results", font=("Arial", 12, "bold"))
         self.results_label.pack(pady=10)
         
+        # Top-N and threshold filters for the results
+        self.filter_frame = tk.Frame(self.right_frame)
+        self.filter_frame.pack(fill=tk.X, pady=5)
+        
+        tk.Label(self.filter_frame, text="Top:").pack(side=tk.LEFT)
+        self.top_n_var = tk.StringVar(value="")  # Blank shows every cell
+        self.top_n_entry = tk.Entry(self.filter_frame, textvariable=self.top_n_var, width=6)
+        self.top_n_entry.pack(side=tk.LEFT, padx=5)
+        self.top_n_entry.bind("<Return>", self.on_filter_change)
+        
+        tk.Label(self.filter_frame, text="Min match %:").pack(side=tk.LEFT)
+        self.min_match_var = tk.StringVar(value="")
+        self.min_match_entry = tk.Entry(self.filter_frame, textvariable=self.min_match_var, width=6)
+        self.min_match_entry.pack(side=tk.LEFT, padx=5)
+        self.min_match_entry.bind("<Return>", self.on_filter_change)
+        
+        tk.Button(self.filter_frame, text="Apply", command=self.on_filter_change).pack(side=tk.LEFT, padx=5)
+        
+        self.result_count_label = tk.Label(self.filter_frame, text="")
+        self.result_count_label.pack(side=tk.RIGHT)
+        
         # Create treeview for results
         self.create_results_treeview()
         
     def create_results_treeview(self):
-        columns = ("position", "color", "rgb", "hex", "similarity")
-        self.results_tree = ttk.Treeview(self.right_frame, columns=columns, show="headings", height=30)
+        columns = ("position", "color", "rgb", "hex", "similarity", "match", "alternatives")
+        
+        # Virtualized: only the rows on screen exist as Treeview items
+        self.results_view = VirtualResultsView(self.right_frame, columns, height=30, on_select=self.on_result_click)
+        self.results_tree = self.results_view.tree
+        
+        # Palette columns are only shown once a palette is loaded
+        self.results_tree.configure(displaycolumns=columns[:5])
         
         # Define headings
         self.results_tree.heading("position", text="Position")
@@ -97,6 +203,8 @@ class ColorGridAnalyzer:
         self.results_tree.heading("rgb", text="RGB")
         self.results_tree.heading("hex", text="HEX")
         self.results_tree.heading("similarity", text="Match %")
+        self.results_tree.heading("match", text="Palette Match")
+        self.results_tree.heading("alternatives", text="Alternatives")
         
         # Define columns
         self.results_tree.column("position", width=80, anchor=tk.CENTER)
@@ -104,24 +212,18 @@ class ColorGridAnalyzer:
         self.results_tree.column("rgb", width=100, anchor=tk.CENTER)
         self.results_tree.column("hex", width=80, anchor=tk.CENTER)
         self.results_tree.column("similarity", width=80, anchor=tk.CENTER)
-        
-        # Add scrollbar
-        scrollbar = ttk.Scrollbar(self.right_frame, orient=tk.VERTICAL, command=self.results_tree.yview)
-        self.results_tree.configure(yscroll=scrollbar.set)
+        self.results_tree.column("match", width=140, anchor=tk.W)
+        self.results_tree.column("alternatives", width=180, anchor=tk.W)
         
         # Pack everything
-        self.results_tree.pack(fill=tk.BOTH, expand=True)
-        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
-        
-        # Bind click event
-        self.results_tree.bind("<ButtonRelease-1>", self.on_result_click)
+        self.results_view.pack(fill=tk.BOTH, expand=True)
         
     def load_image(self):
         # Print current working directory for debugging
         print("Current working directory:", os.getcwd())
         
         file_path = filedialog.askopenfilename(
-            filetypes=[("Image files", "*.jpg *.jpeg *.png *.bmp *.gif")]
+            filetypes=[("Image files", "*.jpg *.jpeg *.png *.bmp *.gif *.tif *.tiff")]
         )
         
         # Debug: Print the selected file path
@@ -134,25 +236,87 @@ class ColorGridAnalyzer:
         try:
             # Try to open the image
             print(f"Attempting to open image: {file_path}")
-            img = Image.open(file_path)
             
-            # Convert to RGB mode if needed
-            if img.mode != "RGB":
-                img = img.convert("RGB")
-                
-            self.image = img
-            print(f"Image loaded successfully. Size: {img.size}")
+            # JPEGs come back as a reduced-scale preview sized for the canvas
+            canvas_size = (self.canvas.winfo_width() or 700, self.canvas.winfo_height() or 500)
+            with span("load_image.open"):
+                source = ImageSource(file_path, preview_size=canvas_size)
+            
+            # An analysis still running belongs to the previous image, whose file is released
+            self.cancel_analysis()
+            if self.image_source is not None:
+                self.image_source.close()
+            self.image_source = source
+            self.image = source.preview
+            self.image_size = source.size
+            with span("load_image.pyramid"):
+                self.pyramid = DisplayPyramid(source.preview)  # Also decodes the preview
+            count("pixels.decoded", source.preview.width * source.preview.height)
+            self.image_tk = None
+            print(f"Image loaded successfully. Size: {source.size}")
             
             # Show the image
             self.show_image()
             self.status_label.config(text="Image loaded. Draw rectangle around grid.")
             self.clear_selection()
             
+            # Decode the full resolution in the background and swap it in when done
+            if source.lazy:
+                print(f"Showing {source.preview.size} preview, decoding full resolution")
+                source.start()
+                self.root.after(WORKER_POLL_MS, self.poll_image_source, source)
+            
         except Exception as e:
             error_msg = f"Failed to load image: {str(e)}"
             print(error_msg)
             messagebox.showerror("Error", error_msg)
     
+    def poll_image_source(self, source):
+        if source is not self.image_source:
+            return  # Another image was loaded meanwhile
+        if not source.ready:
+            self.root.after(WORKER_POLL_MS, self.poll_image_source, source)
+            return
+        
+        if source.error is not None:
+            error_msg = f"Failed to decode full image: {str(source.error)}"
+            print(error_msg)
+            messagebox.showerror("Error", error_msg)
+            return
+        
+        # Redraw from a reduced copy of the full-resolution pixels, which
+        # themselves are only kept by the sampler
+        print("Full-resolution image decoded")
+        self.image = source.preview
+        with span("load_image.pyramid"):
+            self.pyramid = DisplayPyramid(source.preview)
+        self.image_tk = None
+        self.show_image()
+    
+    def load_palette(self):
+        file_path = filedialog.askopenfilename(
+            filetypes=[("Palette files", "*.csv *.tsv *.txt *.json *.npz")]
+        )
+        if not file_path:
+            return
+        
+        try:
+            # The index is built once per palette file and reused for every image
+            self.palette_index = get_palette_index(file_path)
+            print(f"Palette loaded: {len(self.palette_index)} colors")
+            
+            self.results_tree.configure(displaycolumns=self.results_tree["columns"])
+            self.status_label.config(text=f"Palette loaded: {len(self.palette_index)} colors")
+            
+            if self.grid_result is not None:
+                self.grid_result.match_palette(self.palette_index, PALETTE_TOP_K)
+                self.calculate_and_display_results()
+                
+        except Exception as e:
+            error_msg = f"Failed to load palette: {str(e)}"
+            print(error_msg)
+            messagebox.showerror("Error", error_msg)
+    
     def show_image(self):  # Renamed from display_image to avoid conflict
         if self.image is None:
             print("No image to display")
@@ -164,28 +328,65 @@ class ColorGridAnalyzer:
             canvas_height = self.canvas.winfo_height() or 500
             
             # Calculate scaling factor
-            img_width, img_height = self.image.size
+            img_width, img_height = self.image_size
             width_scale = canvas_width / img_width
             height_scale = canvas_height / img_height
-            self.scale_factor = min(width_scale, height_scale)
+            scale_factor = min(width_scale, height_scale)
             
             # Resize image for display
-            new_width = int(img_width * self.scale_factor)
-            new_height = int(img_height * self.scale_factor)
+            new_width = int(img_width * scale_factor)
+            new_height = int(img_height * scale_factor)
+            if self.image_tk is not None and self.image_tk.size == (new_width, new_height):
+                return  # Already shown at this size
             
+            # Keep the selection rectangle and highlight on the same image pixels
+            if self.image_tk is not None:
+                ratio = scale_factor / self.scale_factor
+                self.canvas.scale("rect", 0, 0, ratio, ratio)
+                self.canvas.scale("highlight", 0, 0, ratio, ratio)
+                if self.rect_start_x is not None and self.rect_end_x is not None:
+                    self.rect_start_x *= ratio
+                    self.rect_start_y *= ratio
+                    self.rect_end_x *= ratio
+                    self.rect_end_y *= ratio
+            self.scale_factor = scale_factor
+            
+            # Resample from the nearest pyramid level rather than the full image
             print(f"Resizing image to: {new_width}x{new_height}")
-            self.image_tk = self.image.resize((new_width, new_height), Image.LANCZOS)
-            self.photo = ImageTk.PhotoImage(self.image_tk)
+            with span("show_image.resize", size=f"{new_width}x{new_height}"):
+                self.image_tk = self.pyramid.get((new_width, new_height))
+            with span("show_image.photo"):
+                self.photo = ImageTk.PhotoImage(self.image_tk)
+            count("pixels.resized", new_width * new_height)
+            
+            # Swap the picture on the existing canvas item
+            if self.image_item is None:
+                self.image_item = self.canvas.create_image(0, 0, anchor=tk.NW, image=self.photo, tags="image")
+                self.canvas.tag_lower(self.image_item)
+                count("canvas.items_created")
+            else:
+                self.canvas.itemconfig(self.image_item, image=self.photo)
             
-            # Display on canvas
-            self.canvas.delete("all")
-            self.canvas.create_image(0, 0, anchor=tk.NW, image=self.photo)
+            # Redraw the grid overlay at the new zoom
+            if self.grid_result is not None:
+                with span("show_image.grid"):
+                    self.draw_grid()
             print("Image displayed successfully")
         except Exception as e:
             error_msg = f"Error displaying image: {str(e)}"
             print(error_msg)
             messagebox.showerror("Error", error_msg)
     
+    def schedule_show_image(self):
+        # Coalesce a burst of resize events into one redraw
+        if self.resize_job is not None:
+            self.root.after_cancel(self.resize_job)
+        self.resize_job = self.root.after(RESIZE_DEBOUNCE_MS, self.run_scheduled_show_image)
+    
+    def run_scheduled_show_image(self):
+        self.resize_job = None
+        self.show_image()
+    
     def enable_reference_sampling(self):
         if not self.image:
             messagebox.showinfo("Info", "Please load an image first.")
@@ -195,36 +396,60 @@ class ColorGridAnalyzer:
         self.canvas.bind("<ButtonPress-1>", self.sample_color)
         self.drawing = False
     
+    def pixel_at(self, canvas_x, canvas_y):
+        # Color under a canvas point, or None outside the image
+        img_x = int(canvas_x / self.scale_factor)
+        img_y = int(canvas_y / self.scale_factor)
+        img_width, img_height = self.image_size
+        if img_x < 0 or img_x >= img_width or img_y < 0 or img_y >= img_height:
+            return None
+        
+        source = self.image_source
+        if source is not None and source.ready and source.error is None:
+            # Full-resolution pixels once decoded (read from the tiles for large scans)
+            pixel = source.sampler.sample(np.array([img_x]), np.array([img_y]), 0, 0, "gather")[0, 0]
+            return tuple(int(v) for v in pixel)
+        
+        # Read from the preview while the full image is decoding
+        preview_scale = self.image.width / img_width
+        pixel = self.image.getpixel((int(img_x * preview_scale), int(img_y * preview_scale)))
+        return tuple(pixel[:3])  # Drop alpha if present
+    
+    def show_reference(self, pixel):
+        if pixel is None:
+            self.ref_color_display.config(bg="white")
+            self.ref_rgb_label.config(text="RGB: -")
+            self.ref_hex_label.config(text="HEX: -")
+            return
+        hex_color = f"#{pixel[0]:02X}{pixel[1]:02X}{pixel[2]:02X}"
+        self.ref_color_display.config(bg=hex_color)
+        self.ref_rgb_label.config(text=f"RGB: {pixel}")
+        self.ref_hex_label.config(text=f"HEX: {hex_color}")
+    
     def sample_color(self, event):
         if not self.image:
             return
         
-        # Convert canvas coordinates to image coordinates
-        img_x = int(event.x / self.scale_factor)
-        img_y = int(event.y / self.scale_factor)
-        
         try:
-            # Make sure coordinates are within image bounds
-            img_width, img_height = self.image.size
-            if img_x < 0 or img_x >= img_width or img_y < 0 or img_y >= img_height:
-                print(f"Click coordinates out of bounds: ({img_x}, {img_y})")
+            pixel = self.pixel_at(event.x, event.y)
+            if pixel is None:
+                print(f"Click coordinates out of bounds: ({event.x}, {event.y})")
                 return
-                
-            # Get pixel color
-            pixel = self.image.getpixel((img_x, img_y))
-            if len(pixel) > 3:  # RGBA format
-                pixel = pixel[:3]
             
             # Set as reference color
             self.reference_color = pixel
+            self.hover_reference = None
             hex_color = f"#{pixel[0]:02X}{pixel[1]:02X}{pixel[2]:02X}"
             
             # Update UI
-            self.ref_color_display.config(bg=hex_color)
-            self.ref_rgb_label.config(text=f"RGB: {pixel}")
-            self.ref_hex_label.config(text=f"HEX: {hex_color}")
+            self.show_reference(pixel)
             
-            self.status_label.config(text="Reference color set. Draw rectangle around grid.")
+            # An analyzed grid is re-ranked right away from its stored cell colors
+            if self.grid_result is not None:
+                self.calculate_and_display_results()
+                self.status_label.config(text="Reference color set. Results re-ranked.")
+            else:
+                self.status_label.config(text="Reference color set. Draw rectangle around grid.")
             
             # Reset canvas bindings
             self.canvas.bind("<ButtonPress-1>", self.on_mouse_down)
@@ -263,6 +488,7 @@ class ColorGridAnalyzer:
             self.rect_end_x, self.rect_end_y,
             outline="red", width=2, tags="rect"
         )
+        count("canvas.items_created")
     
     def on_mouse_up(self, event):
         if not self.drawing or not self.image:
@@ -282,27 +508,69 @@ class ColorGridAnalyzer:
         self.status_label.config(text="Rectangle drawn. Click 'Analyze Grid' to process.")
     
     def clear_selection(self):
+        self.cancel_analysis()
+        if self.hover_reference is not None:
+            self.hover_reference = None
+            self.show_reference(self.reference_color)
         self.canvas.delete("rect")
         self.canvas.delete("grid")
         self.canvas.delete("highlight")
+        self.overlay_item = None
+        self.overlay_key = None
+        self.heatmap_item = None
+        self.heatmap_key = None
+        self.highlight_item = None
         self.rect_start_x = None
         self.rect_start_y = None
         self.rect_end_x = None
         self.rect_end_y = None
         self.drawing = False
-        self.grid_colors = []
+        self.detected_dims = None
+        self.cell_canvas_boxes = None
+        self.grid_result = None
         
         # Clear results
-        for item in self.results_tree.get_children():
-            self.results_tree.delete(item)
+        self.results_view.clear()
+        self.result_count_label.config(text="")
+    
+    def auto_detect_grid(self):
+        if not self.image:
+            messagebox.showinfo("Info", "Please load an image first.")
+            return
+        
+        # The displayed image (possibly a reduced preview) is plenty for finding the grid
+        with span("auto_grid.detect"):
+            detection = detect_grid(self.image)
+        print(f"Detected {detection!r}")
+        if detection.confidence < AUTO_GRID_MIN_CONFIDENCE:
+            self.status_label.config(text=f"No clear grid found (confidence {detection.confidence:.2f}). Draw rectangle around grid.")
+            return
+        
+        self.clear_selection()
+        
+        # Detection ran on self.image; map its box to canvas coordinates
+        scale = self.image_size[0] / self.image.width * self.scale_factor
+        x1, y1, x2, y2 = detection.roi
+        self.rect_start_x, self.rect_start_y = x1 * scale, y1 * scale
+        self.rect_end_x, self.rect_end_y = (x2 + 1) * scale, (y2 + 1) * scale
+        self.canvas.create_rectangle(
+            self.rect_start_x, self.rect_start_y,
+            self.rect_end_x, self.rect_end_y,
+            outline="red", width=2, tags="rect"
+        )
+        count("canvas.items_created")
+        self.detected_dims = (detection.rows, detection.cols)
+        self.status_label.config(
+            text=f"Detected {detection.rows} x {detection.cols} grid (confidence {detection.confidence:.2f}). "
+                 "Click 'Analyze Grid' to process.")
     
     def analyze_grid(self):
         if not self.image:
             messagebox.showinfo("Info", "Please load an image first.")
             return
             
-        if not self.reference_color:
-            messagebox.showinfo("Info", "Please set a reference color first.")
+        if not self.reference_color and self.palette_index is None:
+            messagebox.showinfo("Info", "Please set a reference color or load a palette first.")
             return
         
         if not (self.rect_start_x and self.rect_start_y and self.rect_end_x and self.rect_end_y):
@@ -315,31 +583,96 @@ class ColorGridAnalyzer:
         img_end_x = int(self.rect_end_x / self.scale_factor)
         img_end_y = int(self.rect_end_y / self.scale_factor)
         
-        # Make sure coordinates are within image bounds
-        img_width, img_height = self.image.size
-        img_start_x = max(0, min(img_start_x, img_width-1))
-        img_start_y = max(0, min(img_start_y, img_height-1))
-        img_end_x = max(0, min(img_end_x, img_width-1))
-        img_end_y = max(0, min(img_end_y, img_height-1))
-        
         # Ask user for grid dimensions
         grid_dims = self.ask_grid_dimensions()
         if not grid_dims:
             return
         
-        rows, cols = grid_dims
+        rows, cols, sample_size, sample_fraction = grid_dims
+        
+        # Extract and score grid colors on a worker thread (the core clamps the
+        # rectangle to the image); poll_worker picks up the result
+        roi = (img_start_x, img_start_y, img_end_x, img_end_y)
+        source = self.image_source
+        references = [self.reference_color] if self.reference_color else None
+        metric = self.selected_metric()
+        palette = self.palette_index
+        cache = self.result_cache
+        
+        def job(progress):
+            def load_sampler():
+                # The full-resolution pixels may still be decoding
+                with span("analyze.wait_decode"):
+                    while not source.wait(WORKER_POLL_MS / 1000):
+                        progress("Decoding image", 0.0)
+                return source.sampler
+            
+            # Re-analyzing an image with the same grid reuses the cached cell colors
+            with span("analyze_grid", grid=f"{rows}x{cols}"):
+                with span("analyze.digest"):
+                    digest = file_digest(source.path, cache)
+                return analyze_grid(load_sampler, roi, rows, cols, references,
+                                    sample_size=sample_size, sample_fraction=sample_fraction, metric=metric,
+                                    palette=palette, top_k=PALETTE_TOP_K, progress=progress,
+                                    cache=cache, image_digest=digest)
+        
+        self.cancel_analysis()
+        self.worker = AnalysisWorker(job).start()
+        self.analyze_btn.config(state=tk.DISABLED)
+        self.cancel_btn.config(state=tk.NORMAL)
+        self.status_label.config(text="Analyzing...")
+        self.root.after(WORKER_POLL_MS, self.poll_worker)
+    
+    def poll_worker(self):
+        worker = self.worker
+        if worker is None:
+            return
         
-        # Extract grid colors
-        self.extract_grid_colors(img_start_x, img_start_y, img_end_x, img_end_y, rows, cols)
+        for message in worker.poll():
+            kind = message[0]
+            if kind == "progress":
+                stage, fraction = message[1], message[2]
+                self.status_label.config(text=f"{stage}... {fraction:.0%}")
+                continue
+            
+            self.finish_worker()
+            if kind == "done":
+                self.grid_result = message[1]
+                with span("show_image.grid"):
+                    self.draw_grid()
+                
+                # Calculate color similarities and display results
+                self.calculate_and_display_results()
+                result = self.grid_result
+                self.status_label.config(text=f"Grid analyzed: {result.rows} rows x {result.cols} columns")
+            elif kind == "cancelled":
+                self.status_label.config(text="Analysis cancelled")
+            else:
+                error_msg = f"Failed to analyze grid: {str(message[1])}"
+                print(error_msg)
+                self.status_label.config(text="Analysis failed")
+                messagebox.showerror("Error", error_msg)
+            return
         
-        # Calculate color similarities and display results
-        self.calculate_and_display_results()
+        self.root.after(WORKER_POLL_MS, self.poll_worker)
+    
+    def finish_worker(self):
+        self.worker = None
+        self.analyze_btn.config(state=tk.NORMAL)
+        self.cancel_btn.config(state=tk.DISABLED)
+    
+    def cancel_analysis(self):
+        # Stop a running analysis
+        if self.worker is not None:
+            self.worker.cancel()
+            self.finish_worker()
+            self.status_label.config(text="Analysis cancelled")
     
     def ask_grid_dimensions(self):
         # Create a dialog to ask for grid dimensions
         dialog = tk.Toplevel(self.root)
         dialog.title("Grid Dimensions")
-        dialog.geometry("300x150")
+        dialog.geometry("300x180")
         dialog.transient(self.root)
         dialog.grab_set()
         
@@ -349,15 +682,22 @@ class ColorGridAnalyzer:
         frame.pack(pady=5)
         
         tk.Label(frame, text="Rows:").grid(row=0, column=0, padx=5, pady=5)
-        rows_var = tk.StringVar(value="8")  # Default rows (A-H)
+        default_rows, default_cols = self.detected_dims or (8, 12)
+        rows_var = tk.StringVar(value=str(default_rows))  # Default rows (A-H), or the detected grid
         rows_entry = tk.Entry(frame, textvariable=rows_var, width=5)
         rows_entry.grid(row=0, column=1, padx=5, pady=5)
         
         tk.Label(frame, text="Columns:").grid(row=0, column=2, padx=5, pady=5)
-        cols_var = tk.StringVar(value="12")  # Default columns (1-12)
+        cols_var = tk.StringVar(value=str(default_cols))  # Default columns (1-12)
         cols_entry = tk.Entry(frame, textvariable=cols_var, width=5)
         cols_entry.grid(row=0, column=3, padx=5, pady=5)
         
+        tk.Label(frame, text="Sample:").grid(row=1, column=0, padx=5, pady=5)
+        window_var = tk.StringVar(value=self.sample_window)  # Pixels (7) or share of cell (80%)
+        window_entry = tk.Entry(frame, textvariable=window_var, width=5)
+        window_entry.grid(row=1, column=1, padx=5, pady=5)
+        tk.Label(frame, text="px or %").grid(row=1, column=2, columnspan=2, sticky="w", padx=5, pady=5)
+        
         result = [None]
         
         def on_ok():
@@ -366,7 +706,9 @@ class ColorGridAnalyzer:
                 cols = int(cols_var.get())
                 if rows <= 0 or cols <= 0:
                     raise ValueError("Values must be positive")
-                result[0] = (rows, cols)
+                sample_size, sample_fraction = parse_sample_window(window_var.get())
+                self.sample_window = window_var.get().strip()
+                result[0] = (rows, cols, sample_size, sample_fraction)
                 dialog.destroy()
             except ValueError as e:
                 messagebox.showerror("Error", f"Invalid input: {str(e)}")
@@ -385,181 +727,316 @@ class ColorGridAnalyzer:
         
         return result[0]
     
-    def extract_grid_colors(self, start_x, start_y, end_x, end_y, rows, cols):
-        # Clear old grid
-        self.canvas.delete("grid")
-        self.grid_colors = []
-        
-        # Calculate cell dimensions
-        width = end_x - start_x
-        height = end_y - start_y
-        cell_width = width / cols
-        cell_height = height / rows
-        
-        # Extract colors for each cell
-        for row in range(rows):
-            row_colors = []
-            for col in range(cols):
-                # Calculate cell bounds
-                cell_x1 = start_x + col * cell_width
-                cell_y1 = start_y + row * cell_height
-                cell_x2 = cell_x1 + cell_width
-                cell_y2 = cell_y1 + cell_height
-                
-                # Calculate center point for sampling
-                center_x = int(cell_x1 + cell_width / 2)
-                center_y = int(cell_y1 + cell_height / 2)
-                
-                # Make sure coordinates are within image bounds
-                img_width, img_height = self.image.size
-                center_x = max(0, min(center_x, img_width-1))
-                center_y = max(0, min(center_y, img_height-1))
-                
-                # Sample color (average of small area)
-                sample_size = 3
-                x_min = max(0, center_x - sample_size)
-                x_max = min(img_width - 1, center_x + sample_size)
-                y_min = max(0, center_y - sample_size)
-                y_max = min(img_height - 1, center_y + sample_size)
-                
-                colors = []
-                for x in range(x_min, x_max + 1):
-                    for y in range(y_min, y_max + 1):
-                        try:
-                            pixel = self.image.getpixel((x, y))
-                            if len(pixel) > 3:  # RGBA format
-                                pixel = pixel[:3]
-                            colors.append(pixel)
-                        except Exception as e:
-                            print(f"Error sampling pixel at ({x},{y}): {str(e)}")
-                
-                # Average the colors
-                if colors:
-                    avg_color = tuple(int(sum(c[i] for c in colors) / len(colors)) for i in range(3))
-                else:
-                    avg_color = (128, 128, 128)  # Default gray if no colors sampled
-                
-                # Store color and position
-                position = f"{chr(65 + row)}{col + 1}"  # A1, B2, etc.
-                row_colors.append({
-                    'position': position,
-                    'color': avg_color,
-                    'canvas_x1': self.scale_factor * cell_x1,
-                    'canvas_y1': self.scale_factor * cell_y1,
-                    'canvas_x2': self.scale_factor * cell_x2,
-                    'canvas_y2': self.scale_factor * cell_y2
-                })
-                
-                # Draw grid cell on canvas
-                scaled_x1 = self.scale_factor * cell_x1
-                scaled_y1 = self.scale_factor * cell_y1
-                scaled_x2 = self.scale_factor * cell_x2
-                scaled_y2 = self.scale_factor * cell_y2
-                
-                self.canvas.create_rectangle(
-                    scaled_x1, scaled_y1, scaled_x2, scaled_y2,
-                    outline="white", width=1, tags="grid"
-                )
-                
-                # Add label
-                self.canvas.create_text(
-                    (scaled_x1 + scaled_x2) / 2,
-                    (scaled_y1 + scaled_y2) / 2,
-                    text=position,
-                    fill="white",
-                    font=("Arial", 8),
-                    tags="grid"
-                )
-            
-            self.grid_colors.append(row_colors)
+    def draw_grid(self):
+        # Cell bounds at the current zoom; colors and positions stay in grid_result
+        self.cell_canvas_boxes = self.grid_result.cell_boxes() * self.scale_factor
         
-        self.status_label.config(text=f"Grid analyzed: {rows} rows x {cols} columns")
+        # Grid lines and labels are drawn as one overlay image
+        self.update_overlay()
     
-    def calculate_and_display_results(self):
-        if not self.grid_colors or not self.reference_color:
+    def update_overlay(self):
+        result = self.grid_result
+        if result is None or self.image_tk is None:
+            self.canvas.delete("grid")
+            self.overlay_item = None
+            self.overlay_key = None
+            self.heatmap_item = None
+            self.heatmap_key = None
             return
         
-        # Clear existing results
-        for item in self.results_tree.get_children():
-            self.results_tree.delete(item)
-        
-        # Flatten grid colors into a list
-        all_cells = []
-        for row in self.grid_colors:
-            all_cells.extend(row)
-        
-        # Calculate similarity for each cell
-        for cell in all_cells:
-            color = cell['color']
-            similarity = self.calculate_color_similarity(color, self.reference_color)
-            cell['similarity'] = similarity
-        
-        # Sort by similarity (highest first)
-        all_cells.sort(key=lambda x: x['similarity'], reverse=True)
-        
-        # Add to treeview
-        for i, cell in enumerate(all_cells):
-            pos = cell['position']
-            color = cell['color']
-            rgb = f"({color[0]}, {color[1]}, {color[2]})"
-            hex_color = f"#{color[0]:02X}{color[1]:02X}{color[2]:02X}"
-            similarity = f"{cell['similarity']:.2f}%"
+        # Heatmap of the current scores, or of the palette match distances
+        heatmap_values = None
+        heatmap_key = None
+        if self.heatmap_var.get():
+            if result.similarity is not None:
+                heatmap_values = result.similarity[0]
+                heatmap_key = (result.metric, tuple(int(c) for c in result.references[0]))
+            elif result.match_distances is not None:
+                heatmap_values = -result.match_distances[:, 0]
+                heatmap_key = "palette"
+        
+        roi = [v * self.scale_factor for v in result.roi]
+        
+        # Grid lines and labels only change with the ROI, grid or zoom
+        key = (result.roi, result.rows, result.cols, self.image_tk.size)
+        if key != self.overlay_key or self.overlay_item is None:
+            self.overlay_key = key
+            with span("overlay.grid"):
+                overlay = render_grid_overlay(self.image_tk.size, roi, result.rows, result.cols,
+                                              labels=result.positions())
+                self.overlay_photo = ImageTk.PhotoImage(overlay)
+            count("pixels.overlay", overlay.width * overlay.height)
             
-            # Add row to treeview
-            item_id = self.results_tree.insert(
-                "", "end", 
-                values=(pos, "", rgb, hex_color, similarity)
+            if self.overlay_item is None:
+                self.overlay_item = self.canvas.create_image(0, 0, anchor=tk.NW, image=self.overlay_photo, tags="grid")
+                self.canvas.tag_raise("highlight")
+                count("canvas.items_created")
+            else:
+                self.canvas.itemconfig(self.overlay_item, image=self.overlay_photo)
+        
+        # The heatmap layer sits between the image and the grid lines and is
+        # redrawn on its own when the scores change (e.g. while hovering)
+        key = key + (heatmap_key,)
+        if key == self.heatmap_key and (self.heatmap_item is not None or heatmap_key is None):
+            return
+        self.heatmap_key = key
+        layer = None
+        if heatmap_values is not None:
+            with span("overlay.heatmap"):
+                heatmap = heatmap_colors(heatmap_values).reshape(result.rows, result.cols, 4)
+                layer = render_heatmap(self.image_tk.size, roi, result.rows, result.cols, heatmap)
+        if layer is None:
+            self.canvas.delete("heatmap")
+            self.heatmap_item = None
+            return
+        
+        image, (left, top) = layer
+        self.heatmap_photo = ImageTk.PhotoImage(image)
+        count("pixels.overlay", image.width * image.height)
+        if self.heatmap_item is None:
+            self.heatmap_item = self.canvas.create_image(left, top, anchor=tk.NW, image=self.heatmap_photo,
+                                                         tags=("grid", "heatmap"))
+            self.canvas.tag_lower(self.heatmap_item, self.overlay_item)
+            count("canvas.items_created")
+        else:
+            self.canvas.coords(self.heatmap_item, left, top)
+            self.canvas.itemconfig(self.heatmap_item, image=self.heatmap_photo)
+    
+    def highlight_cell(self, x1, y1, x2, y2):
+        # Move the single highlight rectangle instead of redrawing anything
+        if self.highlight_item is None:
+            self.highlight_item = self.canvas.create_rectangle(
+                x1, y1, x2, y2,
+                outline="red", width=2, tags="highlight"
             )
-            
-            # Configure tag for this item
-            tag_name = f"color_{i}"
-            self.results_tree.tag_configure(tag_name, background=hex_color)
-            self.results_tree.item(item_id, tags=(tag_name,))
+            count("canvas.items_created")
+        else:
+            self.canvas.coords(self.highlight_item, x1, y1, x2, y2)
     
-    def calculate_color_similarity(self, color1, color2):
+    def calculate_and_display_results(self):
+        result = self.grid_result
+        reference = self.active_reference()
+        if result is None or (not reference and result.matches is None):
+            return
+        
+        # Score every cell against the reference and rank (highest first),
+        # applying the threshold and top-N filters; without a reference, sort
+        # by distance to the nearest palette color. Only the stored cell colors
+        # are re-scored, so this is fast enough to run on every hover update.
+        top_n, min_match = self.read_result_filters()
+        if reference:
+            metric = self.selected_metric()
+            if (result.similarity is None or result.metric != metric
+                    or tuple(result.references[0]) != tuple(reference)):
+                with span("results.score", metric=metric):
+                    result.score(reference, metric)
+            self.result_similarities = result.similarity[0]
+            with span("results.rank"):
+                order = result.ranking(top=top_n, min_similarity=min_match)
+        else:
+            self.result_similarities = None
+            with span("results.rank"):
+                order = result.match_ranking()[:top_n]
+        self.result_order = order
+        
+        # Only the visible rows are ever formatted and shown
+        with span("results.populate", rows=len(order)):
+            self.results_view.set_rows(len(order), self.result_row_values)
+        self.result_count_label.config(text=f"Showing {len(order)} of {len(result)} cells")
+        
+        # The heatmap follows the current scores
+        with span("results.overlay"):
+            self.update_overlay()
+    
+    def result_row_values(self, row):
+        count("results.rows_formatted")
+        result = self.grid_result
+        index = self.result_order[row]
+        color = tuple(int(c) for c in result.colors[index])
+        rgb = f"({color[0]}, {color[1]}, {color[2]})"
+        hex_color = f"#{color[0]:02X}{color[1]:02X}{color[2]:02X}"
+        if self.result_similarities is not None:
+            similarity = f"{self.result_similarities[index]:.2f}%"
+        else:
+            similarity = "-"
+        match, alternatives = self.format_palette_matches(index)
+        return (result.position(index), "", rgb, hex_color, similarity, match, alternatives), hex_color
+    
+    def read_result_filters(self):
+        # Blank fields mean no filter; invalid input (including a Top of 0 or less) is ignored
         try:
-            # Simple Euclidean distance in RGB space
-            rgb_distance = math.sqrt(sum((c1 - c2) ** 2 for c1, c2 in zip(color1, color2)))
-            max_rgb_distance = math.sqrt(3 * 255 * 255)  # Maximum possible distance
-            rgb_similarity = 100 * (1 - (rgb_distance / max_rgb_distance))
-            
-            return rgb_similarity
-            
-        except Exception as e:
-            print(f"Error calculating color similarity: {str(e)}")
-            return 0  # Return 0% similarity on error
+            top_n = int(self.top_n_var.get()) if self.top_n_var.get().strip() else None
+        except ValueError:
+            top_n = None
+        if top_n is not None and top_n <= 0:
+            top_n = None
+        try:
+            min_match = float(self.min_match_var.get()) if self.min_match_var.get().strip() else None
+        except ValueError:
+            min_match = None
+        return top_n, min_match
     
-    def on_result_click(self, event):
-        # Get selected item
-        item_id = self.results_tree.focus()
-        if not item_id:
+    def on_filter_change(self, event=None):
+        self.calculate_and_display_results()
+    
+    def format_palette_matches(self, index):
+        result = self.grid_result
+        if result.matches is None:
+            return "", ""
+        
+        names = self.palette_index.names
+        ids = result.matches[index]
+        distances = result.match_distances[index]
+        match = f"{names[ids[0]]} (dE {distances[0]:.1f})"
+        alternatives = ", ".join(f"{names[i]} ({d:.1f})" for i, d in zip(ids[1:], distances[1:]))
+        return match, alternatives
+    
+    def active_reference(self):
+        # The hovered color while live mode previews one, else the sampled reference
+        return self.hover_reference or self.reference_color
+    
+    def on_canvas_hover(self, event):
+        if not self.live_var.get() or self.grid_result is None:
             return
         
-        # Get values
-        values = self.results_tree.item(item_id, 'values')
-        if not values:
+        # Coalesce motion events: only the latest point is scored, once Tk is idle
+        self.hover_point = (event.x, event.y)
+        if self.hover_job is None:
+            self.hover_job = self.root.after_idle(self.apply_hover_reference)
+    
+    def apply_hover_reference(self):
+        self.hover_job = None
+        if not self.live_var.get() or self.grid_result is None:
             return
-            
-        position = values[0]
-        
-        # Find the corresponding cell in grid_colors
-        selected_cell = None
-        for row in self.grid_colors:
-            for cell in row:
-                if cell['position'] == position:
-                    selected_cell = cell
-                    break
-            if selected_cell:
-                break
-        
-        if selected_cell:
-            # Highlight the cell on the canvas
-            self.canvas.delete("highlight")
-            self.canvas.create_rectangle(
-                selected_cell['canvas_x1'], selected_cell['canvas_y1'],
-                selected_cell['canvas_x2'], selected_cell['canvas_y2'],
-                outline="red", width=2, tags="highlight"
-            )
+        pixel = self.pixel_at(*self.hover_point)
+        if pixel is None or pixel == self.hover_reference:
+            return
+        self.hover_reference = pixel
+        self.show_reference(pixel)
+        self.calculate_and_display_results()
+    
+    def on_canvas_leave(self, event=None):
+        # Back to the sampled reference
+        if self.hover_job is not None:
+            self.root.after_cancel(self.hover_job)
+            self.hover_job = None
+        if self.hover_reference is None:
+            return
+        self.hover_reference = None
+        self.show_reference(self.reference_color)
+        if self.grid_result is None:
+            return
+        
+        if self.reference_color is None:
+            # Nothing was sampled: drop the preview scores
+            self.grid_result.similarity = None
+            self.results_view.clear()
+            self.result_count_label.config(text="")
+            self.update_overlay()
+        self.calculate_and_display_results()
+    
+    def on_live_toggle(self):
+        if not self.live_var.get():
+            self.on_canvas_leave()
+    
+    def selected_metric(self):
+        return self.metric_var.get().lower()
+    
+    def on_metric_change(self, event):
+        # Re-rank the current grid with the newly selected metric
+        self.calculate_and_display_results()
+    
+    def on_result_click(self, row):
+        # Called by the results view with the clicked row of the filtered ranking,
+        # which holds the cell index directly
+        if self.cell_canvas_boxes is None or self.result_order is None:
+            return
+        index = self.result_order[row]
+        
+        # Highlight the cell on the canvas
+        self.highlight_cell(*(float(v) for v in self.cell_canvas_boxes[index]))
+    
+    def show_stats_panel(self):
+        # Per-stage timings and counters. Profiling runs while the panel is
+        # open (or always, when started with KBTG_PROFILE=1).
+        if self.stats_window is not None:
+            self.stats_window.lift()
+            return
+        PROFILER.enabled = True
+        
+        window = tk.Toplevel(self.root)
+        window.title("Timing Stats")
+        window.geometry("560x420")
+        window.protocol("WM_DELETE_WINDOW", self.close_stats_panel)
+        self.stats_window = window
+        
+        columns = ("calls", "total", "mean", "max", "last")
+        tree = ttk.Treeview(window, columns=columns, height=16)
+        tree.heading("#0", text="Stage")
+        tree.column("#0", width=180, anchor=tk.W)
+        for column in columns:
+            tree.heading(column, text=column.title() if column == "calls" else f"{column.title()} ms")
+            tree.column(column, width=70, anchor=tk.E)
+        tree.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        self.stats_tree = tree
+        
+        btn_frame = tk.Frame(window)
+        btn_frame.pack(pady=5)
+        tk.Button(btn_frame, text="Clear", command=self.clear_stats).pack(side=tk.LEFT, padx=5)
+        tk.Button(btn_frame, text="Export JSON", command=self.export_stats_json).pack(side=tk.LEFT, padx=5)
+        tk.Button(btn_frame, text="Export Trace", command=self.export_stats_trace).pack(side=tk.LEFT, padx=5)
+        
+        self.refresh_stats()
+    
+    def refresh_stats(self):
+        if self.stats_window is None:
+            return
+        tree = self.stats_tree
+        tree.delete(*tree.get_children())
+        for name, stage in PROFILER.summary().items():
+            tree.insert("", tk.END, text=name, values=(
+                stage["calls"], f"{stage['total_ms']:.1f}", f"{stage['mean_ms']:.1f}",
+                f"{stage['max_ms']:.1f}", f"{stage['last_ms']:.1f}"))
+        for name, value in sorted(PROFILER.counters.items()):
+            tree.insert("", tk.END, text=name, values=(f"{value:,}", "", "", "", ""))
+        self.stats_job = self.root.after(STATS_REFRESH_MS, self.refresh_stats)
+    
+    def close_stats_panel(self):
+        if self.stats_job is not None:
+            self.root.after_cancel(self.stats_job)
+            self.stats_job = None
+        self.stats_window.destroy()
+        self.stats_window = None
+        self.stats_tree = None
+        PROFILER.enabled = os.environ.get(PROFILE_ENV) == "1"
+    
+    def clear_stats(self):
+        PROFILER.clear()  # The panel empties on its next refresh
+    
+    def export_stats_json(self):
+        file_path = filedialog.asksaveasfilename(
+            title="Export Timings",
+            defaultextension=".json",
+            filetypes=[("JSON files", "*.json")]
+        )
+        if file_path:
+            try:
+                PROFILER.save_json(file_path)
+            except OSError as e:
+                messagebox.showerror("Error", f"Failed to export timings: {str(e)}")
+    
+    def export_stats_trace(self):
+        # Chrome trace format, for chrome://tracing or ui.perfetto.dev
+        file_path = filedialog.asksaveasfilename(
+            title="Export Trace",
+            defaultextension=".json",
+            filetypes=[("Trace files", "*.json")]
+        )
+        if file_path:
+            try:
+                PROFILER.save_chrome_trace(file_path)
+            except OSError as e:
+                messagebox.showerror("Error", f"Failed to export trace: {str(e)}")
 
 if __name__ == "__main__":
     print("Starting KBTG Color Analyzer")
@@ -571,10 +1048,10 @@ if __name__ == "__main__":
     
     # Configure window resize handler
     def on_resize(event):
-        # Only handle canvas frame resizes
+        # Only handle canvas frame resizes; the redraw waits until resizing settles
         if event.widget == app.canvas_frame and app.image:
             try:
-                app.show_image()
+                app.schedule_show_image()
             except Exception as e:
                 print(f"Error in resize handler: {e}")
     
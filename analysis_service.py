@@ -0,0 +1,359 @@
+import argparse
+import http.client
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from batch_analyze import analyze_image, parse_color, result_record
+from color_metrics import METRICS
+from grid_detection import MIN_CONFIDENCE
+from grid_sampling import parse_sample_window, SAMPLE_SIZE
+from palette_index import get_palette_index
+from result_cache import ResultCache
+
+# Long-running local analysis service, so other programs (a LIMS, scripts)
+# can score plate images without starting Python for each one. Worker
+# processes are started once and stay warm: imports are done, palette
+# indexes are built on first use and kept, and each worker keeps a cache of
+# recent cell colors. Requests are JSON over HTTP on localhost or on a Unix
+# socket:
+#
+#   POST /analyze  {"images": ["plate1.jpg", ...], "reference": ["#C81E1E"],
+#                   "rows": 8, "cols": 12, "roi": [x1, y1, x2, y2], ...}
+#     -> {"results": [one batch_analyze record per image], "elapsed_ms": ...}
+#   GET /health   -> {"status": "ok", "workers": ..., "requests": ..., ...}
+#
+# Options of /analyze, all optional but "images": reference (a color or a
+# list), palette (a file path), top_k, roi, corners, rows, cols, window
+# ("7" or "80%"), metric, auto_grid and min_confidence, as in batch mode.
+# A request's images are split over the workers; images that fail get an
+# error record, as in batch mode. If a worker process dies (a crash in a
+# decoder, the OOM killer), the pool is replaced and the images it was
+# analyzing get error records too.
+
+DEFAULT_PORT = 8765
+
+# Most images of one request given to a worker at once, so concurrent
+# requests take turns instead of queueing behind a large one
+SERVICE_CHUNK_IMAGES = 8
+
+# Largest request body accepted
+MAX_REQUEST_BYTES = 1 << 20
+
+# Cell color entries each worker keeps in memory
+WORKER_CACHE_ENTRIES = 1024
+
+_worker_cache = None
+
+
+def init_service_worker(palette_paths, cache_dir=None):
+    global _worker_cache
+    _worker_cache = ResultCache(max_entries=WORKER_CACHE_ENTRIES, directory=cache_dir)
+    for path in palette_paths:
+        get_palette_index(path)  # Built now so no request waits for it
+
+
+def worker_ready():
+    return os.getpid()
+
+
+def parse_options(request):
+    # Keyword arguments of analyze_image from a request body; raises
+    # ValueError with a message for the client
+    if not isinstance(request, dict):
+        raise ValueError("Request must be a JSON object")
+    images = request.get("images")
+    if isinstance(images, str):
+        images = [images]
+    if not images or not all(isinstance(path, str) for path in images):
+        raise ValueError("images must be a list of image paths")
+
+    references = request.get("reference")
+    if isinstance(references, str):
+        references = [references]
+    try:
+        references = [parse_color(text) for text in references] if references else None
+    except argparse.ArgumentTypeError as e:
+        raise ValueError(str(e))
+    palette = request.get("palette")
+    if not references and not palette:
+        raise ValueError("Give at least one reference color or a palette")
+
+    options = {
+        "roi": request.get("roi"),
+        "rows": int(request.get("rows", 8)),
+        "cols": int(request.get("cols", 12)),
+        "references": references,
+        "window": parse_sample_window(request.get("window", 2 * SAMPLE_SIZE + 1)),
+        "metric": request.get("metric", "rgb"),
+        "top_k": int(request.get("top_k", 3)),
+        "auto_grid": bool(request.get("auto_grid", False)),
+        "min_confidence": float(request.get("min_confidence", MIN_CONFIDENCE)),
+        "corners": request.get("corners"),
+    }
+    if options["rows"] <= 0 or options["cols"] <= 0:
+        raise ValueError("rows and cols must be positive")
+    if options["metric"] not in METRICS:
+        raise ValueError(f"metric must be one of {', '.join(METRICS)}")
+    if options["top_k"] <= 0:
+        raise ValueError("top_k must be positive")
+    if options["roi"] is not None and len(options["roi"]) != 4:
+        raise ValueError("roi must be [x1, y1, x2, y2]")
+    if options["corners"] is not None and len(options["corners"]) != 4:
+        raise ValueError("corners must be four [x, y] points")
+    if sum(bool(options[name]) for name in ("roi", "corners", "auto_grid")) > 1:
+        raise ValueError("Use only one of roi, corners and auto_grid")
+    if palette is not None:
+        if not os.path.isfile(palette):
+            raise ValueError(f"Palette not found: {palette}")
+        palette = os.path.abspath(palette)
+    return images, palette, options
+
+
+def analyze_images(paths, palette_path, options):
+    # Runs in a worker process; errors are reported per image, not raised
+    palette = get_palette_index(palette_path) if palette_path else None
+    records = []
+    for path in paths:
+        try:
+            result, confidence = analyze_image(path, palette=palette, cache=_worker_cache, **options)
+            records.append(result_record(path, result, confidence, palette))
+        except Exception as e:
+            records.append({"image": path, "error": str(e)})
+    return records
+
+
+class AnalysisService:
+    # The warm worker pool and the request counters shared by all
+    # connections
+
+    def __init__(self, workers=None, palette_paths=(), cache_dir=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.palette_paths = [os.path.abspath(path) for path in palette_paths]
+        self.cache_dir = cache_dir
+        self.executor = self._start_executor()
+        self.requests = 0
+        self.images = 0
+        self.restarts = 0
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def _start_executor(self):
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=init_service_worker,
+                                   initargs=(self.palette_paths, self.cache_dir))
+
+    def _replace_broken(self, executor):
+        # A new pool in place of a broken one. Requests that saw the same
+        # pool break all call this; only the first replaces it.
+        with self._lock:
+            if self.executor is executor:
+                self.executor = self._start_executor()
+                self.restarts += 1
+                executor.shutdown(wait=False)
+            return self.executor
+
+    def _submit(self, paths, palette, options):
+        # (executor, future) of one chunk, on a new pool if the current one broke
+        executor = self.executor
+        try:
+            return executor, executor.submit(analyze_images, paths, palette, options)
+        except BrokenProcessPool:
+            executor = self._replace_broken(executor)
+            return executor, executor.submit(analyze_images, paths, palette, options)
+
+    def warm_up(self):
+        # Start every worker process now rather than on the first request
+        futures = [self.executor.submit(worker_ready) for _ in range(self.workers)]
+        return {future.result() for future in futures}
+
+    def analyze(self, request):
+        images, palette, options = parse_options(request)
+        chunk = max(1, min(SERVICE_CHUNK_IMAGES, -(-len(images) // self.workers)))
+        chunks = [images[i:i + chunk] for i in range(0, len(images), chunk)]
+        futures = [self._submit(paths, palette, options) for paths in chunks]
+        results = []
+        for paths, (executor, future) in zip(chunks, futures):
+            try:
+                results.extend(future.result())
+            except BrokenProcessPool:
+                # Every chunk still pending on the pool fails with it; which
+                # image killed the worker is unknown
+                self._replace_broken(executor)
+                results.extend({"image": path, "error": "Worker process died while analyzing this image"}
+                               for path in paths)
+        with self._lock:
+            self.requests += 1
+            self.images += len(images)
+        return results
+
+    def health(self):
+        with self._lock:
+            return {"status": "ok", "workers": self.workers, "palettes": self.palette_paths,
+                    "requests": self.requests, "images": self.images, "worker_restarts": self.restarts,
+                    "uptime_s": round(time.time() - self.started, 1)}
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, so a client can reuse its connection
+    disable_nagle_algorithm = True  # Otherwise the body waits ~40 ms for the headers' ACK
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json(200, self.server.service.health())
+        else:
+            self.send_json(404, {"error": f"Unknown path: {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/analyze":
+            self.send_json(404, {"error": f"Unknown path: {self.path}"})
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_REQUEST_BYTES:
+            self.send_json(413, {"error": "Request too large"})
+            self.close_connection = True
+            return
+        start = time.perf_counter()
+        try:
+            request = json.loads(self.rfile.read(length) or b"null")
+            results = self.server.service.analyze(request)
+        except (ValueError, TypeError) as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        except Exception as e:
+            self.send_json(500, {"error": str(e)})
+            return
+        self.send_json(200, {"results": results, "elapsed_ms": round((time.perf_counter() - start) * 1000, 3)})
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "local"
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+class UnixServiceHandler(ServiceHandler):
+    disable_nagle_algorithm = False  # A TCP option; Unix sockets have no Nagle delay
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(service, host="127.0.0.1", port=DEFAULT_PORT, socket_path=None, quiet=False):
+    # An HTTP server for the service on host:port, or on a Unix socket
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = UnixHTTPServer(socket_path, UnixServiceHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), ServiceHandler)
+        server.daemon_threads = True
+    server.service = service
+    server.quiet = quiet
+    return server
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class ServiceClient:
+    # Minimal client that keeps one connection open:
+    #   client = ServiceClient(port=8765)   or   ServiceClient(socket_path="/tmp/kbtg.sock")
+    #   records = client.analyze(["plate.jpg"], reference="#C81E1E")
+
+    def __init__(self, host="127.0.0.1", port=DEFAULT_PORT, socket_path=None, timeout=None):
+        if socket_path:
+            self.connection = UnixHTTPConnection(socket_path, timeout)
+        else:
+            self.connection = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def request(self, method, path, body=None):
+        data = None if body is None else json.dumps(body).encode()
+        headers = {"Content-Type": "application/json"} if data is not None else {}
+        self.connection.request(method, path, data, headers)
+        response = self.connection.getresponse()
+        reply = json.loads(response.read())
+        if response.status != 200:
+            raise ValueError(f"{response.status}: {reply.get('error')}")
+        return reply
+
+    def analyze(self, images, **options):
+        return self.request("POST", "/analyze", {"images": list(images), **options})["results"]
+
+    def health(self):
+        return self.request("GET", "/health")
+
+    def close(self):
+        self.connection.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve color grid analysis to local programs over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: localhost only)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--socket", metavar="PATH", help="Listen on this Unix socket instead of a TCP port")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument("--palette", action="append", default=[],
+                        help="Palette file to index at start-up (repeatable); others are indexed on first use")
+    parser.add_argument("--cache", metavar="DIR", help="Also keep cell colors of analyzed images in this directory")
+    parser.add_argument("--quiet", action="store_true", help="Do not log each request")
+    args = parser.parse_args(argv)
+
+    if args.workers is not None and args.workers <= 0:
+        parser.error("workers must be positive")
+    for path in args.palette:
+        if not os.path.isfile(path):
+            parser.error(f"Palette not found: {path}")
+    if args.socket and not hasattr(socket, "AF_UNIX"):
+        parser.error("Unix sockets are not available on this system")
+
+    service = AnalysisService(args.workers, args.palette, args.cache)
+    start = time.perf_counter()
+    service.warm_up()
+    server = make_server(service, args.host, args.port, args.socket, args.quiet)
+    where = args.socket or f"http://{args.host}:{server.server_address[1]}"
+    print(f"Serving on {where} with {service.workers} warm workers "
+          f"(ready in {time.perf_counter() - start:.2f}s)", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if args.socket and os.path.exists(args.socket):
+            os.unlink(args.socket)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
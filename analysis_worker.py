@@ -0,0 +1,60 @@
+import queue
+import threading
+
+# Runs an analysis job off the Tk main thread. The GUI polls messages with
+# root.after, so no Tk call is ever made from the worker thread.
+
+
+class AnalysisCancelled(Exception):
+    pass
+
+
+class AnalysisWorker:
+    def __init__(self, job):
+        # job(progress) does the work and returns its result; it should call
+        # progress(stage, fraction) regularly, which raises AnalysisCancelled
+        # once cancel() has been requested
+        self.job = job
+        self.messages = queue.Queue()
+        self._cancel_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    def is_alive(self):
+        return self._thread.is_alive()
+
+    def progress(self, stage, fraction):
+        if self._cancel_event.is_set():
+            raise AnalysisCancelled()
+        self.messages.put(("progress", stage, fraction))
+
+    def poll(self):
+        # Drain pending messages: ("progress", stage, fraction), ("done", result),
+        # ("cancelled",) or ("error", exception)
+        pending = []
+        while True:
+            try:
+                pending.append(self.messages.get_nowait())
+            except queue.Empty:
+                return pending
+
+    def _run(self):
+        try:
+            result = self.job(self.progress)
+            if self._cancel_event.is_set():
+                raise AnalysisCancelled()
+            self.messages.put(("done", result))
+        except AnalysisCancelled:
+            self.messages.put(("cancelled",))
+        except Exception as e:
+            self.messages.put(("error", e))
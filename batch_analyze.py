@@ -0,0 +1,323 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from PIL import Image
+
+from color_metrics import METRICS
+from grid_analysis import analyze_grid
+from grid_detection import DETECT_SIZE, MIN_CONFIDENCE, detect_grid
+from grid_sampling import ImageSampler, RasterSampler, parse_sample_window, SAMPLE_SIZE
+from palette_index import get_palette_index
+from result_cache import ResultCache, file_digest
+from result_export import open_exporter
+from tiled_raster import open_raster
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".gif", ".tif", ".tiff")
+
+# Palette index and result cache set up in each worker process once, at start-up
+_worker_palette = None
+_worker_cache = None
+
+
+def parse_color(text):
+    # Accept "#RRGGBB", "RRGGBB" or "R,G,B"
+    text = text.strip()
+    if "," in text:
+        color = tuple(int(v) for v in text.split(","))
+    else:
+        text = text.lstrip("#")
+        if len(text) != 6:
+            raise argparse.ArgumentTypeError(f"Invalid color: {text}")
+        color = tuple(int(text[i:i + 2], 16) for i in (0, 2, 4))
+    if len(color) != 3 or not all(0 <= c <= 255 for c in color):
+        raise argparse.ArgumentTypeError(f"Invalid color: {text}")
+    return color
+
+
+def parse_roi(text):
+    roi = tuple(int(v) for v in text.split(","))
+    if len(roi) != 4:
+        raise argparse.ArgumentTypeError("ROI must be x1,y1,x2,y2")
+    return roi
+
+
+def parse_corners(text):
+    values = tuple(float(v) for v in text.split(","))
+    if len(values) != 8:
+        raise argparse.ArgumentTypeError("Corners must be x1,y1,x2,y2,x3,y3,x4,y4")
+    return tuple(zip(values[0::2], values[1::2]))
+
+
+def collect_images(inputs):
+    # Expand directories and glob patterns into a sorted list of image files
+    paths = []
+    for entry in inputs:
+        if os.path.isdir(entry):
+            for name in sorted(os.listdir(entry)):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    paths.append(os.path.join(entry, name))
+        else:
+            paths.extend(sorted(glob.glob(entry)))
+    return paths
+
+
+def parse_window(text):
+    try:
+        return parse_sample_window(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def init_worker(palette, cache_dir=None):
+    global _worker_palette, _worker_cache
+    _worker_palette = palette
+    _worker_cache = ResultCache(directory=cache_dir) if cache_dir else None
+
+
+def load_sampler(path):
+    raster = open_raster(path)
+    if raster is not None:
+        # Scans too large to decode are sampled straight from their tiles
+        return RasterSampler(raster)
+    with Image.open(path) as img:
+        return ImageSampler(img)  # Converted to RGB while copied, without another full-size image
+
+
+def find_grid(path, get_sampler, cache=None, digest=None):
+    # (roi, rows, cols, confidence) of the grid detected in the image,
+    # remembered in the cache by image content
+    key = ("grid", digest, DETECT_SIZE)
+    entry = cache.get(key) if cache is not None else None
+    if entry is None:
+        detection = detect_grid(get_sampler())
+        entry = {"roi": detection.roi, "dims": (detection.rows, detection.cols),
+                 "confidence": detection.confidence}
+        if cache is not None:
+            cache.put(key, **entry)
+    roi = tuple(int(v) for v in entry["roi"])
+    rows, cols = (int(v) for v in entry["dims"])
+    return roi, rows, cols, float(entry["confidence"])
+
+
+def analyze_image(path, roi, rows, cols, references, window=(SAMPLE_SIZE, None), metric="rgb",
+                  palette=None, top_k=3, cache=None, auto_grid=False, min_confidence=MIN_CONFIDENCE, corners=None):
+    # The GridResult of one image and, with auto_grid, the detection confidence.
+    # With a cache, an unchanged image is not decoded or sampled again.
+    # With auto_grid, roi, rows and cols come from detect_grid instead.
+    # corners, four (x, y) points, samples a skewed grid through its homography.
+    sample_size, sample_fraction = window
+    digest = file_digest(path, cache) if cache is not None else None
+
+    # Decoded at most once, and only if detection or sampling needs the pixels
+    loaded = []
+
+    def get_sampler():
+        if not loaded:
+            loaded.append(load_sampler(path))
+        return loaded[0]
+
+    confidence = None
+    try:
+        if auto_grid:
+            roi, rows, cols, confidence = find_grid(path, get_sampler, cache, digest)
+            if confidence < min_confidence:
+                raise ValueError(f"No grid detected (confidence {confidence:.2f})")
+
+        result = analyze_grid(get_sampler, roi, rows, cols, references,
+                              sample_size=sample_size, sample_fraction=sample_fraction, metric=metric,
+                              palette=palette, top_k=top_k, cache=cache, image_digest=digest, corners=corners)
+    finally:
+        if loaded and isinstance(loaded[0], RasterSampler):
+            loaded[0].raster.close()
+    return result, confidence
+
+
+def result_record(path, result, confidence=None, palette=None):
+    # The JSON Lines record of one image
+    scored = result.references is not None
+
+    # Whole columns are converted to Python values at once, not cell by cell
+    positions = result.positions()
+    colors = result.colors.tolist()
+    similarity = result.similarity.T.tolist() if scored else None
+    if palette is not None:
+        match_names = [[palette.names[i] for i in ids] for ids in result.matches.tolist()]
+        match_distances = result.match_distances.tolist()
+    cells = []
+    for index in range(len(result)):
+        cell = {"position": positions[index], "rgb": colors[index]}
+        if scored:
+            cell["similarity"] = [round(s, 4) for s in similarity[index]]
+        if palette is not None:
+            cell["matches"] = [{"name": name, "delta_e": round(d, 4)}
+                               for name, d in zip(match_names[index], match_distances[index])]
+        cells.append(cell)
+
+    record = {"image": path, "roi": list(result.roi), "rows": result.rows, "cols": result.cols,
+              "metric": result.metric}
+    if confidence is not None:
+        record["grid_confidence"] = round(confidence, 4)
+    if result.corners is not None:
+        record["corners"] = result.corners.tolist()
+    if scored:
+        record["best"] = [result.position(result.ranking(i, top=1)[0]) for i in range(len(result.references))]
+    record["cells"] = cells
+    return record
+
+
+def analyze_file(path, roi, rows, cols, references, window=(SAMPLE_SIZE, None), metric="rgb",
+                 palette=None, top_k=3, cache=None, auto_grid=False, min_confidence=MIN_CONFIDENCE, corners=None):
+    result, confidence = analyze_image(path, roi, rows, cols, references, window, metric, palette, top_k,
+                                       cache, auto_grid, min_confidence, corners)
+    return result_record(path, result, confidence, palette)
+
+
+def analyze_chunk(paths, roi, rows, cols, references, window, metric, top_k, auto_grid=False,
+                  min_confidence=MIN_CONFIDENCE, corners=None, export=False):
+    # Runs in a worker process; errors are reported per image, not raised.
+    # Returns (record, arrays) pairs, arrays being the result's columns for
+    # the exporters when export is set.
+    records = []
+    for path in paths:
+        try:
+            result, confidence = analyze_image(path, roi, rows, cols, references, window, metric,
+                                               _worker_palette, top_k, _worker_cache, auto_grid,
+                                               min_confidence, corners)
+            records.append((result_record(path, result, confidence, _worker_palette),
+                            result.to_arrays() if export else None))
+        except Exception as e:
+            records.append(({"image": path, "error": str(e)}, None))
+    return records
+
+
+def run_batch(paths, output, roi, rows, cols, references, window=(SAMPLE_SIZE, None), metric="rgb",
+              workers=None, chunksize=4, palette=None, top_k=3, cache_dir=None, auto_grid=False,
+              min_confidence=MIN_CONFIDENCE, corners=None, exporters=()):
+    # Keep only a few chunks in flight so memory stays bounded for any batch size.
+    # Each finished image is also appended to every exporter.
+    chunks = [paths[i:i + chunksize] for i in range(0, len(paths), chunksize)]
+    workers = workers or os.cpu_count() or 1
+    max_pending = workers * 2
+    done_count = 0
+    failed = 0
+
+    # The palette index is built once here and shipped to each worker once
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(palette, cache_dir)) as executor:
+        pending = set()
+        chunk_iter = iter(chunks)
+        while True:
+            for chunk in chunk_iter:
+                pending.add(executor.submit(analyze_chunk, chunk, roi, rows, cols, references, window,
+                                            metric, top_k, auto_grid, min_confidence, corners,
+                                            bool(exporters)))
+                if len(pending) >= max_pending:
+                    break
+            if not pending:
+                break
+
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                for record, arrays in future.result():
+                    if arrays is not None:
+                        # Every exporter has seen the same images, so a
+                        # mismatch is raised by the first one before anything
+                        # is written, and the image is reported as failed
+                        try:
+                            for exporter in exporters:
+                                exporter.write(record["image"], arrays)
+                        except ValueError as e:
+                            record = {"image": record["image"], "error": f"Not exported: {e}"}
+                    output.write(json.dumps(record) + "\n")
+                    done_count += 1
+                    failed += "error" in record
+            output.flush()
+            print(f"Processed {done_count}/{len(paths)} images", file=sys.stderr)
+
+    return done_count, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Analyze color grids in many images without the GUI.")
+    parser.add_argument("inputs", nargs="+", help="Image directories or glob patterns")
+    parser.add_argument("-r", "--reference", type=parse_color, action="append",
+                        help="Reference color as #RRGGBB or R,G,B (repeatable)")
+    parser.add_argument("--palette", help="Palette file (CSV/TSV/JSON of names and colors, or a saved .npz index)")
+    parser.add_argument("--top-k", type=int, default=3, help="Palette matches reported per cell")
+    parser.add_argument("--roi", type=parse_roi, help="Grid rectangle x1,y1,x2,y2 in image pixels (default: whole image)")
+    parser.add_argument("--corners", type=parse_corners,
+                        help="Skewed grid as its four outer corners x1,y1,...,x4,y4, clockwise from A1 (instead of --roi)")
+    parser.add_argument("--rows", type=int, default=8)
+    parser.add_argument("--cols", type=int, default=12)
+    parser.add_argument("--window", type=parse_window, default=(SAMPLE_SIZE, None),
+                        help="Pixels averaged per cell: width in pixels (7) or share of the cell (80%%)")
+    parser.add_argument("--metric", choices=METRICS, default="rgb", help="Color difference metric")
+    parser.add_argument("-o", "--output", help="JSON Lines output file (default: stdout)")
+    parser.add_argument("--export", action="append", metavar="FILE",
+                        help="Also write a per-cell table as .csv, .npz or .parquet (repeatable)")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument("--chunksize", type=int, default=4, help="Images per worker task")
+    parser.add_argument("--cache", metavar="DIR",
+                        help="Reuse cell colors and scores of unchanged images from this directory")
+    parser.add_argument("--auto-grid", action="store_true",
+                        help="Detect the grid rectangle, rows and cols in each image instead of --roi/--rows/--cols")
+    parser.add_argument("--min-confidence", type=float, default=MIN_CONFIDENCE,
+                        help="With --auto-grid, report images whose grid detection is less confident as errors "
+                             f"(default: {MIN_CONFIDENCE})")
+    args = parser.parse_args(argv)
+
+    if args.rows <= 0 or args.cols <= 0:
+        parser.error("rows and cols must be positive")
+    if args.chunksize <= 0:
+        parser.error("chunksize must be positive")
+    if not args.reference and not args.palette:
+        parser.error("Give at least one --reference color or a --palette")
+    if args.top_k <= 0:
+        parser.error("top-k must be positive")
+    if sum(bool(option) for option in (args.roi, args.corners, args.auto_grid)) > 1:
+        parser.error("Use only one of --roi, --corners and --auto-grid")
+    if not 0 <= args.min_confidence <= 1:
+        parser.error("min-confidence must be between 0 and 1")
+
+    paths = collect_images(args.inputs)
+    if not paths:
+        parser.error("No images found")
+
+    start = time.perf_counter()
+    palette = get_palette_index(args.palette) if args.palette else None
+    exporters = []
+    try:
+        for path in args.export or ():
+            exporters.append(open_exporter(path, palette.names if palette is not None else None))
+    except (OSError, ValueError) as e:
+        for exporter in exporters:
+            exporter.close()
+        parser.error(str(e))
+
+    output = open(args.output, "w") if args.output else sys.stdout
+    try:
+        done_count, failed = run_batch(paths, output, args.roi, args.rows, args.cols,
+                                       args.reference, args.window, args.metric, args.workers,
+                                       args.chunksize, palette, args.top_k, args.cache,
+                                       args.auto_grid, args.min_confidence, args.corners, exporters)
+    finally:
+        if args.output:
+            output.close()
+        for exporter in exporters:
+            exporter.close()
+
+    if args.cache:
+        ResultCache(directory=args.cache).prune()
+
+    elapsed = time.perf_counter() - start
+    print(f"Analyzed {done_count} images ({failed} failed) in {elapsed:.2f}s", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,236 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from color_metrics import METRICS
+from display_pyramid import DisplayPyramid
+from grid_analysis import GridResult, extract_cell_colors, extract_quad_colors
+from grid_detection import detect_grid
+from grid_sampling import ImageSampler, cell_centers, window_bounds, window_half_sizes
+from image_source import ImageSource
+from plates import PLATE_FORMATS, make_plate
+from result_export import CsvExporter, NpzExporter
+
+# Times every stage of the pipeline on synthetic plates, headless:
+#   decode     ImageSource preview (what load_image shows first) and full decode
+#   display    pyramid build and a resize served from it (show_image)
+#   detect     automatic grid detection
+#   sample     cell colors of the upright and of the skewed plate
+#   score      every cell against a reference, per metric
+#   rank       full ranking and the top 10
+#   export     CSV and NPZ tables for EXPORT_IMAGES copies of the result
+# Each stage reports its best run in milliseconds. Results can
+# be saved as JSON and compared against a saved baseline.
+
+# Results written per export timing
+EXPORT_IMAGES = 100
+
+# A stage regresses when it is this much slower than the baseline...
+DEFAULT_TOLERANCE = 0.3
+
+# ...and slower by at least this many milliseconds, so tiny stages do not flag on timer noise
+NOISE_FLOOR_MS = 1.0
+
+# Fast stages are re-run until they have taken this long in total, up to MAX_RUNS times
+MIN_STAGE_SECONDS = 0.3
+MAX_RUNS = 100
+
+# Canvas size the display stage resizes to, as in the GUI's default window
+DISPLAY_SIZE = (700, 500)
+
+
+def best_time(func, *args, repeat=3):
+    # Best of at least repeat runs, and of more for fast stages until they
+    # have run for MIN_STAGE_SECONDS, which steadies short timings
+    best = None
+    total = 0.0
+    runs = 0
+    while runs < repeat or (total < MIN_STAGE_SECONDS and runs < MAX_RUNS):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+        total += elapsed
+        runs += 1
+    return best * 1000, result
+
+
+def decode_preview(path):
+    source = ImageSource(path, preview_size=DISPLAY_SIZE)
+    source.preview.load()
+    return source
+
+
+def decode_full(path):
+    source = ImageSource(path, preview_size=DISPLAY_SIZE).start()
+    source.wait()
+    return source.sampler
+
+
+def check_colors(name, expected, actual, tolerance=12):
+    # The benchmarks should time correct work: warn if sampling drifted off the wells
+    error = np.abs(expected.astype(np.int16) - actual.reshape(expected.shape)).max()
+    if error > tolerance:
+        print(f"warning: {name} colors are off by up to {error}", file=sys.stderr)
+
+
+def run(size, wells_list, noise, skew, repeat, workdir):
+    results = {}
+
+    def record(name, func, *args):
+        elapsed, value = best_time(func, *args, repeat=repeat)
+        results[name] = round(elapsed, 3)
+        print(f"{name:32s} {elapsed:10.2f} ms", file=sys.stderr)
+        return value
+
+    for wells in wells_list:
+        rows, cols = PLATE_FORMATS[wells]
+        image, corners, colors = make_plate(wells, size, noise)
+        skewed, skewed_corners, _ = make_plate(wells, size, noise, skew)
+        x1, y1 = corners[0]
+        x2, y2 = corners[2]
+        roi = (int(x1), int(y1), int(x2), int(y2))
+
+        # Decoding is the same for every grid, so it is timed on the first plate only
+        if wells == wells_list[0]:
+            path = os.path.join(workdir, "plate.jpg")
+            image.save(path, quality=92)
+            record("decode.preview", decode_preview, path)
+            record("decode.full", decode_full, path)
+
+            pyramid = record("display.pyramid", DisplayPyramid, image)
+            sizes = [DISPLAY_SIZE, (DISPLAY_SIZE[0] - 1, DISPLAY_SIZE[1] - 1)]
+
+            def resize():
+                # Alternate sizes so the pyramid's last-size cache never answers
+                sizes.reverse()
+                return pyramid.get(sizes[0])
+
+            record("display.resize", resize)
+
+        sampler = record(f"sample.array/{wells}", ImageSampler, image)
+        record(f"detect/{wells}", detect_grid, sampler)
+
+        cell_colors = record(f"sample.window/{wells}", extract_cell_colors, sampler, roi, rows, cols)
+        check_colors(f"sample.window/{wells}", colors, cell_colors)
+        # The table covers the grid's windows, built once per grid as in the app
+        half_x, half_y = window_half_sizes((roi[2] - roi[0]) / cols, (roi[3] - roi[1]) / rows, None, 0.5)
+        bounds = window_bounds(*cell_centers(*roi, rows, cols, *sampler.size), half_x, half_y, sampler.size)
+        record(f"sample.integral_table/{wells}", lambda: ImageSampler(sampler.array).integral_table(bounds))
+        sampler.integral_table(bounds)
+        record(f"sample.fraction/{wells}", extract_cell_colors, sampler, roi, rows, cols, None, 0.5)
+
+        skewed_sampler = ImageSampler(skewed)
+        quad_colors = record(f"sample.skewed/{wells}", extract_quad_colors, skewed_sampler,
+                             skewed_corners, rows, cols, None, 0.5)
+        check_colors(f"sample.skewed/{wells}", colors, quad_colors)
+
+        result = GridResult(roi, rows, cols, cell_colors.reshape(-1, 3))
+        reference = tuple(int(c) for c in colors[0, 0])
+        for metric in METRICS:
+            # A fresh result each run so the Lab conversion is included
+            record(f"score.{metric}/{wells}",
+                   lambda: GridResult(roi, rows, cols, result.colors).score(reference, metric))
+        result.score(reference, "ciede2000")
+        record(f"rank.full/{wells}", result.ranking)
+        record(f"rank.top10/{wells}", lambda: result.ranking(top=10))
+
+        arrays = result.to_arrays()
+        for name, exporter in (("csv", CsvExporter), ("npz", NpzExporter)):
+            path = os.path.join(workdir, f"cells.{name}")
+
+            def export():
+                with exporter(path) as writer:
+                    for i in range(EXPORT_IMAGES):
+                        writer.write(f"plate_{i:05d}.jpg", arrays)
+
+            record(f"export.{name}/{wells}", export)
+    return results
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    # Names of the stages that got slower than the baseline allows
+    regressions = []
+    print(f"\n{'stage':32s} {'ms':>10s} {'baseline':>10s} {'change':>8s}", file=sys.stderr)
+    for name, elapsed in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:32s} {elapsed:10.2f} {'-':>10s} {'new':>8s}", file=sys.stderr)
+            continue
+        change = elapsed / base - 1 if base > 0 else 0.0
+        slower = change > tolerance and elapsed - base > NOISE_FLOOR_MS
+        flag = "  REGRESSION" if slower else ""
+        print(f"{name:32s} {elapsed:10.2f} {base:10.2f} {change:+8.0%}{flag}", file=sys.stderr)
+        if slower:
+            regressions.append(name)
+    return regressions
+
+
+def parse_size(text):
+    try:
+        width, height = (int(v) for v in text.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("Size must be WIDTHxHEIGHT")
+    return width, height
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time each stage of the analysis pipeline on synthetic plates.")
+    parser.add_argument("--size", type=parse_size, default=(4000, 3000), help="Plate image size (default 4000x3000)")
+    parser.add_argument("--wells", type=int, action="append", choices=sorted(PLATE_FORMATS),
+                        help="Plate format (repeatable, default: all)")
+    parser.add_argument("--noise", type=float, default=6.0, help="Sensor noise standard deviation")
+    parser.add_argument("--skew", type=float, default=0.04,
+                        help="Corner displacement of the skewed plate, as a share of the image size")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per stage; the best is kept")
+    parser.add_argument("-o", "--output", help="Write the results as JSON (use as a later --baseline)")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="Allowed slowdown before a stage is flagged (default 0.3 = 30%%)")
+    args = parser.parse_args(argv)
+
+    if args.repeat <= 0:
+        parser.error("repeat must be positive")
+    wells = sorted(set(args.wells or PLATE_FORMATS))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        results = run(args.size, wells, args.noise, args.skew, args.repeat, workdir)
+
+    report = {
+        "config": {"size": list(args.size), "wells": wells, "noise": args.noise, "skew": args.skew,
+                   "repeat": args.repeat},
+        "machine": {"python": platform.python_version(), "numpy": np.__version__,
+                    "pillow": Image.__version__, "platform": platform.platform(),
+                    "cpus": os.cpu_count()},
+        "results_ms": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if baseline is not None:
+        if baseline.get("config") != report["config"]:
+            print("warning: baseline was recorded with different settings", file=sys.stderr)
+        regressions = compare(results, baseline["results_ms"], args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} stage(s) regressed: {', '.join(regressions)}", file=sys.stderr)
+            return 1
+        print("\nNo regressions", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,88 @@
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from grid_sampling import (image_to_array, cell_centers, sample_cell_means, build_integral_image,
+                           integral_cell_means, SAMPLE_SIZE)
+
+
+def legacy_extract(image, start_x, start_y, end_x, end_y, rows, cols):
+    # The original per-pixel getpixel loop from extract_grid_colors
+    cell_width = (end_x - start_x) / cols
+    cell_height = (end_y - start_y) / rows
+    img_width, img_height = image.size
+    result = []
+    for row in range(rows):
+        for col in range(cols):
+            cell_x1 = start_x + col * cell_width
+            cell_y1 = start_y + row * cell_height
+            center_x = max(0, min(int(cell_x1 + cell_width / 2), img_width - 1))
+            center_y = max(0, min(int(cell_y1 + cell_height / 2), img_height - 1))
+            x_min = max(0, center_x - SAMPLE_SIZE)
+            x_max = min(img_width - 1, center_x + SAMPLE_SIZE)
+            y_min = max(0, center_y - SAMPLE_SIZE)
+            y_max = min(img_height - 1, center_y + SAMPLE_SIZE)
+            colors = [image.getpixel((x, y))
+                      for x in range(x_min, x_max + 1)
+                      for y in range(y_min, y_max + 1)]
+            result.append(tuple(int(sum(c[i] for c in colors) / len(colors)) for i in range(3)))
+    return np.array(result, dtype=np.uint8).reshape(rows, cols, 3)
+
+
+def vectorized_extract(array, start_x, start_y, end_x, end_y, rows, cols):
+    img_height, img_width = array.shape[:2]
+    center_x, center_y = cell_centers(start_x, start_y, end_x, end_y, rows, cols, img_width, img_height)
+    return sample_cell_means(array, center_x, center_y, SAMPLE_SIZE)
+
+
+def best_time(func, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    rng = np.random.default_rng(0)
+    image = Image.fromarray(rng.integers(0, 256, size=(3000, 4000, 3), dtype=np.uint8))
+
+    start = time.perf_counter()
+    array = image_to_array(image)
+    convert_time = time.perf_counter() - start
+    print(f"Array conversion (once per image): {convert_time * 1000:.1f} ms")
+
+    # The ROI touches the image edge so border clipping is exercised too
+    roi = (0, 5, 3999, 2990)
+    for rows, cols in [(8, 12), (16, 24), (32, 48), (48, 72)]:
+        legacy_time, expected = best_time(legacy_extract, image, *roi, rows, cols)
+        fast_time, actual = best_time(vectorized_extract, array, *roi, rows, cols)
+        if not np.array_equal(expected, actual):
+            raise SystemExit(f"Mismatch for {rows}x{cols} grid")
+        print(f"{rows * cols:5d} wells: getpixel {legacy_time * 1000:8.1f} ms, "
+              f"numpy {fast_time * 1000:6.2f} ms, speedup {legacy_time / fast_time:6.1f}x")
+
+    # Larger windows: direct gather grows with the window, the summed-area table does not
+    start = time.perf_counter()
+    table = build_integral_image(array)
+    print(f"\nSummed-area table (once per image): {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    center_x, center_y = cell_centers(*roi, 32, 48, 4000, 3000)
+    for half in [3, 10, 20, 40]:
+        gather_time, expected = best_time(sample_cell_means, array, center_x, center_y, half)
+        integral_time, actual = best_time(integral_cell_means, table, center_x, center_y, half, half)
+        if not np.array_equal(expected, actual):
+            raise SystemExit(f"Mismatch for {2 * half + 1}px window")
+        print(f"{2 * half + 1:3d}x{2 * half + 1:<3d} window, 1536 wells: gather {gather_time * 1000:8.2f} ms, "
+              f"integral {integral_time * 1000:5.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from analysis_service import AnalysisService, ServiceClient, make_server
+from plates import make_plate
+
+# Latency and throughput of the local analysis service, entirely on this
+# machine: starts the service in-process (or uses a running one with
+# --port/--socket), then times
+#   cold       one batch_analyze.py process per image, the cost the service avoids
+#   single     requests of one image each, one after another (latency)
+#   batched    requests of --batch images each (throughput)
+# The first requests of each kind are not timed. Every request names image
+# files it has not seen before, so the workers' result caches never answer
+# and each image is decoded and sampled.
+
+# Plate photos generated for the requests
+PLATE_COUNT = 16
+
+# Untimed requests before each timed series
+WARMUP_REQUESTS = 2
+
+
+def unique_copies(sources, count, workdir):
+    # count files with the plates' pixels but distinct contents: JPEG readers
+    # ignore bytes after the end-of-image marker
+    data = []
+    for path in sources:
+        with open(path, "rb") as f:
+            data.append(f.read())
+    paths = []
+    for i in range(count):
+        path = os.path.join(workdir, f"copy_{i:05d}.jpg")
+        with open(path, "wb") as f:
+            f.write(data[i % len(data)] + i.to_bytes(4, "little"))
+        paths.append(path)
+    return paths
+
+
+def percentile_ms(times, q):
+    return float(np.percentile(times, q)) * 1000
+
+
+def report(name, times, images_per_request):
+    total = sum(times)
+    print(f"{name:10s} {len(times):5d} requests  p50 {percentile_ms(times, 50):8.1f} ms  "
+          f"p95 {percentile_ms(times, 95):8.1f} ms  {len(times) * images_per_request / total:7.1f} images/s")
+
+
+def time_requests(client, batches, options):
+    for batch in batches[:WARMUP_REQUESTS]:
+        client.analyze(batch, **options)
+    times = []
+    for batch in batches[WARMUP_REQUESTS:]:
+        start = time.perf_counter()
+        records = client.analyze(batch, **options)
+        times.append(time.perf_counter() - start)
+        errors = [record["error"] for record in records if "error" in record]
+        if errors:
+            raise SystemExit(f"Service reported an error: {errors[0]}")
+    return times
+
+
+def time_cold(paths, roi, reference):
+    # A fresh interpreter per image, as a caller shelling out would pay
+    times = []
+    for path in paths:
+        start = time.perf_counter()
+        subprocess.run([sys.executable, os.path.join(ROOT, "batch_analyze.py"), path, "-j", "1",
+                        "--roi", ",".join(str(v) for v in roi), "-r", reference, "-o", os.devnull],
+                       check=True, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the analysis service against a local client.")
+    parser.add_argument("--port", type=int, help="Use the service already running on this port")
+    parser.add_argument("--socket", help="Use the service already listening on this Unix socket")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="Worker processes of the in-process service (default: CPU count)")
+    parser.add_argument("--wells", type=int, default=96, choices=(96, 384, 1536))
+    parser.add_argument("--size", default="2000x1500", help="Plate image size")
+    parser.add_argument("--requests", type=int, default=20, help="Timed requests per series")
+    parser.add_argument("--batch", type=int, default=8, help="Images per batched request")
+    parser.add_argument("--cold", type=int, default=3, help="Images analyzed by a fresh process each (0 to skip)")
+    args = parser.parse_args(argv)
+
+    if args.requests <= 0 or args.batch <= 0:
+        parser.error("requests and batch must be positive")
+    width, height = (int(v) for v in args.size.lower().split("x"))
+
+    with tempfile.TemporaryDirectory() as workdir:
+        paths = []
+        for i in range(PLATE_COUNT):
+            image, corners, colors = make_plate(args.wells, (width, height), seed=i)
+            path = os.path.join(workdir, f"plate_{i:02d}.jpg")
+            image.save(path, quality=92)
+            paths.append(path)
+        roi = [int(v) for v in (*corners[0], *corners[2])]
+        reference = "#{:02X}{:02X}{:02X}".format(*colors[0, 0])
+        rows, cols = colors.shape[:2]
+        options = {"reference": reference, "roi": roi, "rows": rows, "cols": cols, "metric": "ciede2000"}
+
+        server = service = None
+        if args.port or args.socket:
+            client = ServiceClient(port=args.port, socket_path=args.socket)
+        else:
+            service = AnalysisService(args.workers)
+            start = time.perf_counter()
+            service.warm_up()
+            server = make_server(service, port=0, quiet=True)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            print(f"Service with {service.workers} workers ready in {time.perf_counter() - start:.2f}s")
+            client = ServiceClient(port=server.server_address[1])
+
+        try:
+            if args.cold:
+                report("cold", time_cold(paths[:args.cold], roi, reference), 1)
+            count = WARMUP_REQUESTS + args.requests
+            copies = unique_copies(paths, count * (1 + args.batch), workdir)
+            single = [[path] for path in copies[:count]]
+            report("single", time_requests(client, single, options), 1)
+            batched = [copies[count + i * args.batch:count + (i + 1) * args.batch] for i in range(count)]
+            report("batched", time_requests(client, batched, options), args.batch)
+        finally:
+            client.close()
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+                service.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,59 @@
+import os
+import sys
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from grid_sampling import perspective_transform
+
+# Synthetic plate photos for the benchmarks: round wells of known random
+# colors on a dark plate, with optional sensor noise and perspective skew
+
+# Standard plate formats: wells -> (rows, cols)
+PLATE_FORMATS = {96: (8, 12), 384: (16, 24), 1536: (32, 48)}
+
+BACKGROUND = (235, 235, 235)
+PLATE_COLOR = (40, 40, 45)
+
+
+def make_plate(wells=96, size=(4000, 3000), noise=6.0, skew=0.0, seed=0):
+    # Returns (image, corners, colors): the plate photo, the grid's four outer
+    # corners in the image (clockwise from A1) and the (rows, cols, 3) well
+    # colors. skew moves each corner by up to that share of the image size.
+    rows, cols = PLATE_FORMATS[wells]
+    width, height = size
+    rng = np.random.default_rng(seed)
+    colors = rng.integers(0, 256, size=(rows, cols, 3), dtype=np.uint8)
+
+    # The grid fills the middle 80% of the frame, cells as square as it allows
+    cell = min(width * 0.8 / cols, height * 0.8 / rows)
+    x1, y1 = (width - cell * cols) / 2, (height - cell * rows) / 2
+    x2, y2 = x1 + cell * cols, y1 + cell * rows
+
+    image = Image.new("RGB", size, BACKGROUND)
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((x1, y1, x2, y2), fill=PLATE_COLOR)
+    margin = cell * 0.12
+    for row in range(rows):
+        for col in range(cols):
+            left, top = x1 + col * cell, y1 + row * cell
+            draw.ellipse((left + margin, top + margin, left + cell - margin, top + cell - margin),
+                         fill=tuple(int(c) for c in colors[row, col]))
+
+    corners = np.array([(x1, y1), (x2, y1), (x2, y2), (x1, y2)])
+    if skew:
+        # Move the corners and warp the flat plate onto them
+        shift = rng.uniform(-skew, skew, size=(4, 2)) * (width, height)
+        skewed = corners + shift
+        matrix = perspective_transform(skewed, corners)  # Output pixel -> flat plate pixel
+        image = image.transform(size, Image.PERSPECTIVE, tuple(matrix.ravel()[:8]), Image.BILINEAR,
+                                fillcolor=BACKGROUND)
+        corners = skewed
+
+    if noise:
+        pixels = np.asarray(image, dtype=np.float32)
+        pixels += rng.normal(0, noise, size=pixels.shape).astype(np.float32)
+        image = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+    return image, corners, colors
@@ -0,0 +1,129 @@
+import math
+
+import numpy as np
+
+# Color difference metrics, evaluated over whole (N, 3) arrays of colors
+
+METRICS = ("rgb", "cie76", "cie94", "ciede2000")
+
+MAX_RGB_DISTANCE = math.sqrt(3 * 255 * 255)  # Maximum possible distance
+
+# A Delta-E of 100 (black vs. white in CIE76) or more counts as a 0% match
+MAX_DELTA_E = 100.0
+
+# sRGB gamma expansion for every 8-bit value, so conversion is a table lookup
+_levels = np.arange(256) / 255.0
+SRGB_TO_LINEAR = np.where(_levels <= 0.04045, _levels / 12.92, ((_levels + 0.055) / 1.055) ** 2.4)
+
+# Linear sRGB to XYZ, pre-divided by the D65 white point
+_RGB_TO_XYZ = np.array([
+    [0.4124564, 0.3575761, 0.1804375],
+    [0.2126729, 0.7151522, 0.0721750],
+    [0.0193339, 0.1191920, 0.9503041],
+]) / np.array([[0.95047], [1.0], [1.08883]])
+
+
+def rgb_to_lab(colors):
+    # 8-bit sRGB (..., 3) to CIELAB (D65) as float64
+    linear = SRGB_TO_LINEAR[np.asarray(colors, dtype=np.uint8)]
+    xyz = linear @ _RGB_TO_XYZ.T
+
+    epsilon = (6 / 29) ** 3
+    f = np.where(xyz > epsilon, np.cbrt(xyz), xyz / (3 * (6 / 29) ** 2) + 4 / 29)
+    lab = np.empty_like(f)
+    lab[..., 0] = 116 * f[..., 1] - 16
+    lab[..., 1] = 500 * (f[..., 0] - f[..., 1])
+    lab[..., 2] = 200 * (f[..., 1] - f[..., 2])
+    return lab
+
+
+def delta_e_76(lab, reference_lab):
+    diff = lab - reference_lab
+    return np.sqrt((diff * diff).sum(axis=-1))
+
+
+def delta_e_94(lab, reference_lab):
+    # Graphic arts weights; chroma weighting follows the reference color
+    L1, a1, b1 = np.moveaxis(np.broadcast_to(reference_lab, lab.shape), -1, 0)
+    L2, a2, b2 = np.moveaxis(lab, -1, 0)
+    C1 = np.hypot(a1, b1)
+    C2 = np.hypot(a2, b2)
+    dL = L1 - L2
+    dC = C1 - C2
+    dH_sq = np.maximum((a1 - a2) ** 2 + (b1 - b2) ** 2 - dC ** 2, 0)
+    SC = 1 + 0.045 * C1
+    SH = 1 + 0.015 * C1
+    return np.sqrt(dL ** 2 + (dC / SC) ** 2 + dH_sq / SH ** 2)
+
+
+def delta_e_2000(lab, reference_lab):
+    L1, a1, b1 = np.moveaxis(np.broadcast_to(reference_lab, lab.shape), -1, 0)
+    L2, a2, b2 = np.moveaxis(lab, -1, 0)
+
+    C_mean = (np.hypot(a1, b1) + np.hypot(a2, b2)) / 2
+    G = 0.5 * (1 - np.sqrt(C_mean ** 7 / (C_mean ** 7 + 25.0 ** 7)))
+    a1p = (1 + G) * a1
+    a2p = (1 + G) * a2
+    C1p = np.hypot(a1p, b1)
+    C2p = np.hypot(a2p, b2)
+    h1p = np.degrees(np.arctan2(b1, a1p)) % 360
+    h2p = np.degrees(np.arctan2(b2, a2p)) % 360
+
+    dLp = L2 - L1
+    dCp = C2p - C1p
+    chroma_zero = (C1p * C2p) == 0
+    dhp = h2p - h1p
+    dhp = np.where(dhp > 180, dhp - 360, np.where(dhp < -180, dhp + 360, dhp))
+    dhp = np.where(chroma_zero, 0, dhp)
+    dHp = 2 * np.sqrt(C1p * C2p) * np.sin(np.radians(dhp / 2))
+
+    Lp_mean = (L1 + L2) / 2
+    Cp_mean = (C1p + C2p) / 2
+    hp_sum = h1p + h2p
+    hp_mean = np.where(np.abs(h1p - h2p) > 180,
+                       np.where(hp_sum < 360, hp_sum + 360, hp_sum - 360), hp_sum) / 2
+    hp_mean = np.where(chroma_zero, hp_sum, hp_mean)
+
+    T = (1 - 0.17 * np.cos(np.radians(hp_mean - 30))
+         + 0.24 * np.cos(np.radians(2 * hp_mean))
+         + 0.32 * np.cos(np.radians(3 * hp_mean + 6))
+         - 0.20 * np.cos(np.radians(4 * hp_mean - 63)))
+    d_theta = 30 * np.exp(-(((hp_mean - 275) / 25) ** 2))
+    RC = 2 * np.sqrt(Cp_mean ** 7 / (Cp_mean ** 7 + 25.0 ** 7))
+    SL = 1 + 0.015 * (Lp_mean - 50) ** 2 / np.sqrt(20 + (Lp_mean - 50) ** 2)
+    SC = 1 + 0.045 * Cp_mean
+    SH = 1 + 0.015 * Cp_mean * T
+    RT = -np.sin(np.radians(2 * d_theta)) * RC
+
+    return np.sqrt((dLp / SL) ** 2 + (dCp / SC) ** 2 + (dHp / SH) ** 2
+                   + RT * (dCp / SC) * (dHp / SH))
+
+
+_DELTA_E = {"cie76": delta_e_76, "cie94": delta_e_94, "ciede2000": delta_e_2000}
+
+
+def similarity_matrix(colors, references, metric="rgb", lab=None):
+    # Percent similarity of every color to every reference: (R, N).
+    # The colors are converted to Lab once and reused for all references;
+    # callers scoring the same colors repeatedly can pass that Lab in.
+    colors = np.asarray(colors).reshape(-1, 3)
+    references = np.asarray(references).reshape(-1, 3)
+
+    if metric == "rgb":
+        diff = colors[None, :, :].astype(np.float64) - references[:, None, :].astype(np.float64)
+        rgb_distance = np.sqrt((diff * diff).sum(axis=-1))
+        return 100 * (1 - (rgb_distance / MAX_RGB_DISTANCE))
+
+    if metric not in _DELTA_E:
+        raise ValueError(f"Unknown color metric: {metric}")
+    if lab is None:
+        lab = rgb_to_lab(colors)
+    reference_lab = rgb_to_lab(references)
+    delta_e = np.stack([_DELTA_E[metric](lab, ref) for ref in reference_lab])
+    return np.clip(100 * (1 - delta_e / MAX_DELTA_E), 0, 100)
+
+
+def color_similarity(colors, reference, metric="rgb"):
+    # Percent similarity of (N, 3) colors (or a single color) to one reference
+    colors = np.asarray(colors)
+    return similarity_matrix(colors, reference, metric)[0].reshape(colors.shape[:-1])
@@ -0,0 +1,36 @@
+from PIL import Image
+
+# Multi-resolution copies of the loaded image for display. Each level halves
+# the previous one, so any display size is served by resampling a level at
+# most twice as large instead of the full-resolution image.
+
+
+class DisplayPyramid:
+    def __init__(self, image, min_size=256, resample=Image.BILINEAR):
+        self.resample = resample
+        self.levels = [image]
+        while min(self.levels[-1].size) >= 2 * min_size:
+            self.levels.append(self.levels[-1].reduce(2))
+        self._last = None  # (size, image) of the last request
+
+    @property
+    def size(self):
+        return self.levels[0].size
+
+    def level_for(self, size):
+        # Smallest level that is still at least as large as the requested size
+        width, height = size
+        for level in reversed(self.levels):
+            if level.width >= width and level.height >= height:
+                return level
+        return self.levels[0]
+
+    def get(self, size):
+        size = (max(1, int(size[0])), max(1, int(size[1])))
+        if self._last is not None and self._last[0] == size:
+            return self._last[1]
+
+        level = self.level_for(size)
+        image = level if level.size == size else level.resize(size, self.resample)
+        self._last = (size, image)
+        return image
@@ -0,0 +1,311 @@
+import os
+import queue
+import sys
+import threading
+import time
+
+import numpy as np
+from PIL import Image, ImageSequence
+
+from batch_analyze import IMAGE_EXTENSIONS
+from color_metrics import rgb_to_lab, similarity_matrix
+from grid_analysis import GridResult, clamp_roi, corners_roi, parse_corners
+from grid_sampling import (ImageSampler, cell_centers, grid_transform, image_to_array, quad_cell_size,
+                           quad_sample_points, bilinear_gather, sample_cell_means, window_half_sizes,
+                           SAMPLE_SIZE)
+from profiling import count, span
+
+try:
+    import cv2
+except ImportError:  # Only needed for video files; animated GIFs and TIFFs work without it
+    cv2 = None
+
+# Frames from a fixed camera, analyzed one after another with the same grid.
+# Frame sources are generators: folder_frames watches a directory for new
+# images, video_frames reads a video file. CellTracker keeps every cell's
+# color and score between frames; for each new frame it first reads a few
+# probe pixels per cell, and only the cells whose probe moved more than
+# the change threshold are sampled and scored again. A still plate therefore
+# costs a probe read per frame, whatever the window size or metric.
+
+# A cell is re-sampled when its probe mean moves this far on any channel
+# (0-255) from where it was when the cell was last sampled
+CHANGE_THRESHOLD = 6.0
+
+# Probe pixels per cell axis, spread over the sampling window
+PROBE_POINTS = 4
+
+# How often a watched folder is checked for new images
+WATCH_POLL_SECONDS = 0.5
+
+# Frames decoded ahead of the analysis
+PREFETCH_FRAMES = 2
+
+
+class Frame:
+    __slots__ = ("index", "time", "source", "image")
+
+    def __init__(self, index, time, source, image):
+        self.index = index
+        self.time = time  # Seconds: file modification time, or position in the video
+        self.source = source  # File path, or "video.mp4#frame"
+        self.image = image  # PIL image or (H, W, 3) array
+
+    def __repr__(self):
+        return f"Frame({self.index}, {self.source})"
+
+
+def read_image(path):
+    with Image.open(path) as image:
+        image = image.convert("RGB")
+        image.load()
+    return image
+
+
+def folder_frames(directory, poll_interval=WATCH_POLL_SECONDS, idle_timeout=None, existing=True, stop=None):
+    # New images in directory, oldest first, as they appear. A file is only
+    # read once its size stayed the same for one poll, so images still being
+    # written are not picked up half-done. Ends after idle_timeout seconds
+    # without a new image (never, by default) or once stop (a
+    # threading.Event) is set. existing=False skips the images already there.
+    seen = set()
+    if not existing:
+        seen.update(entry.path for entry in os.scandir(directory))
+    sizes = {}  # Path -> size at the last poll, for files not yet read
+    index = 0
+    last_frame = time.monotonic()
+    while stop is None or not stop.is_set():
+        ready = []
+        for entry in os.scandir(directory):
+            if entry.path in seen or not entry.name.lower().endswith(IMAGE_EXTENSIONS) or not entry.is_file():
+                continue
+            stat = entry.stat()
+            if sizes.get(entry.path) == stat.st_size:
+                ready.append((stat.st_mtime, entry.name, entry.path))
+            else:
+                sizes[entry.path] = stat.st_size
+
+        for mtime, _, path in sorted(ready):
+            seen.add(path)
+            del sizes[path]
+            try:
+                image = read_image(path)
+            except OSError as e:
+                print(f"Skipping {path}: {e}", file=sys.stderr)
+                continue
+            yield Frame(index, mtime, path, image)
+            index += 1
+
+        if ready:
+            last_frame = time.monotonic()
+        elif idle_timeout is not None and time.monotonic() - last_frame > idle_timeout:
+            return
+        else:
+            time.sleep(poll_interval)
+
+
+def video_frames(path, every=1):
+    # Every every-th frame of a video file. Frames that are skipped are not
+    # decoded. Needs OpenCV, except for animated GIFs and multi-page TIFFs.
+    if cv2 is None:
+        try:
+            image = Image.open(path)
+        except OSError:
+            image = None
+        if image is None or getattr(image, "n_frames", 1) <= 1:
+            if image is not None:
+                image.close()
+            raise ValueError("Reading video files needs the opencv-python package")
+        with image:
+            elapsed = 0.0
+            for index, page in enumerate(ImageSequence.Iterator(image)):
+                if index % every == 0:
+                    yield Frame(index, elapsed, f"{path}#{index}", page.convert("RGB"))
+                elapsed += page.info.get("duration", 0) / 1000
+        return
+
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError(f"Cannot open video {path}")
+    try:
+        index = 0
+        while capture.grab():
+            if index % every == 0:
+                ok, frame = capture.retrieve()
+                if not ok:
+                    break
+                # OpenCV decodes to BGR; the reversed view is RGB without a copy
+                yield Frame(index, capture.get(cv2.CAP_PROP_POS_MSEC) / 1000, f"{path}#{index}",
+                            frame[:, :, ::-1])
+            index += 1
+    finally:
+        capture.release()
+
+
+def prefetch(frames, depth=PREFETCH_FRAMES):
+    # Decode up to depth frames on a background thread while the current one
+    # is analyzed. Errors of the source are raised here.
+    pending = queue.Queue(maxsize=depth)
+    done = object()
+
+    def produce():
+        try:
+            for frame in frames:
+                pending.put(frame)
+            pending.put(done)
+        except Exception as e:
+            pending.put(e)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        frame = pending.get()
+        if frame is done:
+            return
+        if isinstance(frame, Exception):
+            raise frame
+        yield frame
+
+
+def window_means(array, x0, x1, y0, y1):
+    # Mean color of each cell's window, one slice per cell, truncated like
+    # sample_cell_means
+    colors = np.empty((len(x0), 3), dtype=np.uint8)
+    for i, (left, right, top, bottom) in enumerate(zip(x0.tolist(), x1.tolist(), y0.tolist(), y1.tolist())):
+        window = array[top:bottom, left:right]
+        colors[i] = window.sum(axis=(0, 1), dtype=np.int64) // (window.shape[0] * window.shape[1])
+    return colors
+
+
+class CellTracker:
+    # Per-cell colors and scores of a fixed grid, kept up to date frame by
+    # frame. The grid is given like analyze_grid's (roi or corners, rows,
+    # cols and sampling window) and laid out when the first frame arrives.
+
+    def __init__(self, roi, rows, cols, reference_colors=None, sample_size=SAMPLE_SIZE, sample_fraction=None,
+                 metric="rgb", palette=None, top_k=3, corners=None, threshold=CHANGE_THRESHOLD):
+        self.roi = roi
+        self.rows = rows
+        self.cols = cols
+        self.references = None
+        if reference_colors is not None:
+            self.references = np.atleast_2d(np.asarray(reference_colors, dtype=np.uint8))
+        self.sample_size = sample_size
+        self.sample_fraction = sample_fraction
+        self.metric = metric
+        self.palette = palette
+        self.top_k = top_k
+        self.corners = None if corners is None else parse_corners(corners)
+        self.threshold = threshold
+        self.size = None  # Frame size the grid is laid out for
+        self.frames = 0
+
+    def _layout(self, size):
+        # Everything about the grid that does not depend on the pixels
+        img_width, img_height = size
+        cells = self.rows * self.cols
+        if self.corners is not None:
+            self.grid_roi = corners_roi(self.corners, img_width, img_height)
+            matrix = grid_transform(self.corners, self.rows, self.cols)
+            cell_size = quad_cell_size(self.corners, self.rows, self.cols)
+            half_x, half_y = window_half_sizes(*cell_size, self.sample_size, self.sample_fraction)
+            x, y = quad_sample_points(matrix, np.arange(self.rows), np.arange(self.cols), cell_size,
+                                      half_x, half_y)
+            self.points = x.reshape(cells, -1), y.reshape(cells, -1)
+            step = max(1, self.points[0].shape[1] // (PROBE_POINTS * PROBE_POINTS))
+            probe_x = np.rint(self.points[0][:, ::step]).astype(np.int64)
+            probe_y = np.rint(self.points[1][:, ::step]).astype(np.int64)
+        else:
+            roi = self.roi if self.roi is not None else (0, 0, img_width - 1, img_height - 1)
+            self.grid_roi = start_x, start_y, end_x, end_y = clamp_roi(roi, img_width, img_height)
+            center_x, center_y = cell_centers(start_x, start_y, end_x, end_y, self.rows, self.cols,
+                                              img_width, img_height)
+            self.half = window_half_sizes((end_x - start_x) / self.cols, (end_y - start_y) / self.rows,
+                                          self.sample_size, self.sample_fraction)
+            self.centers = center_x, center_y
+            half_x, half_y = self.half
+            x0 = np.tile(np.clip(center_x - half_x, 0, img_width), self.rows)
+            x1 = np.tile(np.clip(center_x + half_x + 1, 0, img_width), self.rows)
+            y0 = np.repeat(np.clip(center_y - half_y, 0, img_height), self.cols)
+            y1 = np.repeat(np.clip(center_y + half_y + 1, 0, img_height), self.cols)
+            self.windows = x0, x1, y0, y1
+            spread = (np.arange(PROBE_POINTS) + 0.5) / PROBE_POINTS
+            probe_x = (x0[:, None] + spread * (x1 - x0)[:, None]).astype(np.int64)
+            probe_y = (y0[:, None] + spread * (y1 - y0)[:, None]).astype(np.int64)
+            probe_x, probe_y = (np.repeat(probe_x, PROBE_POINTS, axis=1),
+                                np.tile(probe_y, PROBE_POINTS))
+        self.probe_x = np.clip(probe_x, 0, img_width - 1)
+        self.probe_y = np.clip(probe_y, 0, img_height - 1)
+
+        self.size = size
+        self.probes = None  # Probe means when each cell was last sampled
+        self.colors = np.zeros((cells, 3), dtype=np.uint8)
+        self.similarity = None
+        if self.references is not None:
+            self.similarity = np.zeros((len(self.references), cells))
+        self.matches = self.match_distances = None
+
+    def _sample(self, array, cells):
+        # Colors of the given cells, as analyze_grid would sample them
+        if self.corners is not None:
+            x, y = self.points
+            return bilinear_gather(array, x[cells], y[cells]).mean(axis=1).astype(np.uint8)
+        if len(cells) == len(self.colors) and (2 * self.half[0] + 1) * (2 * self.half[1] + 1) <= ImageSampler.GATHER_MAX_AREA:
+            return sample_cell_means(array, *self.centers, *self.half).reshape(-1, 3)
+        x0, x1, y0, y1 = self.windows
+        return window_means(array, x0[cells], x1[cells], y0[cells], y1[cells])
+
+    def update(self, image):
+        # Bring every cell up to date with a new frame. Returns the frame's
+        # GridResult and the indices of the cells that were re-sampled.
+        array = image_to_array(image)
+        size = (array.shape[1], array.shape[0])
+        if size != self.size:
+            self._layout(size)
+
+        with span("stream.probe"):
+            probes = array[self.probe_y, self.probe_x].mean(axis=1, dtype=np.float32)
+        if self.probes is None:
+            changed = np.arange(len(self.colors))
+            self.probes = probes
+        else:
+            changed = np.flatnonzero(np.abs(probes - self.probes).max(axis=1) > self.threshold)
+            self.probes[changed] = probes[changed]
+        count("stream.cells_resampled", len(changed))
+
+        if len(changed):
+            with span("stream.sample", cells=len(changed)):
+                colors = self._sample(array, changed)
+            self.colors[changed] = colors
+            with span("stream.score", cells=len(changed)):
+                if self.references is not None:
+                    lab = rgb_to_lab(colors) if self.metric != "rgb" else None
+                    self.similarity[:, changed] = similarity_matrix(colors, self.references, self.metric, lab)
+                if self.palette is not None:
+                    matches, distances = self.palette.query(colors, self.top_k)
+                    if self.matches is None:
+                        self.matches = np.zeros((len(self.colors), matches.shape[1]), dtype=matches.dtype)
+                        self.match_distances = np.zeros((len(self.colors), matches.shape[1]))
+                    self.matches[changed] = matches
+                    self.match_distances[changed] = distances
+        self.frames += 1
+        return self.result(), changed
+
+    def result(self):
+        # Snapshot of the current cell values; later frames do not change it
+        result = GridResult(self.grid_roi, self.rows, self.cols, self.colors.copy(), metric=self.metric,
+                            corners=self.corners)
+        if self.references is not None:
+            result.references = self.references
+            result.similarity = self.similarity.copy()
+        if self.matches is not None:
+            result.matches = self.matches.copy()
+            result.match_distances = self.match_distances.copy()
+        return result
+
+
+def track(frames, tracker):
+    # (frame, result, changed cell indices) for every frame, in order
+    for frame in frames:
+        with span("stream.frame"):
+            result, changed = tracker.update(frame.image)
+        yield frame, result, changed
@@ -0,0 +1,358 @@
+import numpy as np
+
+from color_metrics import rgb_to_lab, similarity_matrix
+from grid_sampling import (ImageSampler, RasterSampler, apply_transform, cell_centers, grid_transform,
+                           quad_cell_means, quad_cell_size, window_bounds, window_half_sizes, QUAD_SAMPLES_MAX,
+                           SAMPLE_SIZE)
+from profiling import count, span
+
+# Headless analysis core: no tkinter here so it can run in workers and servers
+
+
+def row_label(row):
+    # A..Z, then AA, AB, ... for plates with more than 26 rows
+    label = ""
+    row += 1
+    while row > 0:
+        row, rem = divmod(row - 1, 26)
+        label = chr(65 + rem) + label
+    return label
+
+
+def cell_position(row, col):
+    return f"{row_label(row)}{col + 1}"  # A1, B2, etc.
+
+
+def parse_position(position):
+    # "B3" -> (1, 2), the inverse of cell_position
+    text = position.strip().upper()
+    letters = text.rstrip("0123456789")
+    digits = text[len(letters):]
+    if not letters or not letters.isalpha() or not letters.isascii() or not digits or int(digits) < 1:
+        raise ValueError(f"Invalid cell position: {position}")
+    row = 0
+    for char in letters:
+        row = row * 26 + ord(char) - 64
+    return row - 1, int(digits) - 1
+
+
+def clamp_roi(roi, img_width, img_height):
+    # Order the corners and keep them inside the image
+    x1, y1, x2, y2 = (int(v) for v in roi)
+    x1, x2 = sorted((x1, x2))
+    y1, y2 = sorted((y1, y2))
+    x1 = max(0, min(x1, img_width - 1))
+    y1 = max(0, min(y1, img_height - 1))
+    x2 = max(0, min(x2, img_width - 1))
+    y2 = max(0, min(y2, img_height - 1))
+    return x1, y1, x2, y2
+
+
+def parse_corners(corners):
+    # Four (x, y) image points as a (4, 2) float array
+    corners = np.asarray(corners, dtype=np.float64)
+    if corners.size != 8:
+        raise ValueError("A four-corner grid needs exactly four (x, y) points")
+    return corners.reshape(4, 2)
+
+
+def corners_roi(corners, img_width, img_height):
+    # Bounding box of a four-corner grid, clamped to the image
+    (x1, y1), (x2, y2) = np.floor(corners.min(axis=0)), np.ceil(corners.max(axis=0))
+    return clamp_roi((x1, y1, x2, y2), img_width, img_height)
+
+
+# Grid rows sampled per step when progress is reported
+PROGRESS_ROWS = 8
+
+
+def extract_quad_colors(sampler, corners, rows, cols, sample_size=SAMPLE_SIZE, sample_fraction=None,
+                        progress=None):
+    # Cell colors of a grid given by its four outer corners; cell centers and
+    # windows are mapped through the grid's homography
+    matrix = grid_transform(corners, rows, cols)
+    cell_size = quad_cell_size(corners, rows, cols)
+    half_x, half_y = window_half_sizes(*cell_size, sample_size, sample_fraction)
+    count("pixels.sampled", rows * cols * min(2 * half_x + 1, QUAD_SAMPLES_MAX) * min(2 * half_y + 1, QUAD_SAMPLES_MAX))
+    col_ids = np.arange(cols)
+    if progress is None:
+        return quad_cell_means(sampler, matrix, np.arange(rows), col_ids, cell_size, half_x, half_y)
+
+    colors = np.empty((rows, cols, 3), dtype=np.uint8)
+    for row in range(0, rows, PROGRESS_ROWS):
+        progress("Sampling", row / rows)
+        row_ids = np.arange(row, min(row + PROGRESS_ROWS, rows))
+        colors[row_ids] = quad_cell_means(sampler, matrix, row_ids, col_ids, cell_size, half_x, half_y)
+    return colors
+
+
+def extract_cell_colors(sampler, roi, rows, cols, sample_size=SAMPLE_SIZE, sample_fraction=None,
+                        progress=None):
+    img_width, img_height = sampler.size
+    start_x, start_y, end_x, end_y = roi
+    center_x, center_y = cell_centers(start_x, start_y, end_x, end_y, rows, cols, img_width, img_height)
+    half_x, half_y = window_half_sizes((end_x - start_x) / cols, (end_y - start_y) / rows,
+                                       sample_size, sample_fraction)
+    count("pixels.sampled", rows * cols * (2 * half_x + 1) * (2 * half_y + 1))
+    if progress is None:
+        return sampler.sample(center_x, center_y, half_x, half_y)
+
+    # Sample in bands of rows so progress can be reported (and the work
+    # cancelled); a summed-area table is built once for the whole grid
+    bounds = window_bounds(center_x, center_y, half_x, half_y, sampler.size)
+    colors = np.empty((rows, cols, 3), dtype=np.uint8)
+    for row in range(0, rows, PROGRESS_ROWS):
+        progress("Sampling", row / rows)
+        band = slice(row, row + PROGRESS_ROWS)
+        colors[band] = sampler.sample(center_x, center_y[band], half_x, half_y, bounds=bounds)
+    return colors
+
+
+class Cell:
+    # View of one cell of a GridResult. Nothing is copied: the values are
+    # read from the result's arrays when asked for.
+    __slots__ = ("result", "index")
+
+    def __init__(self, result, index):
+        self.result = result
+        self.index = index
+
+    @property
+    def row(self):
+        return self.index // self.result.cols
+
+    @property
+    def col(self):
+        return self.index % self.result.cols
+
+    @property
+    def position(self):
+        return self.result.position(self.index)
+
+    @property
+    def color(self):
+        return tuple(int(c) for c in self.result.colors[self.index])
+
+    @property
+    def similarity(self):
+        # One score per reference color, or None before scoring
+        if self.result.similarity is None:
+            return None
+        return tuple(float(s) for s in self.result.similarity[:, self.index])
+
+    def __repr__(self):
+        return f"Cell({self.position}, color={self.color})"
+
+
+def rank_scores(similarity, top=None, min_similarity=None):
+    # Indices of similarity sorted highest first, ties in index order. With
+    # top, argpartition narrows the candidates before anything is sorted.
+    if min_similarity is None:
+        candidates = np.arange(len(similarity))
+    else:
+        candidates = np.flatnonzero(similarity >= min_similarity)
+
+    if top is not None and 0 < top < len(candidates):
+        values = -similarity[candidates]
+        cutoff = values[np.argpartition(values, top - 1)[top - 1]]
+        candidates = candidates[values <= cutoff]  # Keeps ties at the cutoff
+
+    order = candidates[np.argsort(-similarity[candidates], kind="stable")]
+    return order if top is None else order[:top]
+
+
+# Arrays written by GridResult.to_arrays, besides roi, rows, cols and colors
+OPTIONAL_ARRAYS = ("references", "similarity", "matches", "match_distances", "corners")
+
+
+class GridResult:
+    # Column-oriented: every per-cell value is one array indexed by the
+    # row-major cell index, so a result costs a few arrays however many cells
+    # it has. Positions map to indices arithmetically (index_of, cell).
+    __slots__ = ("roi", "rows", "cols", "colors", "references", "similarity", "metric",
+                 "matches", "match_distances", "corners", "_lab")
+
+    def __init__(self, roi, rows, cols, colors, references=None, similarity=None, metric="rgb",
+                 corners=None):
+        self.roi = roi  # Bounding box of the grid for four-corner grids
+        self.rows = rows
+        self.cols = cols
+        self.colors = colors  # (rows * cols, 3) uint8, row-major
+        self.references = references  # (R, 3) uint8
+        self.similarity = similarity  # (R, rows * cols) float64, percent
+        self.metric = metric  # One of color_metrics.METRICS
+        self.matches = None  # (rows * cols, k) palette ids, nearest first
+        self.match_distances = None  # (rows * cols, k) CIE76 Delta-E
+        self.corners = corners  # (4, 2) outer corners clockwise from A1, or None for an upright grid
+        self._lab = None
+
+    def __len__(self):
+        return self.rows * self.cols
+
+    def position(self, index):
+        return cell_position(*divmod(int(index), self.cols))
+
+    def positions(self):
+        labels = [row_label(row) for row in range(self.rows)]
+        return [f"{label}{col + 1}" for label in labels for col in range(self.cols)]
+
+    def index_of(self, position):
+        # Row-major index of a cell given as "B3" or (row, col)
+        row, col = parse_position(position) if isinstance(position, str) else position
+        if not (0 <= row < self.rows and 0 <= col < self.cols):
+            raise KeyError(f"No cell {position} in a {self.rows} x {self.cols} grid")
+        return row * self.cols + col
+
+    def cell(self, key):
+        # Cell view by index, "B3" or (row, col)
+        if isinstance(key, (str, tuple)):
+            return Cell(self, self.index_of(key))
+        index = int(key)
+        if not 0 <= index < len(self):
+            raise IndexError(f"Cell index {index} out of range")
+        return Cell(self, index)
+
+    def to_arrays(self):
+        # Everything as NumPy arrays, e.g. for np.savez or ResultCache.put;
+        # from_arrays restores the result
+        arrays = {"roi": np.asarray(self.roi), "rows": np.asarray(self.rows),
+                  "cols": np.asarray(self.cols), "colors": self.colors, "metric": np.asarray(self.metric)}
+        for name in OPTIONAL_ARRAYS:
+            value = getattr(self, name)
+            if value is not None:
+                arrays[name] = np.asarray(value)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        result = cls(tuple(int(v) for v in arrays["roi"]), int(arrays["rows"]), int(arrays["cols"]),
+                     np.asarray(arrays["colors"]), metric=str(arrays.get("metric", "rgb")))
+        for name in OPTIONAL_ARRAYS:
+            if name in arrays:
+                setattr(result, name, np.asarray(arrays[name]))
+        return result
+
+    def cell_boxes(self):
+        # (N, 4) array of x1, y1, x2, y2 cell bounds in image coordinates
+        # (the bounding boxes of the cells of a four-corner grid)
+        if self.corners is not None:
+            matrix = grid_transform(self.corners, self.rows, self.cols)
+            v, u = np.mgrid[:self.rows + 1, :self.cols + 1]
+            x, y = apply_transform(matrix, u.astype(np.float64), v.astype(np.float64))
+            cell_corners = lambda a: np.stack([a[:-1, :-1], a[:-1, 1:], a[1:, 1:], a[1:, :-1]]).reshape(4, -1)
+            xs, ys = cell_corners(x), cell_corners(y)
+            return np.stack([xs.min(axis=0), ys.min(axis=0), xs.max(axis=0), ys.max(axis=0)], axis=1)
+        start_x, start_y, end_x, end_y = self.roi
+        cell_width = (end_x - start_x) / self.cols
+        cell_height = (end_y - start_y) / self.rows
+        x1 = np.tile(start_x + np.arange(self.cols) * cell_width, self.rows)
+        y1 = np.repeat(start_y + np.arange(self.rows) * cell_height, self.cols)
+        return np.stack([x1, y1, x1 + cell_width, y1 + cell_height], axis=1)
+
+    @property
+    def lab(self):
+        # CIELAB of the cell colors, converted once for repeated re-scoring
+        if self._lab is None:
+            self._lab = rgb_to_lab(self.colors)
+        return self._lab
+
+    def score(self, reference_colors, metric=None):
+        if metric is not None:
+            self.metric = metric
+        self.references = np.atleast_2d(np.asarray(reference_colors, dtype=np.uint8))
+        lab = self.lab if self.metric != "rgb" else None
+        self.similarity = similarity_matrix(self.colors, self.references, self.metric, lab)
+        return self.similarity
+
+    def match_palette(self, palette_index, k=3):
+        self.matches, self.match_distances = palette_index.query(self.colors, k)
+        return self.matches, self.match_distances
+
+    def ranking(self, reference_index=0, top=None, min_similarity=None):
+        # Cell indices sorted by similarity, highest first (ties keep grid order),
+        # optionally only those at or above min_similarity and only the best top
+        return rank_scores(self.similarity[reference_index], top, min_similarity)
+
+    def match_ranking(self):
+        # Cell indices sorted by distance to their best palette match
+        return np.argsort(self.match_distances[:, 0], kind="stable")
+
+
+def analyze_grid(image, roi, rows, cols, reference_colors=None, sample_size=SAMPLE_SIZE,
+                 sample_fraction=None, metric="rgb", palette=None, top_k=3, progress=None,
+                 cache=None, image_digest=None, corners=None):
+    # image may be a PIL image, an (H, W, 3) array, an ImageSampler (reused
+    # across calls so its summed-area table is built once) or a RasterSampler
+    # for images too large to load; roi is in image coordinates, or None for
+    # the whole image. sample_fraction, when given, averages that share of each
+    # cell instead of the fixed (2 * sample_size + 1)^2 window. palette is an
+    # optional PaletteIndex; each cell then gets its top_k nearest entries.
+    # progress, if given, is called as progress(stage, fraction) between steps.
+    #
+    # corners, if given, defines a skewed or rotated grid by its four outer
+    # corners in image coordinates, clockwise from A1's; roi is then ignored
+    # and becomes the corners' bounding box.
+    #
+    # With a result_cache.ResultCache and the image's content digest, cell
+    # colors and scores are cached separately, so a new reference reuses the
+    # sampled colors. image may then also be a function returning the image,
+    # which is only called when the colors are not cached.
+    colors_key = None
+    entry = None
+    if corners is not None:
+        corners = parse_corners(corners)
+    if cache is not None and image_digest is not None:
+        grid = roi and tuple(int(v) for v in roi)
+        if corners is not None:
+            grid = ("corners",) + tuple(corners.ravel().tolist())
+        colors_key = ("colors", image_digest, grid, rows, cols, sample_size, sample_fraction)
+        entry = cache.get(colors_key)
+
+    if entry is not None:
+        count("cache.colors_hits")
+        roi = tuple(int(v) for v in entry["roi"])
+        colors = entry["colors"]
+    else:
+        if callable(image):
+            with span("analyze.load"):
+                image = image()
+        with span("analyze.sample", cells=rows * cols):
+            sampler = image if isinstance(image, (ImageSampler, RasterSampler)) else ImageSampler(image)
+            if corners is not None:
+                roi = corners_roi(corners, *sampler.size)
+                colors = extract_quad_colors(sampler, corners, rows, cols, sample_size, sample_fraction,
+                                             progress).reshape(-1, 3)
+            else:
+                if roi is None:
+                    roi = (0, 0, sampler.size[0] - 1, sampler.size[1] - 1)
+                roi = clamp_roi(roi, *sampler.size)
+                colors = extract_cell_colors(sampler, roi, rows, cols, sample_size, sample_fraction,
+                                             progress).reshape(-1, 3)
+        if colors_key is not None:
+            cache.put(colors_key, roi=np.array(roi), colors=colors)
+
+    result = GridResult(roi, rows, cols, colors, metric=metric, corners=corners)
+    if reference_colors is not None:
+        if progress is not None:
+            progress("Scoring", 0.0)
+        references = np.atleast_2d(np.asarray(reference_colors, dtype=np.uint8))
+        scores_key = None
+        entry = None
+        if colors_key is not None:
+            scores_key = ("scores",) + colors_key[1:] + (metric, references.tobytes())
+            entry = cache.get(scores_key)
+        if entry is not None:
+            count("cache.scores_hits")
+            result.references = references
+            result.similarity = entry["similarity"]
+        else:
+            with span("analyze.score", metric=metric):
+                result.score(references)
+            if scores_key is not None:
+                cache.put(scores_key, similarity=result.similarity)
+    if palette is not None:
+        if progress is not None:
+            progress("Palette matching", 0.0)
+        with span("analyze.palette"):
+            result.match_palette(palette, top_k)
+    return result
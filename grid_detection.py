@@ -0,0 +1,193 @@
+import numpy as np
+
+from grid_sampling import ImageSampler, RasterSampler, image_to_array
+
+# Finds a color grid's bounding box, pitch and rows/cols without a drawn
+# rectangle. Works on a reduced copy of the image:
+#   1. Pixels that differ from the background (the median border color) mark
+#      the grid's extent along each axis.
+#   2. Color edges are projected onto each axis; cell boundaries repeat every
+#      pitch pixels, so the profile's autocorrelation peaks at the pitch.
+#   3. rows/cols = extent / pitch, refined to the count whose cell size best
+#      matches the first few periods. How strongly the profile repeats at
+#      that cell size is the confidence.
+
+# Longest side of the reduced image the detector works on
+DETECT_SIZE = 800
+
+# A pixel belongs to the grid when a channel differs from the background by this much
+CONTENT_THRESHOLD = 40
+
+# Fewest reduced pixels per cell the pitch search considers
+MIN_PITCH = 4
+
+# Below this periodicity an axis is taken to hold a single row or column
+MIN_PERIODICITY = 0.2
+
+# Default for rejecting a detection in batch and stream mode. Upright plates
+# score about 0.5-0.9; a skewed plate misread as a single row about 0.25.
+MIN_CONFIDENCE = 0.3
+
+
+class GridDetection:
+    __slots__ = ("roi", "rows", "cols", "confidence", "pitch")
+
+    def __init__(self, roi, rows, cols, confidence, pitch):
+        self.roi = roi  # (x1, y1, x2, y2) in image coordinates
+        self.rows = rows
+        self.cols = cols
+        self.confidence = confidence  # 0 (no grid found) .. 1
+        self.pitch = pitch  # (cell width, cell height) in image pixels
+
+    def __repr__(self):
+        return (f"GridDetection(roi={self.roi}, rows={self.rows}, cols={self.cols}, "
+                f"confidence={self.confidence:.2f})")
+
+
+def box_reduce(array, factor, band=32):
+    # Mean of every factor x factor block, as float32. Strided adds keep this
+    # fast and, unlike plain subsampling, thin grid lines are never skipped.
+    # Works band rows of output at a time so the uint16 sums stay in cache.
+    height, width = array.shape[0] // factor, array.shape[1] // factor
+    reduced = np.empty((height, width, 3), dtype=np.float32)
+    row_sums = np.empty((band, width * factor, 3), dtype=np.uint16)
+    sums = np.empty((band, width, 3), dtype=np.uint16)
+    for top in range(0, height, band):
+        n = min(band, height - top)
+        rows = row_sums[:n]
+        rows[...] = array[top * factor:(top + n) * factor:factor, :width * factor]
+        for i in range(1, factor):
+            rows += array[top * factor + i:(top + n) * factor:factor, :width * factor]
+        cells = sums[:n]
+        cells[...] = rows[:, 0::factor]
+        for j in range(1, factor):
+            cells += rows[:, j::factor]
+        np.multiply(cells, 1 / (factor * factor), out=reduced[top:top + n], casting="unsafe")
+    return reduced
+
+
+def reduced_image(image, size=DETECT_SIZE):
+    # (h, w, 3) float32 copy no larger than size on its longest side, and the
+    # factor from reduced to image coordinates
+    if isinstance(image, RasterSampler):
+        overview = image.raster.overview((size, size))
+        return np.asarray(overview, dtype=np.float32), image.size[0] / overview.width
+    if isinstance(image, ImageSampler):
+        image = image.array
+
+    if isinstance(image, np.ndarray):
+        array = image_to_array(image)
+        factor = max(1, int(np.ceil(max(array.shape[:2]) / size)))
+        return box_reduce(array, factor), factor
+
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    factor = max(1, int(np.ceil(max(image.size) / size)))
+    if factor > 1:
+        image = image.reduce(factor)
+    return np.asarray(image, dtype=np.float32), factor
+
+
+def content_extent(fraction):
+    # First and last index where the grid covers a good share of the line
+    threshold = 0.5 * np.percentile(fraction, 95)
+    inside = np.flatnonzero(fraction > max(threshold, 0.02))
+    if len(inside) == 0:
+        return 0, len(fraction)
+    return int(inside[0]), int(inside[-1]) + 1
+
+
+def interior(edges, start, stop):
+    # Edge profile over [start, stop) without the grid's own outline, which
+    # is usually far stronger than the cell boundaries and would drown them
+    # out (a plate rim around wells, say)
+    profile = edges[start:stop].copy()
+    if len(profile) > 8:
+        profile[:2] = profile[-3:] = np.median(profile)
+    return profile
+
+
+def autocorrelation(profile, unbiased=False):
+    # Normalized autocorrelation; unbiased divides by the overlap at each lag
+    # so long lags are not penalized
+    profile = profile - profile.mean()
+    n = len(profile)
+    spectrum = np.fft.rfft(profile, 2 * n)
+    autocorr = np.fft.irfft(spectrum * np.conj(spectrum))[:n]
+    if unbiased:
+        autocorr /= n - np.arange(n)
+    return autocorr / autocorr[0] if autocorr[0] > 0 else np.zeros(n)
+
+
+def count_cells(profile):
+    # Number of cells along one axis and how periodic the profile is (0..1).
+    # The pitch is the smallest autocorrelation peak nearly as strong as the
+    # strongest, past the central lobe; the count is then the one whose
+    # pitch best lines up with the first few multiples of the period.
+    # Returns (1, None) when no repeating structure is found.
+    n = len(profile)
+    if n < 2 * MIN_PITCH:
+        return 1, None
+    autocorr = autocorrelation(profile)
+
+    lags = np.arange(1, int(n * 0.6))
+    minima = lags[(autocorr[lags] < autocorr[lags - 1]) & (autocorr[lags] <= autocorr[lags + 1])]
+    if len(minima) == 0:
+        return 1, None
+    lags = lags[lags > max(minima[0], MIN_PITCH - 1)]
+    peaks = lags[(autocorr[lags] > autocorr[lags - 1]) & (autocorr[lags] >= autocorr[lags + 1])]
+    if len(peaks) == 0 or autocorr[peaks].max() <= 0:
+        return 1, None
+    pitch = peaks[autocorr[peaks] >= 0.8 * autocorr[peaks].max()][0]
+
+    autocorr = autocorrelation(profile, unbiased=True)
+    best_cells, best_score = 1, None
+    estimate = int(round(n / pitch))
+    for cells in range(max(2, estimate - 1), estimate + 2):
+        multiples = np.arange(1, cells) * n / cells
+        multiples = multiples[multiples <= n * 0.6][:4]
+        if len(multiples) == 0:
+            continue
+        score = np.interp(multiples, np.arange(n), autocorr).mean()
+        if best_score is None or score > best_score:
+            best_cells, best_score = cells, score
+    if best_score is None or best_score < MIN_PERIODICITY:
+        return 1, None
+    return best_cells, float(np.clip(best_score, 0, 1))
+
+
+def detect_grid(image, size=DETECT_SIZE):
+    # image may be a PIL image, an (H, W, 3) array, an ImageSampler or a
+    # RasterSampler. Returns a GridDetection in image coordinates.
+    small, factor = reduced_image(image, size)
+    height, width = small.shape[:2]
+
+    # Background: the median color of the outer frame of the image
+    border = max(1, min(width, height) // 50)
+    frame = np.concatenate([small[:border].reshape(-1, 3), small[-border:].reshape(-1, 3),
+                            small[:, :border].reshape(-1, 3), small[:, -border:].reshape(-1, 3)])
+    background = np.median(frame, axis=0).astype(np.float32)
+    # Per-channel maximum spelled out; reducing over the short last axis is
+    # several times slower on an 800 x 600 image
+    distance = np.abs(small - background)
+    content = np.maximum(np.maximum(distance[..., 0], distance[..., 1]), distance[..., 2]) > CONTENT_THRESHOLD
+
+    # Color edges across each axis, projected within the other axis' extent
+    y0, y1 = content_extent(content.mean(axis=1))
+    x0, x1 = content_extent(content.mean(axis=0))
+    edges_x = np.abs(np.diff(small[y0:y1], axis=1)).sum(axis=0).sum(axis=1)
+    edges_y = np.abs(np.diff(small[:, x0:x1], axis=0)).sum(axis=(1, 2))
+
+    x0, x1 = content_extent(content[y0:y1].mean(axis=0))
+    y0, y1 = content_extent(content[:, x0:x1].mean(axis=1))
+    cols, confidence_x = count_cells(interior(edges_x, x0, x1))
+    rows, confidence_y = count_cells(interior(edges_y, y0, y1))
+
+    # A single row or column has no period of its own; trust the other axis
+    confidences = [c for c in (confidence_x, confidence_y) if c is not None]
+    confidence = min(confidences) if confidences else 0.0
+
+    roi = (int(x0 * factor), int(y0 * factor),
+           min(int(x1 * factor), int(width * factor)) - 1, min(int(y1 * factor), int(height * factor)) - 1)
+    pitch = ((roi[2] - roi[0]) / cols, (roi[3] - roi[1]) / rows)
+    return GridDetection(roi, rows, cols, confidence, pitch)
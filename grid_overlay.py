@@ -0,0 +1,132 @@
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+# Renders the grid lines and cell labels into one RGBA image, so the canvas
+# holds a single item instead of two per cell. The similarity heatmap is a
+# second image of its own, under the grid, redrawn alone when scores change.
+
+LINE_COLOR = (255, 255, 255, 255)
+LABEL_COLOR = (255, 255, 255, 255)
+HEATMAP_ALPHA = 110
+
+# Labels are skipped when cells are drawn smaller than this (in pixels)
+MIN_LABEL_CELL_WIDTH = 18
+MIN_LABEL_CELL_HEIGHT = 10
+
+
+def heatmap_colors(values, alpha=HEATMAP_ALPHA):
+    # Map values to red (lowest) -> yellow -> green (highest), stretched over
+    # the range present in the grid so small differences stay visible
+    values = np.asarray(values, dtype=np.float64)
+    span = values.max() - values.min() if values.size else 0
+    t = (values - values.min()) / span if span > 0 else np.ones_like(values)
+    rgba = np.empty(values.shape + (4,), dtype=np.uint8)
+    rgba[..., 0] = np.clip(2 * (1 - t), 0, 1) * 255
+    rgba[..., 1] = np.clip(2 * t, 0, 1) * 255
+    rgba[..., 2] = 0
+    rgba[..., 3] = alpha
+    return rgba
+
+
+_glyph_cache = {}
+_label_cache = {}
+
+
+def label_mask(text, font):
+    # Alpha mask of a label, built from per-character glyphs rendered once and
+    # cached; drawing thousands of labels through FreeType one by one is slow
+    mask = _label_cache.get((text, id(font)))
+    if mask is not None:
+        return mask
+
+    glyphs = []
+    for char in text:
+        glyph = _glyph_cache.get((char, id(font)))
+        if glyph is None:
+            ascent, descent = font.getmetrics()
+            width = max(1, int(round(font.getlength(char))))
+            image = Image.new("L", (width, ascent + descent), 0)
+            ImageDraw.Draw(image).text((0, 0), char, fill=255, font=font)
+            glyph = np.asarray(image)
+            _glyph_cache[(char, id(font))] = glyph
+        glyphs.append(glyph)
+
+    if len(_label_cache) > 20000:
+        _label_cache.clear()
+    mask = _label_cache[(text, id(font))] = np.hstack(glyphs)
+    return mask
+
+
+def cell_edges(size, roi, rows, cols):
+    # Cell edges in display pixels, clipped to the displayed image
+    width, height = size
+    x1, y1, x2, y2 = roi
+    xs = np.clip(np.round(x1 + np.arange(cols + 1) * (x2 - x1) / cols).astype(int), 0, width - 1)
+    ys = np.clip(np.round(y1 + np.arange(rows + 1) * (y2 - y1) / rows).astype(int), 0, height - 1)
+    return xs, ys
+
+
+def heatmap_pixels(heatmap, xs, ys):
+    # Stretch (rows, cols, 4) per-cell colors onto the exact cell edges
+    cells = np.repeat(heatmap, np.diff(ys), axis=0)
+    return np.repeat(cells, np.diff(xs), axis=1)
+
+
+def render_heatmap(size, roi, rows, cols, heatmap):
+    # Just the heatmap, cropped to the grid, as (RGBA image, (left, top)) or
+    # None if the grid has no area. Drawn as its own layer under the grid
+    # lines it can be redrawn alone whenever the scores change.
+    xs, ys = cell_edges(size, roi, rows, cols)
+    if xs[-1] <= xs[0] or ys[-1] <= ys[0]:
+        return None
+    return Image.fromarray(heatmap_pixels(heatmap, xs, ys), "RGBA"), (int(xs[0]), int(ys[0]))
+
+
+def render_grid_overlay(size, roi, rows, cols, labels=None):
+    # size is the (width, height) of the displayed image and roi the grid
+    # rectangle (x1, y1, x2, y2) in the same display coordinates. Cell fills
+    # are drawn separately by render_heatmap.
+    width, height = size
+    overlay = np.zeros((height, width, 4), dtype=np.uint8)
+    x1, y1, x2, y2 = roi
+    xs, ys = cell_edges(size, roi, rows, cols)
+
+    # Grid lines
+    overlay[ys[0]:ys[-1] + 1, xs] = LINE_COLOR
+    overlay[ys, xs[0]:xs[-1] + 1] = LINE_COLOR
+
+    image = Image.fromarray(overlay, "RGBA")
+
+    cell_width = (x2 - x1) / cols
+    cell_height = (y2 - y1) / rows
+    if labels is not None and cell_width >= MIN_LABEL_CELL_WIDTH and cell_height >= MIN_LABEL_CELL_HEIGHT:
+        font = _label_font()
+        text = np.zeros((height, width), dtype=np.uint8)
+        for index, label in enumerate(labels):
+            mask = label_mask(label, font)
+            row, col = divmod(index, cols)
+            left = int(x1 + (col + 0.5) * cell_width - mask.shape[1] / 2)
+            top = int(y1 + (row + 0.5) * cell_height - mask.shape[0] / 2)
+
+            # Clip the label to the overlay
+            mask = mask[max(0, -top):height - top, max(0, -left):width - left]
+            top, left = max(0, top), max(0, left)
+            if mask.size == 0:
+                continue
+            region = text[top:top + mask.shape[0], left:left + mask.shape[1]]
+            np.maximum(region, mask, out=region)
+
+        # Blend all labels onto the overlay in one pass
+        image.paste(LABEL_COLOR, (0, 0, width, height), Image.fromarray(text, "L"))
+
+    return image
+
+
+_font = None
+
+
+def _label_font():
+    global _font
+    if _font is None:
+        _font = ImageFont.load_default()
+    return _font
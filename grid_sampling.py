@@ -0,0 +1,347 @@
+import numpy as np
+
+# Half-size of the square averaged around each cell center (7x7 pixels)
+SAMPLE_SIZE = 3
+
+# Largest region (in pixels) a RasterSampler reads at once
+REGION_MAX_PIXELS = 2 ** 24
+
+# Pixels copied at a time when a PIL image is turned into an array
+ARRAY_BAND_PIXELS = 2 ** 22
+
+# Most points per axis averaged in a cell of a four-corner grid; larger
+# windows are covered by this many evenly spaced points instead of every pixel
+QUAD_SAMPLES_MAX = 16
+
+
+def image_to_array(image):
+    # Return the image as an (H, W, 3) uint8 array. Arrays are only copied
+    # when they are not already RGB uint8; PIL images are always copied, so
+    # callers that keep the array should let go of the image. The copy is
+    # made in bands of rows, since np.asarray on a whole image would first
+    # build a second full-size bytes object.
+    if isinstance(image, np.ndarray):
+        array = image
+    else:
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        array = np.empty((image.height, image.width, 3), dtype=np.uint8)
+        rows = max(1, ARRAY_BAND_PIXELS // max(1, image.width))
+        for top in range(0, image.height, rows):
+            bottom = min(image.height, top + rows)
+            array[top:bottom] = np.asarray(image.crop((0, top, image.width, bottom)))
+
+    if array.ndim == 2:  # Grayscale
+        array = np.repeat(array[:, :, None], 3, axis=2)
+    elif array.shape[2] > 3:  # RGBA format
+        array = array[:, :, :3]
+
+    if array.dtype != np.uint8:
+        array = array.astype(np.uint8)
+    return array
+
+
+def cell_centers(start_x, start_y, end_x, end_y, rows, cols, img_width, img_height):
+    # Integer center of every cell, clamped to the image like the original loop
+    cell_width = (end_x - start_x) / cols
+    cell_height = (end_y - start_y) / rows
+
+    center_x = (start_x + np.arange(cols) * cell_width + cell_width / 2).astype(np.int64)
+    center_y = (start_y + np.arange(rows) * cell_height + cell_height / 2).astype(np.int64)
+
+    center_x = np.clip(center_x, 0, img_width - 1)
+    center_y = np.clip(center_y, 0, img_height - 1)
+    return center_x, center_y
+
+
+def perspective_transform(src, dst):
+    # 3x3 homography mapping the four src points onto the four dst points
+    a, b = [], []
+    for (x, y), (u, v) in zip(src, dst):
+        a.append([x, y, 1, 0, 0, 0, -u * x, -u * y])
+        a.append([0, 0, 0, x, y, 1, -v * x, -v * y])
+        b.extend((u, v))
+    try:
+        h = np.linalg.solve(np.array(a, dtype=np.float64), np.array(b, dtype=np.float64))
+    except np.linalg.LinAlgError:
+        raise ValueError("Grid corners must form a quadrilateral")
+    return np.append(h, 1.0).reshape(3, 3)
+
+
+def grid_transform(corners, rows, cols):
+    # Homography from grid coordinates, where cell (row, col) spans
+    # [col, col + 1] x [row, row + 1], to image coordinates. corners are the
+    # grid's outer corners clockwise from the top-left (A1) one.
+    return perspective_transform([(0, 0), (cols, 0), (cols, rows), (0, rows)], corners)
+
+
+def apply_transform(matrix, x, y):
+    w = matrix[2, 0] * x + matrix[2, 1] * y + matrix[2, 2]
+    return ((matrix[0, 0] * x + matrix[0, 1] * y + matrix[0, 2]) / w,
+            (matrix[1, 0] * x + matrix[1, 1] * y + matrix[1, 2]) / w)
+
+
+def quad_cell_size(corners, rows, cols):
+    # Mean cell width and height in image pixels of a four-corner grid
+    corners = np.asarray(corners, dtype=np.float64)
+    top, right, bottom, left = (np.hypot(*(corners[(i + 1) % 4] - corners[i])) for i in range(4))
+    return (top + bottom) / (2 * cols), (left + right) / (2 * rows)
+
+
+def window_offsets(half, cell_size):
+    # Evenly spaced offsets from the cell center, in cells, covering a
+    # (2 * half + 1)-pixel window; one point per pixel for small windows
+    count = min(2 * half + 1, QUAD_SAMPLES_MAX)
+    return ((np.arange(count) + 0.5) / count - 0.5) * (2 * half + 1) / cell_size
+
+
+def quad_sample_points(matrix, row_ids, col_ids, cell_size, half_x, half_y):
+    # Image coordinates of the points averaged in each cell, as two
+    # (rows, cols, n) float arrays. The window is laid out in grid space, so
+    # it follows the perspective of its cell.
+    u = (np.asarray(col_ids) + 0.5)[None, :, None, None] + window_offsets(half_x, cell_size[0])[None, None, None, :]
+    v = (np.asarray(row_ids) + 0.5)[:, None, None, None] + window_offsets(half_y, cell_size[1])[None, None, :, None]
+    u, v = np.broadcast_arrays(u, v)
+    x, y = apply_transform(matrix, u, v)
+    return x.reshape(x.shape[0], x.shape[1], -1), y.reshape(y.shape[0], y.shape[1], -1)
+
+
+def bilinear_gather(array, x, y):
+    # Bilinearly interpolated colors of an (H, W, 3) array at float
+    # coordinates, as float32 (..., 3). Points outside are clamped to the border.
+    img_height, img_width = array.shape[:2]
+    x = np.clip(x, 0, img_width - 1)
+    y = np.clip(y, 0, img_height - 1)
+    x0 = np.minimum(x.astype(np.int64), max(img_width - 2, 0))
+    y0 = np.minimum(y.astype(np.int64), max(img_height - 2, 0))
+    x1 = np.minimum(x0 + 1, img_width - 1)
+    y1 = np.minimum(y0 + 1, img_height - 1)
+    fx = (x - x0).astype(np.float32)[..., None]
+    fy = (y - y0).astype(np.float32)[..., None]
+
+    top = array[y0, x0] * (1 - fx) + array[y0, x1] * fx
+    bottom = array[y1, x0] * (1 - fx) + array[y1, x1] * fx
+    return top * (1 - fy) + bottom * fy
+
+
+def quad_cell_means(sampler, matrix, row_ids, col_ids, cell_size, half_x, half_y):
+    # Mean color of each cell of a four-corner grid from bilinear samples
+    # taken only at the window points, without warping the image
+    x, y = quad_sample_points(matrix, row_ids, col_ids, cell_size, half_x, half_y)
+    return sampler.sample_points(x, y).mean(axis=2).astype(np.uint8)  # (rows, cols, 3)
+
+
+def parse_sample_window(text):
+    # "7" is a 7x7 pixel window, "80%" covers 80% of each cell.
+    # Returns (sample_size, sample_fraction) with exactly one of them set.
+    text = str(text).strip()
+    if text.endswith("%"):
+        fraction = float(text[:-1]) / 100
+        if not 0 < fraction <= 1:
+            raise ValueError("Sample window must be between 0% and 100%")
+        return None, fraction
+    width = int(text)
+    if width <= 0:
+        raise ValueError("Sample window must be positive")
+    return width // 2, None
+
+
+def window_half_sizes(cell_width, cell_height, sample_size=SAMPLE_SIZE, sample_fraction=None):
+    # Half-width and half-height of the window averaged in each cell
+    if sample_fraction is None:
+        return sample_size, sample_size
+    half_x = max(0, int(cell_width * sample_fraction / 2))
+    half_y = max(0, int(cell_height * sample_fraction / 2))
+    return half_x, half_y
+
+
+def sample_cell_means(array, center_x, center_y, sample_size=SAMPLE_SIZE, sample_size_y=None):
+    # Average the (2 * sample_size + 1)^2 window around every cell center in
+    # one batched gather. Windows are clipped at the image border exactly like
+    # the original getpixel loop, and the mean is truncated to an integer.
+    if sample_size_y is None:
+        sample_size_y = sample_size
+    img_height, img_width = array.shape[:2]
+
+    xs = center_x[:, None] + np.arange(-sample_size, sample_size + 1)  # (cols, kx)
+    ys = center_y[:, None] + np.arange(-sample_size_y, sample_size_y + 1)  # (rows, ky)
+    x_valid = (xs >= 0) & (xs < img_width)
+    y_valid = (ys >= 0) & (ys < img_height)
+    xs = np.clip(xs, 0, img_width - 1)
+    ys = np.clip(ys, 0, img_height - 1)
+
+    # Gather all windows at once: (rows, ky, cols, kx, 3)
+    patches = array[ys[:, :, None, None], xs[None, None, :, :]]
+
+    # Pixels outside the image were clamped above, so mask them out of the sum
+    mask = y_valid[:, :, None, None] & x_valid[None, None, :, :]
+    sums = np.where(mask[..., None], patches, 0).sum(axis=(1, 3), dtype=np.int64)
+    counts = y_valid.sum(axis=1)[:, None] * x_valid.sum(axis=1)[None, :]
+
+    return (sums // counts[:, :, None]).astype(np.uint8)  # (rows, cols, 3)
+
+
+def build_integral_image(array):
+    # Summed-area table with a zero first row and column: (H + 1, W + 1, 3).
+    # uint32 is enough even for huge images because the four-corner difference
+    # is exact modulo 2**32 as long as a single window sums to less than that
+    # (any window under ~16 megapixels).
+    img_height, img_width = array.shape[:2]
+    table = np.zeros((img_height + 1, img_width + 1, 3), dtype=np.uint32)
+    np.cumsum(array, axis=0, dtype=np.uint32, out=table[1:, 1:])
+    np.cumsum(table[1:, 1:], axis=1, dtype=np.uint32, out=table[1:, 1:])
+    return table
+
+
+def integral_cell_means(table, center_x, center_y, half_x, half_y):
+    # Average any rectangular window per cell in constant time from the table
+    img_height, img_width = table.shape[0] - 1, table.shape[1] - 1
+    x0 = np.clip(center_x - half_x, 0, img_width)
+    x1 = np.clip(center_x + half_x + 1, 0, img_width)
+    y0 = np.clip(center_y - half_y, 0, img_height)[:, None]
+    y1 = np.clip(center_y + half_y + 1, 0, img_height)[:, None]
+
+    sums = table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0]  # Wraps back to the exact sum
+    counts = (y1 - y0) * (x1 - x0)
+    return (sums.astype(np.int64) // counts[:, :, None]).astype(np.uint8)
+
+
+def window_bounds(center_x, center_y, half_x, half_y, size):
+    # (x0, y0, x1, y1) covering the windows of every cell, clipped to size
+    img_width, img_height = size
+    return (int(np.clip(np.min(center_x) - half_x, 0, img_width)),
+            int(np.clip(np.min(center_y) - half_y, 0, img_height)),
+            int(np.clip(np.max(center_x) + half_x + 1, 0, img_width)),
+            int(np.clip(np.max(center_y) + half_y + 1, 0, img_height)))
+
+
+class ImageSampler:
+    # Per-image sampling state: the cached pixel array and, once a large
+    # window is requested, a summed-area table. The table only covers the
+    # windows asked for (the grid's area, not the whole image) and is reused
+    # while later windows fall inside it.
+
+    # Windows up to this many pixels are gathered directly; larger ones use
+    # the summed-area table so their cost does not grow with the window
+    GATHER_MAX_AREA = 81
+
+    def __init__(self, image):
+        self.array = image_to_array(image)
+        self._integral = None
+
+    @property
+    def size(self):
+        return self.array.shape[1], self.array.shape[0]
+
+    def integral_table(self, bounds):
+        # (bounds of the table, summed-area table) covering bounds (x0, y0,
+        # x1, y1) of the image
+        if self._integral is not None:
+            (x0, y0, x1, y1), table = self._integral
+            if x0 <= bounds[0] and y0 <= bounds[1] and x1 >= bounds[2] and y1 >= bounds[3]:
+                return self._integral
+        x0, y0, x1, y1 = bounds
+        self._integral = bounds, build_integral_image(self.array[y0:y1, x0:x1])
+        return self._integral
+
+    def sample(self, center_x, center_y, half_x=SAMPLE_SIZE, half_y=None, method="auto", bounds=None):
+        # bounds: the area a summed-area table should cover when one is
+        # built, e.g. the whole grid when it is sampled in bands; by default
+        # just these windows
+        if half_y is None:
+            half_y = half_x
+        if method == "auto":
+            small = (2 * half_x + 1) * (2 * half_y + 1) <= self.GATHER_MAX_AREA
+            method = "gather" if small and self._integral is None else "integral"
+
+        if method == "gather":
+            return sample_cell_means(self.array, center_x, center_y, half_x, half_y)
+        if method == "integral":
+            if bounds is None:
+                bounds = window_bounds(center_x, center_y, half_x, half_y, self.size)
+            (left, top, _, _), table = self.integral_table(bounds)
+            return integral_cell_means(table, center_x - left, center_y - top, half_x, half_y)
+        raise ValueError(f"Unknown sampling method: {method}")
+
+    def sample_points(self, x, y):
+        return bilinear_gather(self.array, x, y)
+
+
+class RasterSampler:
+    # Samples an image too large to hold in memory: anything with .size and
+    # .read_region(x0, y0, x1, y1), such as a tiled_raster.TiledRaster. Each
+    # row of cells reads only the image rows its windows cover, in column
+    # groups of at most max_pixels.
+
+    def __init__(self, raster, max_pixels=REGION_MAX_PIXELS):
+        self.raster = raster
+        self.max_pixels = max_pixels
+
+    @property
+    def size(self):
+        return self.raster.size
+
+    def sample(self, center_x, center_y, half_x=SAMPLE_SIZE, half_y=None, method="auto", bounds=None):
+        # method and bounds are accepted for ImageSampler compatibility; one
+        # exact strategy is used for every window size
+        if half_y is None:
+            half_y = half_x
+        img_width, img_height = self.size
+        center_x = np.asarray(center_x, dtype=np.int64)
+        x0 = np.clip(center_x - half_x, 0, img_width)
+        x1 = np.clip(center_x + half_x + 1, 0, img_width)
+
+        # Group neighbouring columns while their combined region stays small
+        band_height = 2 * half_y + 1
+        groups = []
+        start = 0
+        for col in range(1, len(center_x) + 1):
+            if col == len(center_x) or (x1[col] - x0[start]) * band_height > self.max_pixels:
+                groups.append((start, col))
+                start = col
+
+        colors = np.empty((len(center_y), len(center_x), 3), dtype=np.uint8)
+        for row, cy in enumerate(np.asarray(center_y, dtype=np.int64)):
+            y0 = max(0, int(cy) - half_y)
+            y1 = min(img_height, int(cy) + half_y + 1)
+            for first, last in groups:
+                rx0, rx1 = int(x0[first]), int(x1[last - 1])
+                region = self.raster.read_region(rx0, y0, rx1, y1)
+
+                # The region rows are exactly the window rows, so each window
+                # sum is a difference of cumulative column sums
+                sums = np.zeros((rx1 - rx0 + 1, 3), dtype=np.int64)
+                np.cumsum(region.sum(axis=0, dtype=np.int64), axis=0, out=sums[1:])
+                wx0, wx1 = x0[first:last] - rx0, x1[first:last] - rx0
+                counts = (y1 - y0) * (wx1 - wx0)
+                colors[row, first:last] = (sums[wx1] - sums[wx0]) // counts[:, None]
+        return colors
+
+    def sample_points(self, x, y):
+        # Bilinear colors at (rows, cols, n) float coordinates. Each row of
+        # cells reads the bounding region of its points, split into column
+        # groups of at most max_pixels.
+        img_width, img_height = self.size
+        colors = np.empty(x.shape + (3,), dtype=np.float32)
+        for row in range(x.shape[0]):
+            left = np.clip(np.floor(x[row].min(axis=1)), 0, img_width - 1).astype(np.int64)
+            right = np.clip(np.floor(x[row].max(axis=1)) + 2, 1, img_width).astype(np.int64)
+            top = np.clip(np.floor(y[row].min(axis=1)), 0, img_height - 1).astype(np.int64)
+            bottom = np.clip(np.floor(y[row].max(axis=1)) + 2, 1, img_height).astype(np.int64)
+
+            first = 0
+            while first < x.shape[1]:
+                last = first + 1
+                while last < x.shape[1]:
+                    area = ((right[first:last + 1].max() - left[first:last + 1].min())
+                            * (bottom[first:last + 1].max() - top[first:last + 1].min()))
+                    if area > self.max_pixels:
+                        break
+                    last += 1
+                rx0, rx1 = int(left[first:last].min()), int(right[first:last].max())
+                ry0, ry1 = int(top[first:last].min()), int(bottom[first:last].max())
+                region = self.raster.read_region(rx0, ry0, rx1, ry1)
+                colors[row, first:last] = bilinear_gather(region, x[row, first:last] - rx0,
+                                                          y[row, first:last] - ry0)
+                first = last
+        return colors
@@ -0,0 +1,120 @@
+import threading
+
+from PIL import Image
+
+from grid_sampling import ImageSampler, RasterSampler
+from profiling import count, span
+from tiled_raster import open_raster
+
+# Loads an image for the GUI in two steps. JPEGs are first decoded at a
+# reduced DCT scale (Image.draft), which is several times faster and smaller
+# than a full decode and is enough to show the picture right away. The
+# full-resolution pixels, which only analysis needs, are then decoded on a
+# background thread. TIFF scans too large to decode are never loaded whole:
+# they are sampled tile by tile and shown from a downsampled overview. Other
+# formats are decoded in full up front, as before. Once decoded, the
+# full-resolution pixels live only in the sampler's array; what is shown is
+# a reduced copy, so no second full-size image is kept.
+
+# Smallest overview shown for scans read through a TiledRaster, and smallest
+# reduced copy shown of a fully decoded image
+OVERVIEW_MIN_SIZE = (1024, 1024)
+
+
+def to_rgb(image):
+    return image if image.mode == "RGB" else image.convert("RGB")
+
+
+def display_copy(image, min_size=OVERVIEW_MIN_SIZE):
+    # image reduced by the largest integer factor that keeps it at least
+    # min_size; small images are returned as they are
+    factor = max(1, min(image.width // min_size[0], image.height // min_size[1]))
+    return image if factor == 1 else image.reduce(factor)
+
+
+class ImageSource:
+    def __init__(self, path, preview_size=None):
+        self.path = path
+        self._sampler = None
+        self._error = None
+        self._loaded = threading.Event()
+
+        self._raster = raster = open_raster(path)
+        if raster is not None:
+            self.size = raster.size
+            self.preview = raster.overview(preview_size or OVERVIEW_MIN_SIZE)
+            self._sampler = RasterSampler(raster)
+            self._loaded.set()
+            return
+
+        with Image.open(path) as image:
+            self.size = image.size
+            if preview_size is not None and image.format == "JPEG":
+                # Decodes at 1/2, 1/4 or 1/8 scale, no smaller than preview_size
+                image.draft("RGB", preview_size)
+            preview = to_rgb(image)
+            preview.load()  # Before the file is closed
+
+        if preview.size == self.size:
+            # No reduced decode available: the pixels were decoded in full
+            self._set_full(preview)
+            self._loaded.set()
+        else:
+            self.preview = preview  # Replaced once the full decode is done
+
+    @property
+    def lazy(self):
+        # True while the full-resolution decode is still to come
+        return not self._loaded.is_set()
+
+    def start(self):
+        # Decode the full-resolution image in the background
+        if not self._loaded.is_set():
+            threading.Thread(target=self._decode, daemon=True).start()
+        return self
+
+    def _decode(self):
+        try:
+            with span("decode.full"), Image.open(self.path) as image:
+                full = to_rgb(image)
+                full.load()
+                count("pixels.decoded", full.width * full.height)
+            self._set_full(full)
+        except Exception as e:
+            self._error = e
+        finally:
+            self._loaded.set()
+
+    def _set_full(self, full):
+        # Keep the full-resolution pixels only as the sampler's array (a
+        # copy), and a reduced copy of them to show
+        self._sampler = ImageSampler(full)
+        self.preview = display_copy(full)
+        if self.preview is not full:
+            full.close()
+
+    @property
+    def ready(self):
+        return self._loaded.is_set()
+
+    def wait(self, timeout=None):
+        # True once the full-resolution decode has finished (or failed)
+        return self._loaded.wait(timeout)
+
+    @property
+    def sampler(self):
+        # ImageSampler (or RasterSampler) over the full-resolution pixels;
+        # blocks until decoded
+        self._loaded.wait()
+        if self._error is not None:
+            raise self._error
+        return self._sampler
+
+    @property
+    def error(self):
+        return self._error
+
+    def close(self):
+        # Releases the file of a scan read tile by tile
+        if self._raster is not None:
+            self._raster.close()
@@ -0,0 +1,192 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+from PIL import Image
+
+from grid_analysis import GridResult, analyze_grid, clamp_roi, corners_roi, parse_corners, rank_scores
+from grid_sampling import ImageSampler, RasterSampler, image_to_array, SAMPLE_SIZE
+from tiled_raster import open_raster
+
+# Several grids in one image, such as the plates of a tray scan, analyzed in
+# parallel worker processes. The decoded pixels are copied once into shared
+# memory and every worker maps the same block, so only the plate
+# definitions and the per-cell results are pickled. Each worker samples a
+# crop around its own plate, so a summed-area table for percentage windows
+# covers that plate alone. Scans read through a TiledRaster are not decoded
+# at all: each worker opens the file and reads just its plate's tiles.
+# merged_ranking ranks the cells of all plates together.
+
+# Extra pixels kept around a plate's bounding box when it is cropped
+CROP_MARGIN = 2
+
+
+class PlateGrid:
+    __slots__ = ("name", "rows", "cols", "roi", "corners")
+
+    def __init__(self, name, rows, cols, roi=None, corners=None):
+        self.name = name
+        self.rows = rows
+        self.cols = cols
+        self.roi = roi  # (x1, y1, x2, y2), or None for the whole image
+        self.corners = None if corners is None else parse_corners(corners)  # Skewed plates
+
+    def __repr__(self):
+        return f"PlateGrid({self.name!r}, {self.rows} x {self.cols})"
+
+
+def parse_plates(items):
+    # PlateGrids from dicts such as {"name": "P1", "roi": [...], "rows": 8,
+    # "cols": 12} or with "corners" instead of "roi"
+    plates = []
+    for i, item in enumerate(items):
+        name = str(item.get("name", f"Plate {i + 1}"))
+        rows, cols = int(item.get("rows", 8)), int(item.get("cols", 12))
+        if rows <= 0 or cols <= 0:
+            raise ValueError(f"{name}: rows and cols must be positive")
+        if item.get("roi") is not None and item.get("corners") is not None:
+            raise ValueError(f"{name}: give either roi or corners")
+        roi = item.get("roi")
+        if roi is not None and len(roi) != 4:
+            raise ValueError(f"{name}: roi must be [x1, y1, x2, y2]")
+        plates.append(PlateGrid(name, rows, cols, roi and tuple(int(v) for v in roi), item.get("corners")))
+    if len({plate.name for plate in plates}) != len(plates):
+        raise ValueError("Plate names must be unique")
+    return plates
+
+
+def analyze_plate(image, plate, options):
+    # GridResult of one plate in image coordinates. An (H, W, 3) array is
+    # cropped to the plate first (a view, not a copy); a RasterSampler
+    # already reads only the regions it needs.
+    if isinstance(image, RasterSampler):
+        return analyze_grid(image, plate.roi, plate.rows, plate.cols, corners=plate.corners, **options)
+
+    img_height, img_width = image.shape[:2]
+    if plate.corners is not None:
+        x1, y1, x2, y2 = corners_roi(plate.corners, img_width, img_height)
+    else:
+        x1, y1, x2, y2 = clamp_roi(plate.roi or (0, 0, img_width - 1, img_height - 1), img_width, img_height)
+
+    # Fixed windows may reach past the plate's edge cells
+    margin = (options.get("sample_size") or 0) + CROP_MARGIN
+    left, top = max(0, x1 - margin), max(0, y1 - margin)
+    right, bottom = min(img_width, x2 + margin + 1), min(img_height, y2 + margin + 1)
+    sampler = ImageSampler(image[top:bottom, left:right])
+
+    if plate.corners is not None:
+        result = analyze_grid(sampler, None, plate.rows, plate.cols, corners=plate.corners - (left, top), **options)
+        result.corners = plate.corners
+    else:
+        result = analyze_grid(sampler, (x1 - left, y1 - top, x2 - left, y2 - top), plate.rows, plate.cols,
+                              **options)
+    x1, y1, x2, y2 = result.roi
+    result.roi = (x1 + left, y1 + top, x2 + left, y2 + top)
+    return result
+
+
+class SharedImage:
+    # An (H, W, 3) uint8 array copied into a shared memory block, which
+    # workers map by name with attach_image. Unlinked on close.
+
+    def __init__(self, array):
+        self._shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+        self.array = np.ndarray(array.shape, dtype=np.uint8, buffer=self._shm.buf)
+        self.array[...] = array
+        self.spec = (self._shm.name, array.shape)
+
+    def close(self):
+        if self._shm is not None:
+            self.array = None
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def attach_image(spec):
+    # (shared memory, array) for a SharedImage's spec
+    name, shape = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+
+
+def analyze_shared_plate(source, plate, options):
+    # Runs in a worker process. source is ("shared", spec) or ("raster",
+    # path). Returns the result's arrays, which pickle compactly.
+    if source[0] == "raster":
+        with open_raster(source[1]) as raster:
+            return analyze_plate(RasterSampler(raster), plate, options).to_arrays()
+    shm, array = attach_image(source[1])
+    try:
+        return analyze_plate(array, plate, options).to_arrays()
+    finally:
+        del array
+        shm.close()
+
+
+def analyze_plates(image, plates, reference_colors=None, sample_size=SAMPLE_SIZE, sample_fraction=None,
+                   metric="rgb", palette=None, top_k=3, workers=None, executor=None):
+    # GridResults of several plates in one image, in the order given. image
+    # is a path, a PIL image or an (H, W, 3) array. Plates are analyzed by
+    # up to workers processes (default: one per plate, at most the CPU
+    # count), or by an existing ProcessPoolExecutor; workers=1 analyzes
+    # them one after another in this process. Palette matching runs here
+    # afterwards, so the palette index is never sent to the workers.
+    source = array = raster = None
+    if isinstance(image, str):
+        raster = open_raster(image)
+        if raster is not None:
+            source = ("raster", os.path.abspath(image))
+            local = RasterSampler(raster)
+        else:
+            with Image.open(image) as img:
+                array = image_to_array(img)
+    else:
+        array = image.array if isinstance(image, ImageSampler) else image_to_array(image)
+    if array is not None:
+        local = array
+
+    options = {"reference_colors": reference_colors, "sample_size": sample_size,
+               "sample_fraction": sample_fraction, "metric": metric}
+    workers = min(workers or os.cpu_count() or 1, len(plates))
+    try:
+        if executor is None and workers <= 1:
+            results = [analyze_plate(local, plate, options) for plate in plates]
+        else:
+            shared = SharedImage(array) if array is not None else None
+            pool = executor or ProcessPoolExecutor(max_workers=workers)
+            try:
+                if shared is not None:
+                    source = ("shared", shared.spec)
+                futures = [pool.submit(analyze_shared_plate, source, plate, options) for plate in plates]
+                results = [GridResult.from_arrays(future.result()) for future in futures]
+            finally:
+                if executor is None:
+                    pool.shutdown()
+                if shared is not None:
+                    shared.close()
+    finally:
+        if raster is not None:
+            raster.close()
+
+    if palette is not None:
+        for result in results:
+            result.match_palette(palette, top_k)
+    return results
+
+
+def merged_ranking(results, reference_index=0, top=None, min_similarity=None):
+    # Cells of all plates ranked together, highest similarity first (ties
+    # in plate order, then grid order): (plate indices, cell indices)
+    similarity = np.concatenate([result.similarity[reference_index] for result in results])
+    plate_ids = np.repeat(np.arange(len(results)), [len(result) for result in results])
+    starts = np.cumsum([0] + [len(result) for result in results])
+    order = rank_scores(similarity, top, min_similarity)
+    return plate_ids[order], order - starts[plate_ids[order]]
@@ -0,0 +1,211 @@
+import csv
+import json
+import os
+
+import numpy as np
+
+from color_metrics import rgb_to_lab
+
+# Nearest-palette-color lookup for large named palettes.
+#
+# RGB space is quantized into (2 ** bits) ** 3 bins and, once per palette,
+# each bin stores the palette entries nearest (in Lab) to its center. A query
+# then only measures the exact Lab distance to its bin's short candidate list
+# instead of to every palette entry. Results are exact: colors whose
+# nearest entries could lie outside their bin's list fall back to a full
+# search. Distances are CIE76 Delta-E.
+
+# Distance subtracted from each bin's reach, covering rounding errors
+REACH_SLACK = 1e-6
+
+
+def parse_hex(text):
+    text = text.strip().lstrip("#")
+    if len(text) != 6:
+        raise ValueError(f"Invalid hex color: {text}")
+    return tuple(int(text[i:i + 2], 16) for i in (0, 2, 4))
+
+
+def load_palette(path):
+    # CSV/TSV rows of "name,#RRGGBB" or "name,R,G,B" (a header row is
+    # skipped), or a JSON object mapping names to hex strings
+    names = []
+    colors = []
+    if path.lower().endswith(".json"):
+        with open(path) as f:
+            data = json.load(f)
+        for name, value in data.items():
+            names.append(name)
+            colors.append(parse_hex(value) if isinstance(value, str) else tuple(value))
+    else:
+        with open(path, newline="") as f:
+            try:
+                dialect = csv.Sniffer().sniff(f.read(4096), delimiters=",;\t")
+            except csv.Error:
+                dialect = csv.excel
+            f.seek(0)
+            for row in csv.reader(f, dialect):
+                row = [v.strip() for v in row if v.strip()]
+                if not row:
+                    continue
+                try:
+                    color = parse_hex(row[1]) if len(row) == 2 else tuple(int(v) for v in row[1:4])
+                except (ValueError, IndexError):
+                    if not names:
+                        continue  # Header row
+                    raise ValueError(f"Invalid palette row: {row}")
+                names.append(row[0])
+                colors.append(color)
+
+    if not names:
+        raise ValueError(f"No colors found in palette: {path}")
+    return names, np.array(colors, dtype=np.uint8)
+
+
+class PaletteIndex:
+    def __init__(self, names, colors, bits=5, candidates=32, lut=None, reach=None):
+        self.names = list(names)
+        self.colors = np.asarray(colors, dtype=np.uint8).reshape(-1, 3)
+        self.lab = rgb_to_lab(self.colors)
+        self.bits = bits
+        self.candidates = min(candidates, len(self.names))
+        if lut is None or reach is None:
+            lut, reach = self._build_lut()
+        self.lut = lut
+        self.reach = reach
+
+    def __len__(self):
+        return len(self.names)
+
+    def _bin_centers(self, colors):
+        # RGB center of the bin of each color
+        step = 256 // 2 ** self.bits
+        return (colors // step) * step + step // 2
+
+    def _build_lut(self):
+        # For every RGB bin, the palette entries closest to the bin center,
+        # and the distance from the center to the nearest entry left out
+        # (its reach; infinite when every entry is a candidate). Done in
+        # chunks as ||a||^2 + ||b||^2 - 2ab so memory stays small.
+        levels = 2 ** self.bits
+        centers = self._bin_centers(np.arange(0, 256, 256 // levels))
+        grid = np.stack(np.meshgrid(centers, centers, centers, indexing="ij"), axis=-1).reshape(-1, 3)
+        bin_lab = rgb_to_lab(grid)
+
+        palette_sq = (self.lab ** 2).sum(axis=1)
+        dtype = np.uint16 if len(self.names) <= np.iinfo(np.uint16).max else np.int32
+        lut = np.empty((len(grid), self.candidates), dtype=dtype)
+        reach = np.full(len(grid), np.inf)
+        chunk = max(1, 2 ** 22 // len(self.names))
+        for start in range(0, len(grid), chunk):
+            block = bin_lab[start:start + chunk]
+            dist = (block ** 2).sum(axis=1)[:, None] + palette_sq[None, :] - 2 * block @ self.lab.T
+            if self.candidates < len(self.names):
+                nearest = np.argpartition(dist, self.candidates, axis=1)
+                lut[start:start + chunk] = nearest[:, :self.candidates]
+                diff = block - self.lab[nearest[:, self.candidates]]
+                # Less a little slack for the rounding of the expanded distances
+                reach[start:start + chunk] = np.sqrt((diff * diff).sum(axis=1)) - REACH_SLACK
+            else:
+                lut[start:start + chunk] = np.arange(len(self.names))
+        return lut, reach
+
+    def query(self, colors, k=1):
+        # Top-k palette entries per color: (ids, delta_e), both (N, k),
+        # nearest first. A color's k-th best candidate is exact when it is
+        # nearer than any entry outside the bin's list can be, i.e. when
+        # d(color, center) + d(color, k-th) <= reach (triangle inequality);
+        # the colors where that does not hold are searched exhaustively.
+        colors = np.asarray(colors, dtype=np.uint8).reshape(-1, 3)
+        k = min(k, len(self.names))
+        lab = rgb_to_lab(colors)
+        shift = 8 - self.bits
+        bins = ((colors[:, 0].astype(np.int64) >> shift) << (2 * self.bits)) \
+            | ((colors[:, 1].astype(np.int64) >> shift) << self.bits) \
+            | (colors[:, 2].astype(np.int64) >> shift)
+
+        ids = np.empty((len(colors), k), dtype=np.int64)
+        delta_e = np.empty((len(colors), k))
+        if k <= self.candidates:
+            candidate_ids = self.lut[bins].astype(np.int64)  # (N, candidates)
+            diff = lab[:, None, :] - self.lab[candidate_ids]
+            ids[:], delta_e[:] = nearest_k(np.sqrt((diff * diff).sum(axis=-1)), candidate_ids, k)
+            offset = lab - rgb_to_lab(self._bin_centers(colors))
+            inexact = np.flatnonzero(np.sqrt((offset * offset).sum(axis=1)) + delta_e[:, -1] > self.reach[bins])
+        else:
+            inexact = np.arange(len(colors))
+        if len(inexact):
+            ids[inexact], delta_e[inexact] = self._search(lab[inexact], k)
+        return ids, delta_e
+
+    def _search(self, lab, k):
+        # Exact top-k over the whole palette, in chunks
+        palette_sq = (self.lab ** 2).sum(axis=1)
+        ids = np.empty((len(lab), k), dtype=np.int64)
+        delta_e = np.empty((len(lab), k))
+        chunk = max(1, 2 ** 22 // len(self.names))
+        for start in range(0, len(lab), chunk):
+            block = lab[start:start + chunk]
+            dist = (block ** 2).sum(axis=1)[:, None] + palette_sq[None, :] - 2 * block @ self.lab.T
+            if k < dist.shape[1]:
+                nearest = np.argpartition(dist, k - 1, axis=1)[:, :k]
+            else:
+                nearest = np.broadcast_to(np.arange(dist.shape[1]), dist.shape)
+            diff = block[:, None, :] - self.lab[nearest]
+            ids[start:start + chunk], delta_e[start:start + chunk] = nearest_k(
+                np.sqrt((diff * diff).sum(axis=-1)), nearest, k)
+        return ids, delta_e
+
+    def save(self, path):
+        np.savez_compressed(path, names=np.array(self.names), colors=self.colors, lut=self.lut,
+                            reach=self.reach, bits=self.bits, candidates=self.candidates)
+
+    @classmethod
+    def load(cls, path):
+        # Indexes saved without reach are rebuilt
+        with np.load(path) as data:
+            return cls(data["names"].tolist(), data["colors"], int(data["bits"]),
+                       int(data["candidates"]), data["lut"], data["reach"] if "reach" in data else None)
+
+
+def nearest_k(dist, ids, k):
+    # The k smallest distances of each row and their ids, nearest first
+    if k < dist.shape[1]:
+        top = np.argpartition(dist, k - 1, axis=1)[:, :k]
+    else:
+        top = np.broadcast_to(np.arange(dist.shape[1]), dist.shape)
+    top_dist = np.take_along_axis(dist, top, axis=1)
+    order = np.argsort(top_dist, axis=1, kind="stable")
+    return (np.take_along_axis(np.take_along_axis(ids, top, axis=1), order, axis=1),
+            np.take_along_axis(top_dist, order, axis=1))
+
+
+_index_cache = {}
+
+
+def get_palette_index(path, bits=5, candidates=32):
+    # Build each palette's index once per process and reuse it until the file changes
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size, bits, candidates)
+    index = _index_cache.get(key)
+    if index is None:
+        if path.lower().endswith(".npz"):
+            index = PaletteIndex.load(path)
+        else:
+            index = PaletteIndex(*load_palette(path), bits=bits, candidates=candidates)
+        _index_cache[key] = index
+    return index
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+
+    # Prebuild an index so later runs can load it instead of rebuilding:
+    #   python palette_index.py palette.csv palette.npz
+    if len(sys.argv) != 3:
+        sys.exit("usage: python palette_index.py PALETTE_FILE INDEX.npz")
+    start = time.perf_counter()
+    index = PaletteIndex(*load_palette(sys.argv[1]))
+    index.save(sys.argv[2])
+    print(f"Indexed {len(index)} colors in {time.perf_counter() - start:.2f}s -> {sys.argv[2]}")
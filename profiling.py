@@ -0,0 +1,158 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+
+# Timing spans and counters for finding out where time goes. Code wraps a
+# stage in `with span("stage"):` and counts work with count("pixels", n).
+# While the profiler is disabled (the default) span() hands back one shared
+# do-nothing context manager and count() returns at once, so the
+# instrumentation can stay in place at practically no cost.
+#
+# Recorded spans can be summarized per stage, saved as JSON, or saved in
+# the Chrome trace format (open in chrome://tracing or ui.perfetto.dev).
+
+# Most recent spans kept; older ones are dropped
+MAX_SPANS = 20000
+
+# Set to 1 to start the app with profiling on
+PROFILE_ENV = "KBTG_PROFILE"
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("profiler", "name", "args", "start")
+
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler._record(self.name, self.start, time.perf_counter(), self.args)
+        return False
+
+
+class Profiler:
+    def __init__(self, enabled=False, max_spans=MAX_SPANS):
+        self.enabled = enabled
+        self.spans = deque(maxlen=max_spans)  # (name, start, end, thread id, args)
+        self.counters = {}
+        self.thread_names = {}
+        self.origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, args)
+
+    def count(self, name, amount=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def _record(self, name, start, end, args):
+        thread = threading.current_thread()
+        with self._lock:
+            self.spans.append((name, start, end, thread.ident, args))
+            self.thread_names.setdefault(thread.ident, thread.name)
+
+    def clear(self):
+        with self._lock:
+            self.spans.clear()
+            self.counters.clear()
+            self.origin = time.perf_counter()
+
+    def summary(self):
+        # {stage: {"calls", "total_ms", "mean_ms", "max_ms", "last_ms"}}, in
+        # order of first appearance
+        stages = {}
+        with self._lock:
+            spans = list(self.spans)
+        for name, start, end, _, _ in spans:
+            elapsed = (end - start) * 1000
+            stage = stages.get(name)
+            if stage is None:
+                stage = stages[name] = {"calls": 0, "total_ms": 0.0, "max_ms": 0.0}
+            stage["calls"] += 1
+            stage["total_ms"] += elapsed
+            stage["max_ms"] = max(stage["max_ms"], elapsed)
+            stage["last_ms"] = elapsed
+        for stage in stages.values():
+            stage["mean_ms"] = stage["total_ms"] / stage["calls"]
+        return stages
+
+    def to_json(self):
+        with self._lock:
+            spans = list(self.spans)
+            counters = dict(self.counters)
+        return {
+            "stages": self.summary(),
+            "counters": counters,
+            "spans": [{"name": name, "start_ms": (start - self.origin) * 1000,
+                       "duration_ms": (end - start) * 1000, "thread": self.thread_names.get(tid, str(tid)),
+                       **({"args": args} if args else {})}
+                      for name, start, end, tid, args in spans],
+        }
+
+    def to_chrome_trace(self):
+        # Complete ("X") events per span, one track per thread, and the
+        # counter totals as a final counter ("C") event
+        pid = os.getpid()
+        with self._lock:
+            spans = list(self.spans)
+            counters = dict(self.counters)
+            threads = dict(self.thread_names)
+        events = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+                  for tid, name in threads.items()]
+        end_us = 0.0
+        for name, start, end, tid, args in spans:
+            start_us = (start - self.origin) * 1e6
+            end_us = max(end_us, (end - self.origin) * 1e6)
+            events.append({"name": name, "cat": name.split(".")[0], "ph": "X", "ts": start_us,
+                           "dur": (end - start) * 1e6, "pid": pid, "tid": tid, "args": args})
+        if counters:
+            events.append({"name": "counters", "ph": "C", "ts": end_us, "pid": pid, "args": counters})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def save_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_json(), f, indent=2)
+
+    def save_chrome_trace(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_chrome_trace(), f)
+
+
+# The process-wide profiler the pipeline modules report to
+PROFILER = Profiler(enabled=os.environ.get(PROFILE_ENV) == "1")
+
+
+def span(name, **args):
+    if not PROFILER.enabled:
+        return _NULL_SPAN
+    return _Span(PROFILER, name, args)
+
+
+def count(name, amount=1):
+    if PROFILER.enabled:
+        PROFILER.count(name, amount)
@@ -0,0 +1,121 @@
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Content-addressed cache of analysis intermediates. Entries are small dicts
+# of NumPy arrays kept in an in-memory LRU and, if a directory is given, also
+# written there as .npz files so later runs and other processes can reuse
+# them. Keys are tuples whose first element names the kind of entry.
+
+# Bytes read at a time when hashing image files
+HASH_CHUNK = 1 << 20
+
+
+def key_digest(key):
+    return hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()
+
+
+class ResultCache:
+    def __init__(self, max_entries=256, directory=None, max_disk_entries=10000):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.max_disk_entries = max_disk_entries
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key[0]}-{key_digest(key)}.npz")
+
+    def get(self, key):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return entry
+
+        entry = None
+        if self.directory:
+            path = self._path(key)
+            try:
+                with np.load(path) as data:
+                    entry = {name: data[name] for name in data.files}
+                os.utime(path)  # Mark as recently used for pruning
+            except (OSError, ValueError):
+                entry = None
+
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._remember(key, entry)
+        return entry
+
+    def put(self, key, **arrays):
+        entry = {name: np.asarray(value) for name, value in arrays.items()}
+        with self._lock:
+            self._remember(key, entry)
+
+        if self.directory:
+            # Write to a temporary name first so readers never see a partial file
+            buffer = io.BytesIO()
+            np.savez(buffer, **entry)
+            path = self._path(key)
+            temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(buffer.getvalue())
+            os.replace(temp_path, path)
+        return entry
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def prune(self):
+        # Drop the least recently used files beyond max_disk_entries
+        if not self.directory:
+            return 0
+        paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                 if name.endswith(".npz")]
+        if len(paths) <= self.max_disk_entries:
+            return 0
+        paths.sort(key=lambda path: os.stat(path).st_mtime)
+        stale = paths[:len(paths) - self.max_disk_entries]
+        for path in stale:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return len(stale)
+
+
+def file_digest(path, cache=None):
+    # Hash of the file contents. With a cache, the digest is remembered per
+    # (path, size, mtime) so unchanged files are not read again.
+    stat = os.stat(path)
+    stat_key = ("digest", os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if cache is not None:
+        entry = cache.get(stat_key)
+        if entry is not None:
+            return str(entry["digest"])
+
+    hasher = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            hasher.update(chunk)
+    digest = hasher.hexdigest()
+
+    if cache is not None:
+        cache.put(stat_key, digest=digest)
+    return digest
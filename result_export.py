@@ -0,0 +1,227 @@
+import abc
+import csv
+import io
+import os
+import shutil
+import tempfile
+import zipfile
+
+import numpy as np
+
+from grid_analysis import GridResult, row_label
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # Only needed for Parquet export
+    pyarrow = None
+
+# Per-cell result tables written while a batch runs. Each image's GridResult
+# arrays are appended to an in-memory buffer of columns; once the buffer holds
+# EXPORT_BUFFER_CELLS cells it is written out in one go, so memory stays
+# constant and the file sees a few large writes however long the batch is.
+#
+# Every format has the same columns: image, position, row, col, r, g, b,
+# lab_l, lab_a, lab_b, similarity_1..R (one per reference color) and, with a
+# palette, match_1..k with delta_e_1..k. In NPZ files image and match_i are
+# indices into the "images" and "palette_names" arrays, and position is left
+# out (it follows from row and col).
+
+# Cells buffered before the columns are written out
+EXPORT_BUFFER_CELLS = 1 << 16
+
+# Write buffer of the underlying files
+EXPORT_IO_BUFFER = 1 << 20
+
+
+def cell_columns(image_id, arrays):
+    # Numeric columns of one image's result, from GridResult.to_arrays()
+    result = GridResult.from_arrays(arrays)
+    count = len(result)
+    index = np.arange(count)
+    lab = result.lab.astype(np.float32)
+    columns = {
+        "image": np.full(count, image_id, dtype=np.int32),
+        "row": (index // result.cols).astype(np.int32),
+        "col": (index % result.cols).astype(np.int32),
+        "r": result.colors[:, 0], "g": result.colors[:, 1], "b": result.colors[:, 2],
+        "lab_l": lab[:, 0], "lab_a": lab[:, 1], "lab_b": lab[:, 2],
+    }
+    if result.similarity is not None:
+        for i, scores in enumerate(result.similarity):
+            columns[f"similarity_{i + 1}"] = scores.astype(np.float32)
+    if result.matches is not None:
+        for i in range(result.matches.shape[1]):
+            columns[f"match_{i + 1}"] = result.matches[:, i].astype(np.int32)
+            columns[f"delta_e_{i + 1}"] = result.match_distances[:, i].astype(np.float32)
+    return columns
+
+
+class ResultExporter(abc.ABC):
+    # Buffers columns and hands them to _write_columns in large batches.
+    # Subclasses write the actual file format. Only the image paths of the
+    # buffered images are kept; the image column numbers images from 0 over
+    # the whole export.
+
+    def __init__(self, path, palette_names=None, buffer_cells=EXPORT_BUFFER_CELLS):
+        self.path = path
+        self.palette_names = None if palette_names is None else np.asarray(palette_names, dtype=object)
+        self.buffer_cells = buffer_cells
+        self.image_count = 0
+        self.names = None  # Column names, fixed by the first image
+        self.cells = 0
+        self._buffer = []
+        self._buffered = 0
+        self._buffer_images = []  # Paths of the buffered images
+        self._first_image = 0  # Image number of the first buffered image
+
+    def write(self, image, arrays):
+        # Raises ValueError, having written nothing, if the result's columns
+        # differ from the first image's
+        columns = cell_columns(self.image_count, arrays)
+        if self.names is None:
+            self.names = list(columns)
+        elif list(columns) != self.names:
+            raise ValueError(f"{image}: result columns differ from the first image's")
+
+        count = len(columns["image"])
+        self._buffer.append(columns)
+        self._buffer_images.append(image)
+        self.image_count += 1
+        self._buffered += count
+        self.cells += count
+        if self._buffered >= self.buffer_cells:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        columns = {name: np.concatenate([part[name] for part in self._buffer]) for name in self.names}
+        self._write_columns(columns)
+        self._buffer = []
+        self._buffered = 0
+        self._buffer_images = []
+        self._first_image = self.image_count
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @abc.abstractmethod
+    def _write_columns(self, columns):
+        # Write out buffered columns; the buffered image paths are still set
+        pass
+
+    def _named(self, columns):
+        # Image paths, positions and palette names in place of indices
+        images = np.asarray(self._buffer_images, dtype=object)
+        named = {"image": images[columns["image"] - self._first_image]}
+        labels = [row_label(row) for row in range(int(columns["row"].max()) + 1)]
+        named["position"] = [f"{labels[row]}{col + 1}"
+                             for row, col in zip(columns["row"].tolist(), columns["col"].tolist())]
+        for name in self.names[1:]:
+            values = columns[name]
+            if name.startswith("match_") and self.palette_names is not None:
+                values = self.palette_names[values]
+            named[name] = values
+        return named
+
+
+class CsvExporter(ResultExporter):
+    def __init__(self, path, palette_names=None, buffer_cells=EXPORT_BUFFER_CELLS):
+        super().__init__(path, palette_names, buffer_cells)
+        self._file = open(path, "w", newline="", buffering=EXPORT_IO_BUFFER)
+        self._header = False
+
+    def _write_columns(self, columns):
+        named = self._named(columns)
+        text = io.StringIO()
+        writer = csv.writer(text)
+        if not self._header:
+            writer.writerow(named)
+            self._header = True
+        # Floats are rounded like the JSON Lines output (+ 0.0 turns -0.0 into 0.0)
+        values = [(np.round(v.astype(np.float64), 4) + 0.0).tolist() if isinstance(v, np.ndarray) and v.dtype.kind == "f"
+                  else (v.tolist() if isinstance(v, np.ndarray) else v) for v in named.values()]
+        writer.writerows(zip(*values))
+        self._file.write(text.getvalue())
+
+    def close(self):
+        super().close()
+        self._file.close()
+
+
+class NpzExporter(ResultExporter):
+    # Each column is spooled to a temporary file as raw array data; close()
+    # then streams them into one compressed .npz holding one array per column
+
+    def __init__(self, path, palette_names=None, buffer_cells=EXPORT_BUFFER_CELLS):
+        super().__init__(path, palette_names, buffer_cells)
+        self._spool = {}  # name -> (temporary file, dtype)
+        self._spool_dir = os.path.dirname(os.path.abspath(path))
+        self.images = []  # Every image path, for the "images" table
+
+    def _write_columns(self, columns):
+        self.images.extend(self._buffer_images)
+        for name, values in columns.items():
+            if name not in self._spool:
+                self._spool[name] = (tempfile.TemporaryFile(dir=self._spool_dir), values.dtype)
+            spool, dtype = self._spool[name]
+            spool.write(np.ascontiguousarray(values, dtype=dtype).tobytes())
+
+    def close(self):
+        super().close()
+        with zipfile.ZipFile(self.path, "w", zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+            for name, (spool, dtype) in self._spool.items():
+                header = {"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False,
+                          "shape": (self.cells,)}
+                spool.seek(0)
+                with archive.open(f"{name}.npy", "w", force_zip64=True) as member:
+                    np.lib.format.write_array_header_2_0(member, header)
+                    shutil.copyfileobj(spool, member, EXPORT_IO_BUFFER)
+                spool.close()
+            self._spool = {}
+
+            tables = {"images": np.asarray(self.images, dtype=str)}
+            if self.palette_names is not None:
+                tables["palette_names"] = self.palette_names.astype(str)
+            for name, values in tables.items():
+                with archive.open(f"{name}.npy", "w", force_zip64=True) as member:
+                    np.lib.format.write_array(member, values, allow_pickle=False)
+
+
+class ParquetExporter(ResultExporter):
+    # One Parquet row group per flushed buffer
+
+    def __init__(self, path, palette_names=None, buffer_cells=EXPORT_BUFFER_CELLS):
+        if pyarrow is None:
+            raise ValueError("Parquet export needs the pyarrow package")
+        super().__init__(path, palette_names, buffer_cells)
+        self._writer = None
+
+    def _write_columns(self, columns):
+        table = pyarrow.table({name: pyarrow.array(values) for name, values in self._named(columns).items()})
+        if self._writer is None:
+            self._writer = pyarrow.parquet.ParquetWriter(self.path, table.schema, compression="zstd")
+        self._writer.write_table(table)
+
+    def close(self):
+        super().close()
+        if self._writer is not None:
+            self._writer.close()
+
+
+EXPORTERS = {".csv": CsvExporter, ".npz": NpzExporter, ".parquet": ParquetExporter}
+
+
+def open_exporter(path, palette_names=None, buffer_cells=EXPORT_BUFFER_CELLS):
+    # Exporter for the format named by the file extension
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in EXPORTERS:
+        raise ValueError(f"Unknown export format for {path}: use {', '.join(EXPORTERS)}")
+    return EXPORTERS[extension](path, palette_names, buffer_cells)
@@ -0,0 +1,132 @@
+import tkinter as tk
+from tkinter import ttk
+
+# A Treeview that only materializes the rows currently on screen. The data
+# stays in the caller's arrays; row_values(i) formats row i on demand, so the
+# cost of showing results is bounded by the viewport, not the plate size.
+
+
+def swatch_tag(hex_color, bits=4):
+    # Quantize "#RRGGBB" to a shared tag name and its representative color so
+    # at most 2 ** (3 * bits) background tags ever exist
+    shift = 8 - bits
+    r, g, b = (int(hex_color[i:i + 2], 16) >> shift << shift for i in (1, 3, 5))
+    return f"swatch_{r:02X}{g:02X}{b:02X}", f"#{r:02X}{g:02X}{b:02X}"
+
+
+class VirtualResultsView:
+    DEFAULT_ROW_HEIGHT = 20
+
+    def __init__(self, parent, columns, height=30, on_select=None):
+        self.count = 0
+        self.offset = 0
+        self.row_values = None
+        self.selected_row = None
+        self.on_select = on_select
+        self.swatch_tags = set()
+
+        self.frame = tk.Frame(parent)
+        self.tree = ttk.Treeview(self.frame, columns=columns, show="headings", height=height,
+                                 selectmode="browse")
+        self.scrollbar = ttk.Scrollbar(self.frame, orient=tk.VERTICAL, command=self.yview)
+
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+
+        # One Treeview item per visible line, reused while scrolling
+        self.items = []
+        self.set_visible_rows(height)
+
+        self.tree.bind("<ButtonRelease-1>", self.on_click)
+        self.tree.bind("<Configure>", self.on_configure)
+        self.tree.bind("<MouseWheel>", self.on_mousewheel)
+        self.tree.bind("<Button-4>", lambda event: self.scroll(-3))
+        self.tree.bind("<Button-5>", lambda event: self.scroll(3))
+        self.tree.bind("<Prior>", lambda event: self.scroll(-len(self.items)))
+        self.tree.bind("<Next>", lambda event: self.scroll(len(self.items)))
+
+    def pack(self, **kwargs):
+        self.frame.pack(**kwargs)
+
+    def set_visible_rows(self, visible):
+        visible = max(1, visible)
+        while len(self.items) < visible:
+            self.items.append(self.tree.insert("", "end", values=()))
+        while len(self.items) > visible:
+            self.tree.delete(self.items.pop())
+        self.tree.configure(height=visible)
+
+    def set_rows(self, count, row_values):
+        # row_values(i) -> (values tuple, "#RRGGBB" swatch color or None)
+        self.count = count
+        self.row_values = row_values
+        self.selected_row = None
+        self.offset = 0
+        self.refresh()
+
+    def clear(self):
+        self.set_rows(0, None)
+
+    def refresh(self):
+        visible = len(self.items)
+        self.offset = max(0, min(self.offset, self.count - visible))
+        self.tree.selection_set(())
+
+        for line, item_id in enumerate(self.items):
+            row = self.offset + line
+            if row >= self.count:
+                self.tree.item(item_id, values=(), tags=())
+                continue
+
+            values, color = self.row_values(row)
+            tags = ()
+            if color:
+                tag, swatch = swatch_tag(color)
+                if tag not in self.swatch_tags:
+                    self.tree.tag_configure(tag, background=swatch)
+                    self.swatch_tags.add(tag)
+                tags = (tag,)
+            self.tree.item(item_id, values=values, tags=tags)
+            if row == self.selected_row:
+                self.tree.selection_set(item_id)
+
+        if self.count:
+            self.scrollbar.set(self.offset / self.count, min(1.0, (self.offset + visible) / self.count))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+
+    def scroll(self, lines):
+        self.offset += lines
+        self.refresh()
+
+    def yview(self, *args):
+        # Scrollbar protocol: ("moveto", fraction) or ("scroll", n, "units"/"pages")
+        if args[0] == "moveto":
+            self.offset = int(float(args[1]) * self.count)
+        elif args[0] == "scroll":
+            step = len(self.items) if args[2] == "pages" else 1
+            self.offset += int(args[1]) * step
+        self.refresh()
+
+    def on_mousewheel(self, event):
+        self.scroll(-3 if event.delta > 0 else 3)
+
+    def on_configure(self, event):
+        style = ttk.Style()
+        row_height = int(style.lookup("Treeview", "rowheight") or self.DEFAULT_ROW_HEIGHT)
+        # Leave room for the heading row
+        visible = event.height // row_height - 1
+        if visible > 0 and visible != len(self.items):
+            self.set_visible_rows(visible)
+            self.refresh()
+
+    def on_click(self, event):
+        item_id = self.tree.focus()
+        if item_id not in self.items:
+            return
+        row = self.offset + self.items.index(item_id)
+        if row >= self.count:
+            return
+        self.selected_row = row
+        if self.on_select:
+            self.on_select(row)
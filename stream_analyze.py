@@ -0,0 +1,154 @@
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+
+from batch_analyze import parse_color, parse_corners, parse_roi, parse_window, result_record
+from color_metrics import METRICS
+from frame_stream import (CellTracker, folder_frames, prefetch, track, video_frames, CHANGE_THRESHOLD,
+                          WATCH_POLL_SECONDS)
+from grid_detection import MIN_CONFIDENCE, detect_grid
+from grid_sampling import SAMPLE_SIZE
+from palette_index import get_palette_index
+from result_export import open_exporter
+
+# Follows a color-change assay over time: analyzes every new image saved to
+# a folder, or every frame of a video, with one fixed grid, and writes one
+# JSON Lines record per frame. Only cells that changed are re-sampled.
+
+
+def frame_record(frame, result, changed, confidence=None, palette=None):
+    # The batch record of the frame's result, plus when it was taken and
+    # which cells changed since their last sample
+    record = {"frame": frame.index, "time": round(frame.time, 4)}
+    record.update(result_record(frame.source, result, confidence, palette))
+    record["changed"] = [result.position(i) for i in changed.tolist()]
+    return record
+
+
+def run_stream(frames, output, tracker, palette=None, exporters=(), auto_grid=False,
+               min_confidence=MIN_CONFIDENCE):
+    # Writes a record per frame until the frames run out; returns how many
+    # there were. With auto_grid, the grid is detected in the first frame
+    # and kept for the rest.
+    confidence = None
+    if auto_grid:
+        first = next(frames, None)
+        if first is None:
+            return 0
+        detection = detect_grid(first.image)
+        if detection.confidence < min_confidence:
+            raise ValueError(f"No grid detected (confidence {detection.confidence:.2f})")
+        tracker.roi, tracker.rows, tracker.cols = detection.roi, detection.rows, detection.cols
+        confidence = detection.confidence
+        print(f"Detected {detection.rows} x {detection.cols} grid (confidence {confidence:.2f})",
+              file=sys.stderr)
+        frames = itertools.chain([first], frames)
+
+    done_count = 0
+    start = time.perf_counter()
+    for frame, result, changed in track(frames, tracker):
+        output.write(json.dumps(frame_record(frame, result, changed, confidence, palette)) + "\n")
+        output.flush()
+        if exporters:
+            arrays = result.to_arrays()
+            for exporter in exporters:
+                exporter.write(frame.source, arrays)
+        done_count += 1
+        if done_count % 100 == 0:
+            rate = done_count / (time.perf_counter() - start)
+            print(f"Analyzed {done_count} frames ({rate:.1f} frames/s)", file=sys.stderr)
+    return done_count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Analyze a color grid in every new image of a folder, or in every frame of a video.")
+    parser.add_argument("input", help="Folder to watch, or a video file")
+    parser.add_argument("-r", "--reference", type=parse_color, action="append",
+                        help="Reference color as #RRGGBB or R,G,B (repeatable)")
+    parser.add_argument("--palette", help="Palette file (CSV/TSV/JSON of names and colors, or a saved .npz index)")
+    parser.add_argument("--top-k", type=int, default=3, help="Palette matches reported per cell")
+    parser.add_argument("--roi", type=parse_roi, help="Grid rectangle x1,y1,x2,y2 in image pixels (default: whole image)")
+    parser.add_argument("--corners", type=parse_corners,
+                        help="Skewed grid as its four outer corners x1,y1,...,x4,y4, clockwise from A1 (instead of --roi)")
+    parser.add_argument("--rows", type=int, default=8)
+    parser.add_argument("--cols", type=int, default=12)
+    parser.add_argument("--window", type=parse_window, default=(SAMPLE_SIZE, None),
+                        help="Pixels averaged per cell: width in pixels (7) or share of the cell (80%%)")
+    parser.add_argument("--metric", choices=METRICS, default="rgb", help="Color difference metric")
+    parser.add_argument("--threshold", type=float, default=CHANGE_THRESHOLD,
+                        help="Re-sample a cell once its color moves this far on any channel, 0-255 "
+                             "(default %(default)s; 0 re-samples any cell whose pixels changed at all)")
+    parser.add_argument("-o", "--output", help="JSON Lines output file (default: stdout)")
+    parser.add_argument("--export", action="append", metavar="FILE",
+                        help="Also write a per-cell table as .csv, .npz or .parquet (repeatable)")
+    parser.add_argument("--auto-grid", action="store_true",
+                        help="Detect the grid rectangle, rows and cols in the first frame")
+    parser.add_argument("--min-confidence", type=float, default=MIN_CONFIDENCE,
+                        help="With --auto-grid, stop if the first frame's grid detection is less confident "
+                             f"(default: {MIN_CONFIDENCE})")
+    parser.add_argument("--every", type=int, default=1, help="Video: analyze every Nth frame")
+    parser.add_argument("--poll", type=float, default=WATCH_POLL_SECONDS, help="Folder: seconds between checks")
+    parser.add_argument("--idle-timeout", type=float,
+                        help="Folder: stop after this many seconds without a new image (default: run until Ctrl+C)")
+    parser.add_argument("--new-only", action="store_true", help="Folder: skip the images already there")
+    args = parser.parse_args(argv)
+
+    if args.rows <= 0 or args.cols <= 0:
+        parser.error("rows and cols must be positive")
+    if not args.reference and not args.palette:
+        parser.error("Give at least one --reference color or a --palette")
+    if args.top_k <= 0:
+        parser.error("top-k must be positive")
+    if args.every <= 0:
+        parser.error("every must be positive")
+    if args.threshold < 0:
+        parser.error("threshold must not be negative")
+    if sum(bool(option) for option in (args.roi, args.corners, args.auto_grid)) > 1:
+        parser.error("Use only one of --roi, --corners and --auto-grid")
+    if not os.path.exists(args.input):
+        parser.error(f"No such folder or file: {args.input}")
+
+    if os.path.isdir(args.input):
+        frames = folder_frames(args.input, args.poll, args.idle_timeout, existing=not args.new_only)
+    else:
+        frames = video_frames(args.input, args.every)
+
+    palette = get_palette_index(args.palette) if args.palette else None
+    sample_size, sample_fraction = args.window
+    tracker = CellTracker(args.roi, args.rows, args.cols, args.reference, sample_size, sample_fraction,
+                          args.metric, palette, args.top_k, args.corners, args.threshold)
+    exporters = []
+    try:
+        for path in args.export or ():
+            exporters.append(open_exporter(path, palette.names if palette is not None else None))
+    except (OSError, ValueError) as e:
+        for exporter in exporters:
+            exporter.close()
+        parser.error(str(e))
+
+    start = time.perf_counter()
+    output = open(args.output, "w") if args.output else sys.stdout
+    try:
+        run_stream(prefetch(frames), output, tracker, palette, exporters, args.auto_grid, args.min_confidence)
+    except KeyboardInterrupt:
+        pass
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    finally:
+        if args.output:
+            output.close()
+        for exporter in exporters:
+            exporter.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"Analyzed {tracker.frames} frames in {elapsed:.2f}s", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from color_metrics import (color_similarity, delta_e_2000, delta_e_76, delta_e_94, rgb_to_lab,
+                           similarity_matrix)
+
+# The color difference metrics against published and hand-computed values.
+
+# Sharma, Wu and Dalal (2005), "The CIEDE2000 color-difference formula":
+# (L1, a1, b1, L2, a2, b2, Delta-E 2000)
+SHARMA_PAIRS = np.array([
+    [50.0000, 2.6772, -79.7751, 50.0000, 0.0000, -82.7485, 2.0425],
+    [50.0000, 3.1571, -77.2803, 50.0000, 0.0000, -82.7485, 2.8615],
+    [50.0000, 2.8361, -74.0200, 50.0000, 0.0000, -82.7485, 3.4412],
+    [50.0000, -1.3802, -84.2814, 50.0000, 0.0000, -82.7485, 1.0000],
+    [50.0000, -1.1848, -84.8006, 50.0000, 0.0000, -82.7485, 1.0000],
+    [50.0000, -0.9009, -85.5211, 50.0000, 0.0000, -82.7485, 1.0000],
+    [50.0000, 0.0000, 0.0000, 50.0000, -1.0000, 2.0000, 2.3669],
+    [50.0000, -1.0000, 2.0000, 50.0000, 0.0000, 0.0000, 2.3669],
+    [50.0000, 2.4900, -0.0010, 50.0000, -2.4900, 0.0009, 7.1792],
+    [50.0000, 2.4900, -0.0010, 50.0000, -2.4900, 0.0010, 7.1792],
+    [50.0000, 2.4900, -0.0010, 50.0000, -2.4900, 0.0011, 7.2195],
+    [50.0000, 2.4900, -0.0010, 50.0000, -2.4900, 0.0012, 7.2195],
+    [50.0000, -0.0010, 2.4900, 50.0000, 0.0009, -2.4900, 4.8045],
+    [50.0000, -0.0010, 2.4900, 50.0000, 0.0010, -2.4900, 4.8045],
+    [50.0000, -0.0010, 2.4900, 50.0000, 0.0011, -2.4900, 4.7461],
+    [50.0000, 2.5000, 0.0000, 50.0000, 0.0000, -2.5000, 4.3065],
+    [50.0000, 2.5000, 0.0000, 73.0000, 25.0000, -18.0000, 27.1492],
+    [50.0000, 2.5000, 0.0000, 61.0000, -5.0000, 29.0000, 22.8977],
+    [50.0000, 2.5000, 0.0000, 56.0000, -27.0000, -3.0000, 31.9030],
+    [50.0000, 2.5000, 0.0000, 58.0000, 24.0000, 15.0000, 19.4535],
+    [50.0000, 2.5000, 0.0000, 50.0000, 3.1736, 0.5854, 1.0000],
+    [50.0000, 2.5000, 0.0000, 50.0000, 3.2972, 0.0000, 1.0000],
+    [50.0000, 2.5000, 0.0000, 50.0000, 1.8634, 0.5757, 1.0000],
+    [50.0000, 2.5000, 0.0000, 50.0000, 3.2592, 0.3350, 1.0000],
+    [60.2574, -34.0099, 36.2677, 60.4626, -34.1751, 39.4387, 1.2644],
+    [63.0109, -31.0961, -5.8663, 62.8187, -29.7946, -4.0864, 1.2630],
+    [61.2901, 3.7196, -5.3901, 61.4292, 2.2480, -4.9620, 1.8731],
+    [35.0831, -44.1164, 3.7933, 35.0232, -40.0716, 1.5901, 1.8645],
+    [22.7233, 20.0904, -46.6940, 23.0331, 14.9730, -42.5619, 2.0373],
+    [36.4612, 47.8580, 18.3852, 36.2715, 50.5065, 21.2231, 1.4146],
+    [90.8027, -2.0831, 1.4410, 91.1528, -1.6435, 0.0447, 1.4441],
+    [90.9257, -0.5406, -0.9208, 88.6381, -0.8985, -0.7239, 1.5381],
+    [6.7747, -0.2908, -2.4247, 5.8714, -0.0985, -2.2286, 0.6377],
+    [2.0776, 0.0795, -1.1350, 0.9033, -0.0636, -0.5514, 0.9082],
+])
+
+
+def test_ciede2000_sharma_pairs():
+    reference, lab, expected = SHARMA_PAIRS[:, :3], SHARMA_PAIRS[:, 3:6], SHARMA_PAIRS[:, 6]
+    np.testing.assert_allclose(delta_e_2000(lab, reference), expected, atol=1e-4)
+    # The formula is symmetric
+    np.testing.assert_allclose(delta_e_2000(reference, lab), expected, atol=1e-4)
+
+
+def test_ciede2000_identical_colors():
+    lab = SHARMA_PAIRS[:, :3]
+    np.testing.assert_allclose(delta_e_2000(lab, lab), 0, atol=1e-12)
+
+
+def test_cie94_spot_checks():
+    reference = np.array([50.0, 10.0, 0.0])
+    # Lightness alone: S_L = 1
+    np.testing.assert_allclose(delta_e_94(np.array([60.0, 10.0, 0.0]), reference), 10.0)
+    # Chroma alone: S_C = 1 + 0.045 * C_ref = 1.45
+    np.testing.assert_allclose(delta_e_94(np.array([50.0, 20.0, 0.0]), reference), 10 / 1.45)
+    # Hue alone, at equal chroma: S_H = 1 + 0.015 * C_ref = 1.15
+    np.testing.assert_allclose(delta_e_94(np.array([50.0, 0.0, 10.0]), reference), np.sqrt(200) / 1.15)
+    # Chroma weighting follows the reference, so the metric is not symmetric
+    np.testing.assert_allclose(delta_e_94(reference, np.array([50.0, 20.0, 0.0])), 10 / 1.9)
+
+
+def test_cie76_spot_checks():
+    np.testing.assert_allclose(delta_e_76(np.array([73.0, 25.0, -18.0]), np.array([50.0, 2.5, 0.0])),
+                               np.sqrt(23 ** 2 + 22.5 ** 2 + 18 ** 2))
+    np.testing.assert_allclose(delta_e_76(np.array([100.0, 0.0, 0.0]), np.zeros(3)), 100.0)
+
+
+def test_rgb_to_lab_known_colors():
+    colors = np.array([[0, 0, 0], [255, 255, 255], [255, 0, 0], [0, 255, 0], [0, 0, 255]], dtype=np.uint8)
+    expected = np.array([[0.0, 0.0, 0.0], [100.0, 0.0, 0.0], [53.2408, 80.0925, 67.2032],
+                         [87.7347, -86.1827, 83.1793], [32.2970, 79.1875, -107.8602]])
+    np.testing.assert_allclose(rgb_to_lab(colors), expected, atol=2e-3)
+
+
+def test_similarity_scales():
+    colors = np.array([[200, 30, 30], [0, 0, 0], [255, 255, 255]], dtype=np.uint8)
+    reference = np.array([200, 30, 30], dtype=np.uint8)
+    for metric in ("rgb", "cie76", "cie94", "ciede2000"):
+        similarity = color_similarity(colors, reference, metric)
+        assert similarity[0] == 100
+        assert ((similarity >= 0) & (similarity <= 100)).all()
+    # Black vs. white: the largest RGB distance, and a Delta-E of 100
+    black_white = similarity_matrix(colors[1:2], colors[2:3], "rgb")
+    np.testing.assert_allclose(black_white, 0, atol=1e-12)
+    np.testing.assert_allclose(similarity_matrix(colors[1:2], colors[2:3], "cie76"), 0, atol=1e-2)
@@ -0,0 +1,93 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from frame_stream import CellTracker
+from grid_analysis import analyze_grid
+from palette_index import PaletteIndex
+
+# CellTracker against analyze_grid run from scratch on every frame. Cells
+# the tracker skips have the same pixels as before, so its results must be
+# identical, on the first frame and after cells change.
+
+REFERENCES = [(200, 30, 40), (10, 200, 30)]
+ROI = (40, 30, 620, 450)
+CORNERS = [(60, 40), (610, 70), (590, 460), (30, 430)]
+
+GRIDS = [
+    {"roi": ROI, "sample_size": 3},
+    {"roi": ROI, "sample_size": 9},  # Above ImageSampler.GATHER_MAX_AREA
+    {"roi": ROI, "sample_size": None, "sample_fraction": 0.5},
+    {"roi": None, "corners": CORNERS, "sample_size": 3},
+    {"roi": None, "corners": CORNERS, "sample_size": None, "sample_fraction": 0.6},
+]
+
+
+def random_frame(seed=0):
+    return np.random.default_rng(seed).integers(0, 256, (480, 640, 3), dtype=np.uint8)
+
+
+def small_palette():
+    colors = np.random.default_rng(1).integers(0, 256, (40, 3), dtype=np.uint8)
+    return PaletteIndex([f"color {i}" for i in range(len(colors))], colors)
+
+
+def check_same(result, expected):
+    assert tuple(result.roi) == tuple(expected.roi)
+    np.testing.assert_array_equal(result.colors, expected.colors)
+    np.testing.assert_array_equal(result.similarity, expected.similarity)
+    if expected.matches is not None:
+        np.testing.assert_array_equal(result.matches, expected.matches)
+        np.testing.assert_array_equal(result.match_distances, expected.match_distances)
+
+
+def paint_cells(frame, result, cells, color):
+    # A copy of frame with the given cells' boxes filled with one color
+    frame = frame.copy()
+    boxes = result.cell_boxes().astype(int)
+    for cell in cells:
+        x1, y1, x2, y2 = boxes[cell]
+        frame[y1:y2, x1:x2] = color
+    return frame
+
+
+def test_tracker_matches_analyze_grid():
+    palette = small_palette()
+    rows, cols = 8, 12
+    for grid in GRIDS:
+        for metric in ("rgb", "ciede2000"):
+            options = dict(grid, metric=metric, palette=palette)
+            tracker = CellTracker(options.pop("roi"), rows, cols, REFERENCES, **options)
+            frame = random_frame()
+            result, changed = tracker.update(frame)
+            expected = analyze_grid(frame, grid["roi"], rows, cols, REFERENCES, metric=metric, palette=palette,
+                                    **{k: v for k, v in grid.items() if k != "roi"})
+            assert len(changed) == rows * cols
+            check_same(result, expected)
+
+            painted = [0, 5, 50, rows * cols - 1]
+            frame = paint_cells(frame, expected, painted, (0, 255, 0))
+            result, changed = tracker.update(frame)
+            expected = analyze_grid(frame, grid["roi"], rows, cols, REFERENCES, metric=metric, palette=palette,
+                                    **{k: v for k, v in grid.items() if k != "roi"})
+            assert set(painted) <= set(changed.tolist())
+            check_same(result, expected)
+
+            result, changed = tracker.update(frame)
+            assert len(changed) == 0
+            check_same(result, expected)
+
+
+def test_unchanged_frame_keeps_results():
+    tracker = CellTracker(ROI, 8, 12, REFERENCES)
+    frame = random_frame(seed=3)
+    first, _ = tracker.update(frame)
+    # Noise below the change threshold is not re-sampled
+    noisy = np.clip(frame.astype(int) + 2, 0, 255).astype(np.uint8)
+    result, changed = tracker.update(noisy)
+    assert len(changed) == 0
+    np.testing.assert_array_equal(result.colors, first.colors)
+    assert tracker.frames == 2
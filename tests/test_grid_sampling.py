@@ -0,0 +1,86 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from grid_sampling import (ImageSampler, build_integral_image, integral_cell_means, sample_cell_means,
+                           window_bounds)
+
+# The summed-area table path of ImageSampler against direct gather means.
+# The table is uint32 and relies on wrap-around arithmetic, so both paths
+# must agree exactly, also where the table's sums overflow.
+
+
+def random_image(height, width, seed=0):
+    return np.random.default_rng(seed).integers(0, 256, (height, width, 3), dtype=np.uint8)
+
+
+def check_paths_agree(array, center_x, center_y, half_x, half_y):
+    expected = sample_cell_means(array, center_x, center_y, half_x, half_y)
+    np.testing.assert_array_equal(ImageSampler(array).sample(center_x, center_y, half_x, half_y, "integral"),
+                                  expected)
+    np.testing.assert_array_equal(ImageSampler(array).sample(center_x, center_y, half_x, half_y), expected)
+
+
+def test_windows_inside_the_image():
+    array = random_image(300, 400)
+    center_x, center_y = np.arange(50, 360, 31), np.arange(40, 260, 27)
+    for half_x, half_y in ((0, 0), (3, 3), (4, 2), (10, 10), (14, 9)):
+        check_paths_agree(array, center_x, center_y, half_x, half_y)
+
+
+def test_windows_at_image_edges():
+    array = random_image(120, 160, seed=1)
+    center_x = np.array([0, 1, 5, 80, 154, 158, 159])
+    center_y = np.array([0, 2, 60, 117, 119])
+    for half_x, half_y in ((3, 3), (6, 4), (12, 12), (40, 30)):
+        check_paths_agree(array, center_x, center_y, half_x, half_y)
+
+
+def test_windows_above_the_gather_limit():
+    array = random_image(500, 600, seed=2)
+    half = 20
+    assert (2 * half + 1) ** 2 > ImageSampler.GATHER_MAX_AREA
+    center_x, center_y = np.arange(20, 600, 45), np.arange(15, 500, 40)
+    check_paths_agree(array, center_x, center_y, half, half)
+    check_paths_agree(array, center_x, center_y, half, 5)
+
+
+def test_table_covers_only_the_requested_windows():
+    array = random_image(400, 500, seed=3)
+    sampler = ImageSampler(array)
+    center_x, center_y = np.arange(200, 320, 20), np.arange(150, 250, 20)
+    colors = sampler.sample(center_x, center_y, 8, 8, "integral")
+    np.testing.assert_array_equal(colors, sample_cell_means(array, center_x, center_y, 8, 8))
+    bounds, table = sampler.integral_table(window_bounds(center_x, center_y, 8, 8, sampler.size))
+    assert bounds == (192, 142, 309, 239)
+    assert table.shape == (239 - 142 + 1, 309 - 192 + 1, 3)
+
+    # Windows inside the table reuse it; others build a new one
+    colors = sampler.sample(center_x[1:3], center_y[1:3], 5, 5, "integral")
+    np.testing.assert_array_equal(colors, sample_cell_means(array, center_x[1:3], center_y[1:3], 5, 5))
+    assert sampler.integral_table(bounds)[1] is table
+    colors = sampler.sample(np.array([10, 490]), np.array([5, 395]), 9, 9, "integral")
+    np.testing.assert_array_equal(colors, sample_cell_means(array, np.array([10, 490]), np.array([5, 395]), 9, 9))
+    assert sampler.integral_table(bounds)[1] is not table
+
+
+def test_sums_that_wrap_around():
+    # Over 2**32 / 255 bright pixels, so the table's later sums overflow
+    # uint32 and only their differences are exact
+    height, width = 4200, 4200
+    array = np.full((height, width, 3), 255, dtype=np.uint8)
+    array[-300:, -300:] = random_image(300, 300, seed=4)
+    table = build_integral_image(array)
+    assert int(array[..., 0].sum(dtype=np.int64)) >= 2 ** 32
+    assert table[-1, -1, 0] == int(array[..., 0].sum(dtype=np.int64)) % 2 ** 32
+
+    center_x = np.array([0, 2000, width - 200, width - 40, width - 1])
+    center_y = np.array([0, 2100, height - 150, height - 30, height - 1])
+    for half in (3, 25, 90):
+        expected = sample_cell_means(array, center_x, center_y, half, half)
+        np.testing.assert_array_equal(integral_cell_means(table, center_x, center_y, half, half), expected)
+        np.testing.assert_array_equal(ImageSampler(array).sample(center_x, center_y, half, half, "integral"),
+                                      expected)
@@ -0,0 +1,120 @@
+import functools
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import multi_grid
+from grid_analysis import analyze_grid
+from multi_grid import PlateGrid, analyze_plates, merged_ranking
+from palette_index import PaletteIndex
+from tiled_raster import open_raster
+
+# Plates of a tray analyzed by analyze_plates, in this process and in
+# worker processes started by fork and by spawn, against analyze_grid run
+# on each plate of the whole image.
+
+REFERENCES = [(200, 30, 40), (10, 200, 30)]
+
+PLATES = [
+    PlateGrid("A", 8, 12, roi=(20, 15, 640, 430)),
+    PlateGrid("B", 16, 24, corners=[(720, 30), (1370, 60), (1350, 440), (700, 420)]),
+    PlateGrid("C", 8, 12, roi=(30, 470, 660, 880)),
+    PlateGrid("D", 16, 24, corners=[(705, 480), (1380, 470), (1390, 890), (690, 870)]),
+]
+
+
+def tray_pixels(seed=0):
+    return np.random.default_rng(seed).integers(0, 256, (900, 1400, 3), dtype=np.uint8)
+
+
+def expected_results(array, sample_size, sample_fraction, palette=None):
+    results = []
+    for plate in PLATES:
+        result = analyze_grid(array, plate.roi, plate.rows, plate.cols, REFERENCES, sample_size=sample_size,
+                              sample_fraction=sample_fraction, metric="cie76", palette=palette,
+                              corners=plate.corners)
+        results.append(result)
+    return results
+
+
+def check_same(results, expected):
+    assert len(results) == len(expected)
+    for result, plate_expected in zip(results, expected):
+        assert tuple(result.roi) == tuple(plate_expected.roi)
+        np.testing.assert_array_equal(result.colors, plate_expected.colors)
+        np.testing.assert_allclose(result.similarity, plate_expected.similarity)
+        if plate_expected.matches is not None:
+            np.testing.assert_array_equal(result.matches, plate_expected.matches)
+
+
+@pytest.mark.parametrize("sample_size, sample_fraction", [(3, None), (None, 0.7)])
+def test_in_process_matches_analyze_grid(sample_size, sample_fraction):
+    array = tray_pixels()
+    colors = np.random.default_rng(1).integers(0, 256, (40, 3), dtype=np.uint8)
+    palette = PaletteIndex([f"color {i}" for i in range(len(colors))], colors)
+    results = analyze_plates(array, PLATES, REFERENCES, sample_size, sample_fraction, metric="cie76",
+                             palette=palette, workers=1)
+    check_same(results, expected_results(array, sample_size, sample_fraction, palette))
+
+
+@pytest.mark.parametrize("method", ["fork", "spawn"])
+def test_worker_processes_match_analyze_grid(method):
+    if method not in multiprocessing.get_all_start_methods():
+        pytest.skip(f"No {method} start method here")
+    array = tray_pixels(seed=2)
+    with ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context(method)) as executor:
+        for sample_size, sample_fraction in ((3, None), (None, 0.7)):
+            results = analyze_plates(array, PLATES, REFERENCES, sample_size, sample_fraction, metric="cie76",
+                                     executor=executor)
+            check_same(results, expected_results(array, sample_size, sample_fraction))
+
+
+def test_image_file_matches_analyze_grid(tmp_path):
+    array = tray_pixels(seed=3)
+    path = str(tmp_path / "tray.png")
+    Image.fromarray(array).save(path)
+    for workers in (1, 2):
+        results = analyze_plates(path, PLATES, REFERENCES, metric="cie76", workers=workers)
+        check_same(results, expected_results(array, 3, None))
+
+
+def test_tiled_scan_matches_analyze_grid(tmp_path, monkeypatch):
+    # Workers read their own plate's tiles instead of a shared array. The
+    # scan is far below TILED_MIN_PIXELS, so tiled reading is forced here
+    # and in forked workers.
+    tifffile = pytest.importorskip("tifffile")
+    if "fork" not in multiprocessing.get_all_start_methods():
+        pytest.skip("No fork start method here")
+    monkeypatch.setattr(multi_grid, "open_raster", functools.partial(open_raster, min_pixels=1))
+    array = tray_pixels(seed=4)
+    path = str(tmp_path / "tray.tif")
+    tifffile.imwrite(path, array, tile=(128, 128))
+    with open_raster(path, min_pixels=1) as raster:
+        assert raster is not None
+    results = analyze_plates(path, PLATES, REFERENCES, None, 0.7, metric="cie76", workers=1)
+    check_same(results, expected_results(array, None, 0.7))
+    with ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context("fork")) as executor:
+        results = analyze_plates(path, PLATES, REFERENCES, None, 0.7, metric="cie76", executor=executor)
+    check_same(results, expected_results(array, None, 0.7))
+
+
+def test_merged_ranking_orders_all_plates():
+    results = analyze_plates(tray_pixels(), PLATES, REFERENCES, metric="cie76", workers=1)
+    similarity = np.concatenate([result.similarity[1] for result in results])
+    expected = np.argsort(-similarity, kind="stable")[:20]
+
+    plate_ids, cell_ids = merged_ranking(results, reference_index=1, top=20)
+    ranked = [results[plate].similarity[1, cell] for plate, cell in zip(plate_ids, cell_ids)]
+    np.testing.assert_array_equal(ranked, similarity[expected])
+    assert np.all(np.diff(ranked) <= 0)
+
+    plate_ids, cell_ids = merged_ranking(results, min_similarity=0.5)
+    assert all(results[plate].similarity[0, cell] >= 0.5 for plate, cell in zip(plate_ids, cell_ids))
+    assert len(plate_ids) == int((np.concatenate([result.similarity[0] for result in results]) >= 0.5).sum())
@@ -0,0 +1,79 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from color_metrics import rgb_to_lab
+from palette_index import PaletteIndex
+
+# PaletteIndex.query against a brute-force search of the whole palette. The
+# palettes are dense clusters around a few brand colors, where a bin's short
+# candidate list is most likely to miss the true nearest entries.
+
+
+def clustered_palette(count, clusters=6, spread=6, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.integers(30, 226, (clusters, 3))
+    colors = centers[rng.integers(0, clusters, count)] + rng.integers(-spread, spread + 1, (count, 3))
+    colors = np.clip(colors, 0, 255).astype(np.uint8)
+    return [f"color {i}" for i in range(count)], colors, centers
+
+
+def brute_force(palette_colors, colors, k):
+    diff = rgb_to_lab(colors)[:, None, :] - rgb_to_lab(palette_colors)[None, :, :]
+    return np.sort(np.sqrt((diff * diff).sum(axis=-1)), axis=1)[:, :k]
+
+
+def check_queries(index, palette_colors, colors, k):
+    ids, delta_e = index.query(colors, k)
+    assert ids.shape == delta_e.shape == (len(colors), k)
+    np.testing.assert_allclose(delta_e, brute_force(palette_colors, colors, k), atol=1e-9)
+    # The reported distances belong to the reported entries
+    diff = rgb_to_lab(colors)[:, None, :] - index.lab[ids]
+    np.testing.assert_allclose(delta_e, np.sqrt((diff * diff).sum(axis=-1)), atol=1e-9)
+
+
+def test_clustered_palette_near_brand_colors():
+    names, palette_colors, centers = clustered_palette(3000)
+    index = PaletteIndex(names, palette_colors)
+    rng = np.random.default_rng(1)
+    colors = centers[rng.integers(0, len(centers), 4000)] + rng.integers(-12, 13, (4000, 3))
+    colors = np.clip(colors, 0, 255).astype(np.uint8)
+    for k in (1, 3):
+        check_queries(index, palette_colors, colors, k)
+
+
+def test_clustered_palette_random_colors():
+    names, palette_colors, _ = clustered_palette(3000, seed=2)
+    index = PaletteIndex(names, palette_colors)
+    colors = np.random.default_rng(3).integers(0, 256, (4000, 3)).astype(np.uint8)
+    check_queries(index, palette_colors, colors, 1)
+    check_queries(index, palette_colors, colors, 5)
+
+
+def test_more_matches_than_candidates():
+    names, palette_colors, _ = clustered_palette(300, seed=4)
+    index = PaletteIndex(names, palette_colors, candidates=8)
+    colors = np.random.default_rng(5).integers(0, 256, (500, 3)).astype(np.uint8)
+    check_queries(index, palette_colors, colors, 12)
+
+
+def test_small_palette_is_searched_whole():
+    names, palette_colors, _ = clustered_palette(20, seed=6)
+    index = PaletteIndex(names, palette_colors)
+    assert index.candidates == 20 and np.isinf(index.reach).all()
+    colors = np.random.default_rng(7).integers(0, 256, (500, 3)).astype(np.uint8)
+    check_queries(index, palette_colors, colors, 3)
+
+
+def test_saved_index_matches(tmp_path):
+    names, palette_colors, _ = clustered_palette(1000, seed=8)
+    index = PaletteIndex(names, palette_colors)
+    path = str(tmp_path / "palette.npz")
+    index.save(path)
+    loaded = PaletteIndex.load(path)
+    np.testing.assert_array_equal(loaded.reach, index.reach)
+    colors = np.random.default_rng(9).integers(0, 256, (1000, 3)).astype(np.uint8)
+    check_queries(loaded, palette_colors, colors, 2)
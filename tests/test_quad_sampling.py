@@ -0,0 +1,80 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from grid_analysis import analyze_grid, extract_cell_colors, extract_quad_colors
+from grid_sampling import ImageSampler
+
+# A four-corner grid whose corners are an upright rectangle must sample the
+# same cells as that rectangle given as a roi.
+
+REFERENCES = [(200, 30, 40), (10, 200, 30)]
+
+
+def rectangle_corners(roi):
+    x1, y1, x2, y2 = roi
+    return np.array([(x1, y1), (x2, y1), (x2, y2), (x1, y2)], dtype=np.float64)
+
+
+def random_image(height, width, seed=0):
+    return np.random.default_rng(seed).integers(0, 256, (height, width, 3), dtype=np.uint8)
+
+
+def solid_plate(roi, rows, cols, size=(1000, 700), seed=0):
+    # Cells of one random color each, with background gaps between them, on
+    # an roi whose cell edges fall between pixels
+    rng = np.random.default_rng(seed)
+    colors = rng.integers(0, 256, (rows, cols, 3), dtype=np.uint8)
+    array = np.full((size[1], size[0], 3), 235, dtype=np.uint8)
+    x1, y1, x2, y2 = roi
+    cell_width, cell_height = (x2 - x1) / cols, (y2 - y1) / rows
+    for row in range(rows):
+        for col in range(cols):
+            left, top = x1 + col * cell_width, y1 + row * cell_height
+            array[int(top + 0.15 * cell_height):int(top + 0.85 * cell_height),
+                  int(left + 0.15 * cell_width):int(left + 0.85 * cell_width)] = colors[row, col]
+    return array, colors
+
+
+def test_pixel_aligned_rectangle_matches_exactly():
+    # Even cell sizes put every cell center and window point on a pixel, so
+    # the bilinear samples are the pixels the rectangular gather averages
+    array = random_image(600, 800)
+    for roi, rows, cols in (((100, 50, 580, 370), 8, 12), ((10, 20, 490, 404), 16, 24)):
+        for window in ({"sample_size": 0}, {"sample_size": 3}, {"sample_size": 7},
+                       {"sample_size": None, "sample_fraction": 0.5}):
+            if window.get("sample_fraction") and (roi[2] - roi[0]) / cols > 30:
+                continue  # Wider than QUAD_SAMPLES_MAX points: averaged from a subset
+            expected = analyze_grid(array, roi, rows, cols, REFERENCES, metric="ciede2000", **window)
+            result = analyze_grid(ImageSampler(array), None, rows, cols, REFERENCES, metric="ciede2000",
+                                  corners=rectangle_corners(roi), **window)
+            assert result.roi == expected.roi
+            np.testing.assert_array_equal(result.colors, expected.colors)
+            np.testing.assert_allclose(result.similarity, expected.similarity)
+
+
+def test_rectangle_recovers_the_same_cell_colors():
+    # Fractional cell sizes: the quad path samples around the exact centers
+    # the rectangle path truncates, both inside each cell's solid color
+    for roi, rows, cols in (((103, 61, 897, 634), 8, 12), ((51, 40, 950, 655), 16, 24)):
+        array, colors = solid_plate(roi, rows, cols)
+        sampler = ImageSampler(array)
+        for sample_size, sample_fraction in ((0, None), (3, None), (None, 0.4)):
+            rect = extract_cell_colors(sampler, roi, rows, cols, sample_size, sample_fraction)
+            quad = extract_quad_colors(sampler, rectangle_corners(roi), rows, cols, sample_size, sample_fraction)
+            np.testing.assert_array_equal(rect, colors)
+            # Bilinear weights of equal pixels can round a hair below the value
+            np.testing.assert_allclose(quad.astype(int), colors, atol=1)
+
+
+def test_progress_bands_match_one_pass():
+    array = random_image(500, 700, seed=2)
+    corners = rectangle_corners((20, 30, 680, 470))
+    calls = []
+    banded = extract_quad_colors(ImageSampler(array), corners, 32, 48, 2,
+                                 progress=lambda stage, fraction: calls.append(fraction))
+    np.testing.assert_array_equal(banded, extract_quad_colors(ImageSampler(array), corners, 32, 48, 2))
+    assert len(calls) == 4
@@ -0,0 +1,89 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tiled_raster
+from grid_analysis import analyze_grid
+from grid_sampling import ImageSampler, RasterSampler
+from tiled_raster import open_raster
+
+# Scans sampled through a TiledRaster against the same pixels sampled in
+# memory, for each TIFF layout read without a full decode.
+
+ROI = (37, 29, 1180, 860)
+
+
+def plate_pixels(seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 256, (900, 1200, 3), dtype=np.uint8)
+
+
+def write_tiff(path, array, layout):
+    if layout == "pillow-strips":
+        Image.fromarray(array).save(path)
+        return
+    tifffile = pytest.importorskip("tifffile")
+    options = {
+        "strips": {"rowsperstrip": 37},
+        "tiles": {"tile": (128, 192)},
+        "zlib-strips": {"rowsperstrip": 64, "compression": "zlib"},
+        "zlib-tiles": {"tile": (256, 256), "compression": "zlib"},
+        "zlib-predictor": {"rowsperstrip": 50, "compression": "zlib", "predictor": True},
+    }[layout]
+    tifffile.imwrite(path, array, photometric="rgb" if array.ndim == 3 else "minisblack", **options)
+
+
+@pytest.mark.parametrize("layout", ["pillow-strips", "strips", "tiles", "zlib-strips", "zlib-tiles",
+                                    "zlib-predictor"])
+def test_raster_sampling_matches_memory(tmp_path, layout):
+    array = plate_pixels()
+    path = str(tmp_path / "scan.tif")
+    write_tiff(path, array, layout)
+
+    with open_raster(path, min_pixels=1) as raster:
+        assert raster is not None and raster.size == (1200, 900)
+        np.testing.assert_array_equal(raster.read_region(0, 0, 1200, 900), array)
+        for sample_size, sample_fraction in ((3, None), (None, 0.8)):
+            expected = analyze_grid(ImageSampler(array), ROI, 8, 12, sample_size=sample_size,
+                                    sample_fraction=sample_fraction)
+            actual = analyze_grid(RasterSampler(raster), ROI, 8, 12, sample_size=sample_size,
+                                  sample_fraction=sample_fraction)
+            np.testing.assert_array_equal(actual.colors, expected.colors)
+            # Small regions at a time, so every window spans several segments
+            actual = analyze_grid(RasterSampler(raster, max_pixels=5000), ROI, 8, 12, sample_size=sample_size,
+                                  sample_fraction=sample_fraction)
+            np.testing.assert_array_equal(actual.colors, expected.colors)
+
+
+def test_grayscale_scan(tmp_path):
+    gray = plate_pixels(1)[..., 0]
+    path = str(tmp_path / "gray.tif")
+    write_tiff(path, gray, "zlib-tiles")
+    with open_raster(path, min_pixels=1) as raster:
+        np.testing.assert_array_equal(raster.read_region(100, 50, 700, 400), np.repeat(gray[50:400, 100:700, None], 3, 2))
+
+
+def test_small_and_other_files_are_left_to_pillow(tmp_path):
+    array = plate_pixels(2)
+    path = str(tmp_path / "scan.tif")
+    write_tiff(path, array, "pillow-strips")
+    assert open_raster(path) is None  # Below TILED_MIN_PIXELS
+    png = str(tmp_path / "scan.png")
+    Image.fromarray(array).save(png)
+    assert open_raster(png, min_pixels=1) is None
+
+
+def test_unreadable_scan_too_large_for_pillow(tmp_path, monkeypatch):
+    # A compressed scan without tifffile: too large for Pillow to decode whole
+    path = str(tmp_path / "scan.tif")
+    Image.fromarray(plate_pixels(3)).save(path, compression="tiff_adobe_deflate")
+    monkeypatch.setattr(tiled_raster, "tifffile", None)
+    assert open_raster(path, min_pixels=1) is None
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 1000)
+    with pytest.raises(ValueError, match="tile by tile"):
+        open_raster(path, min_pixels=1)
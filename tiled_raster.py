@@ -0,0 +1,185 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image, TiffImagePlugin
+
+try:
+    import tifffile
+except ImportError:  # Only needed for compressed TIFFs
+    tifffile = None
+
+# Pixel access for scans too large to decode into memory. Uncompressed TIFFs
+# (stripped or tiled) are memory-mapped straight from the file using the
+# layout Pillow reports, so only the pages that are read become resident.
+# Compressed TIFFs are decoded one strip or tile at a time with the optional
+# tifffile package, keeping a bounded number of decoded segments around.
+# Compressions tifffile cannot decode on its own (LZW, JPEG and others need
+# imagecodecs) are left to Pillow.
+
+# Images at least this large (in pixels) are read through a TiledRaster
+TILED_MIN_PIXELS = 2 ** 26
+
+# Decoded segments kept in memory for compressed rasters
+SEGMENT_CACHE_SIZE = 64
+
+# Pillow raw modes that can be mapped directly, and their bytes per pixel
+RAW_CHANNELS = {"RGB": 3, "RGBX": 4, "RGBA": 4, "L": 1}
+
+
+class TiledRaster:
+    # An image stored as rectangular segments (strips or tiles), each loaded
+    # on demand as an (h, w, channels) uint8 array. close() (or a with
+    # block) releases the file.
+
+    def __init__(self, size, boxes, load_segment, cache_size=SEGMENT_CACHE_SIZE, close=None):
+        self.size = size
+        self.boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)  # (x0, y0, x1, y1)
+        self._load_segment = load_segment
+        self._close = close  # Releases the open file, if any
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Hold at least two rows of tiles so a row-by-row scan never thrashes
+        if cache_size:
+            per_row = int((self.boxes[:, 1] == 0).sum())
+            cache_size = max(cache_size, 2 * per_row)
+        self.cache_size = cache_size
+
+    def close(self):
+        with self._lock:
+            self._cache.clear()
+        if self._close is not None:
+            self._close()
+            self._close = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def segment(self, index):
+        if not self.cache_size:
+            return self._load_segment(index)
+
+        with self._lock:
+            array = self._cache.get(index)
+            if array is not None:
+                self._cache.move_to_end(index)
+                return array
+        array = self._load_segment(index)
+        with self._lock:
+            self._cache[index] = array
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return array
+
+    def read_region(self, x0, y0, x1, y1):
+        # Copy the pixels of [x0, x1) x [y0, y1) into an (h, w, 3) uint8 array,
+        # touching only the segments that overlap it
+        region = np.empty((y1 - y0, x1 - x0, 3), dtype=np.uint8)
+        boxes = self.boxes
+        hits = np.nonzero((boxes[:, 0] < x1) & (boxes[:, 2] > x0) & (boxes[:, 1] < y1) & (boxes[:, 3] > y0))[0]
+        for index in hits:
+            sx0, sy0, sx1, sy1 = (int(v) for v in boxes[index])
+            ix0, iy0 = max(x0, sx0), max(y0, sy0)
+            ix1, iy1 = min(x1, sx1), min(y1, sy1)
+            part = self.segment(index)[iy0 - sy0:iy1 - sy0, ix0 - sx0:ix1 - sx0]
+            region[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0] = part[..., :3]  # Gray broadcasts to RGB
+        return region
+
+    def overview(self, min_size):
+        # Nearest-neighbour reduction by the largest integer step that keeps
+        # the result at least min_size (width, height); only every step-th
+        # row is read
+        width, height = self.size
+        step = max(1, min(width // max(1, min_size[0]), height // max(1, min_size[1])))
+        ys = np.arange(0, height, step)
+        overview = np.empty((len(ys), len(range(0, width, step)), 3), dtype=np.uint8)
+        for i, y in enumerate(ys):
+            overview[i] = self.read_region(0, int(y), width, int(y) + 1)[0, ::step]
+        return Image.fromarray(overview, "RGB")
+
+
+def open_raster(path, min_pixels=TILED_MIN_PIXELS):
+    # A TiledRaster for TIFFs of at least min_pixels that can be read without
+    # a full decode, or None if the file should just be opened with Pillow.
+    # Raises ValueError for scans that can be read neither way. Close the
+    # raster when done with it.
+    if not path.lower().endswith((".tif", ".tiff")):
+        return None
+
+    # Only the header is read. The TIFF reader is used directly rather than
+    # through Image.open, whose decompression bomb check would reject the
+    # very scans read here.
+    with TiffImagePlugin.TiffImageFile(path) as image:
+        size, tiles = image.size, list(image.tile)
+    if size[0] * size[1] < min_pixels:
+        return None
+
+    raster = _open_raw(path, size, tiles)
+    if raster is None and tifffile is not None:
+        raster = _open_tifffile(path)
+    if raster is None and Image.MAX_IMAGE_PIXELS and size[0] * size[1] > 2 * Image.MAX_IMAGE_PIXELS:
+        # Pillow would refuse to decode it as a decompression bomb
+        raise ValueError(
+            f"{path} ({size[0]} x {size[1]}) is too large to decode whole and cannot be read tile by tile. "
+            "Only 8-bit RGB or grayscale TIFFs can be; compressed ones need the tifffile package, "
+            "and LZW, JPEG and most other compressions also imagecodecs (pip install tifffile imagecodecs).")
+    return raster
+
+
+def _open_raw(path, size, tiles):
+    # Uncompressed 8-bit data: every segment is a strided view of the mapped file
+    for tile in tiles:
+        codec, args = tile[0], tile[3]
+        if codec != "raw" or args[0] not in RAW_CHANNELS or (len(args) > 2 and args[2] != 1):
+            return None
+
+    data = np.memmap(path, dtype=np.uint8, mode="r")
+
+    def load_segment(index):
+        x0, y0, x1, y1 = tiles[index][1]
+        rawmode, stride = tiles[index][3][:2]
+        channels = RAW_CHANNELS[rawmode]
+        stride = stride or (x1 - x0) * channels
+        return np.lib.stride_tricks.as_strided(
+            data[tiles[index][2]:], shape=(y1 - y0, x1 - x0, channels),
+            strides=(stride, channels, 1), writeable=False)
+
+    return TiledRaster(size, [tile[1] for tile in tiles], load_segment, cache_size=0)
+
+
+def _open_tifffile(path):
+    tif = tifffile.TiffFile(path)
+    page = tif.pages[0]
+    contig = page.planarconfig == tifffile.PLANARCONFIG.CONTIG or page.samplesperpixel == 1
+    photometric = page.photometric in (tifffile.PHOTOMETRIC.RGB, tifffile.PHOTOMETRIC.MINISBLACK)
+    # Codecs such as LZW and JPEG need the imagecodecs package
+    codec = page.compression in tifffile.TIFF.DECOMPRESSORS and page.predictor in tifffile.TIFF.UNPREDICTORS
+    if page.dtype != np.uint8 or not contig or not photometric or page.imagedepth != 1 or not codec:
+        tif.close()
+        return None
+
+    height, width = page.imagelength, page.imagewidth
+    if page.is_tiled:
+        seg_width, seg_height = page.tilewidth, page.tilelength
+    else:
+        seg_width, seg_height = width, page.rowsperstrip or height
+    per_row = -(-width // seg_width)
+    boxes = []
+    for index in range(len(page.dataoffsets)):
+        y0, x0 = index // per_row * seg_height, index % per_row * seg_width
+        boxes.append((x0, y0, min(x0 + seg_width, width), min(y0 + seg_height, height)))
+
+    lock = threading.Lock()
+
+    def load_segment(index):
+        with lock:  # One shared file handle
+            tif.filehandle.seek(page.dataoffsets[index])
+            data = tif.filehandle.read(page.databytecounts[index])
+        segment = page.decode(data, index, jpegtables=page.jpegtables)[0]
+        return segment.reshape(segment.shape[-3:])  # (h, w, samples), may be padded
+
+    return TiledRaster((width, height), boxes, load_segment, close=tif.close)
@@ -0,0 +1,124 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+from batch_analyze import parse_color, parse_roi, parse_window, result_record
+from color_metrics import METRICS
+from grid_sampling import SAMPLE_SIZE
+from multi_grid import PlateGrid, analyze_plates, merged_ranking, parse_plates
+from palette_index import get_palette_index
+from result_export import open_exporter
+
+# Analyzes every plate of a tray scan at once, one worker process per plate,
+# and ranks all their cells together against the reference color. Plates
+# are listed in a JSON file:
+#   [{"name": "P1", "roi": [x1, y1, x2, y2], "rows": 8, "cols": 12},
+#    {"name": "P2", "corners": [[x, y], [x, y], [x, y], [x, y]], "rows": 16, "cols": 24}]
+# or given with --plate x1,y1,x2,y2 (repeatable, all --rows x --cols).
+
+
+def load_plates(path):
+    with open(path) as f:
+        items = json.load(f)
+    if isinstance(items, dict):
+        items = items.get("plates", [])
+    return parse_plates(items)
+
+
+def tray_record(path, plates, results, references, palette=None, top=None, min_similarity=None):
+    # One batch record per plate, and the merged ranking for each reference
+    records = []
+    for plate, result in zip(plates, results):
+        record = result_record(path, result, palette=palette)
+        del record["image"]
+        records.append({"name": plate.name, **record})
+
+    rankings = []
+    for reference in range(len(references)):
+        plate_ids, cell_ids = merged_ranking(results, reference, top, min_similarity)
+        rankings.append([{"plate": plates[p].name, "position": results[p].position(c),
+                          "rgb": results[p].colors[c].tolist(),
+                          "similarity": round(float(results[p].similarity[reference, c]), 4)}
+                         for p, c in zip(plate_ids.tolist(), cell_ids.tolist())])
+    return {"image": path, "plates": records, "ranking": rankings}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Analyze all plates of a tray scan in parallel and rank them together.")
+    parser.add_argument("image", help="Tray image")
+    parser.add_argument("--plates", metavar="FILE", help="JSON list of plates (name, roi or corners, rows, cols)")
+    parser.add_argument("--plate", type=parse_roi, action="append", default=[],
+                        help="Plate rectangle x1,y1,x2,y2 with --rows x --cols cells (repeatable)")
+    parser.add_argument("--rows", type=int, default=8)
+    parser.add_argument("--cols", type=int, default=12)
+    parser.add_argument("-r", "--reference", type=parse_color, action="append", required=True,
+                        help="Reference color as #RRGGBB or R,G,B (repeatable)")
+    parser.add_argument("--palette", help="Palette file (CSV/TSV/JSON of names and colors, or a saved .npz index)")
+    parser.add_argument("--top-k", type=int, default=3, help="Palette matches reported per cell")
+    parser.add_argument("--window", type=parse_window, default=(SAMPLE_SIZE, None),
+                        help="Pixels averaged per cell: width in pixels (7) or share of the cell (80%%)")
+    parser.add_argument("--metric", choices=METRICS, default="rgb", help="Color difference metric")
+    parser.add_argument("--top", type=int, help="Only the best N cells of the merged ranking")
+    parser.add_argument("--min-match", type=float, help="Only cells at least this similar (percent) in the ranking")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="Worker processes (default: one per plate, at most the CPU count; 1 runs in-process)")
+    parser.add_argument("-o", "--output", help="JSON output file (default: stdout)")
+    parser.add_argument("--export", action="append", metavar="FILE",
+                        help="Also write a per-cell table as .csv, .npz or .parquet (repeatable)")
+    args = parser.parse_args(argv)
+
+    if args.rows <= 0 or args.cols <= 0:
+        parser.error("rows and cols must be positive")
+    if args.top_k <= 0:
+        parser.error("top-k must be positive")
+    if args.top is not None and args.top <= 0:
+        parser.error("top must be positive")
+    if args.workers is not None and args.workers <= 0:
+        parser.error("workers must be positive")
+    if not os.path.isfile(args.image):
+        parser.error(f"No such image: {args.image}")
+
+    try:
+        plates = load_plates(args.plates) if args.plates else []
+    except (OSError, ValueError, TypeError, AttributeError) as e:
+        parser.error(f"Cannot read plates from {args.plates}: {e}")
+    plates += [PlateGrid(f"Plate {len(plates) + i + 1}", args.rows, args.cols, roi=roi)
+               for i, roi in enumerate(args.plate)]
+    if not plates:
+        parser.error("Give the plates with --plates or --plate")
+    if len({plate.name for plate in plates}) != len(plates):
+        parser.error("Plate names must be unique")
+
+    start = time.perf_counter()
+    palette = get_palette_index(args.palette) if args.palette else None
+    sample_size, sample_fraction = args.window
+    results = analyze_plates(args.image, plates, args.reference, sample_size, sample_fraction, args.metric,
+                             palette, args.top_k, args.workers)
+    record = tray_record(args.image, plates, results, args.reference, palette, args.top, args.min_match)
+
+    output = open(args.output, "w") if args.output else sys.stdout
+    try:
+        json.dump(record, output)
+        output.write("\n")
+    finally:
+        if args.output:
+            output.close()
+
+    for path in args.export or ():
+        try:
+            with open_exporter(path, palette.names if palette is not None else None) as exporter:
+                for plate, result in zip(plates, results):
+                    exporter.write(f"{args.image}#{plate.name}", result.to_arrays())
+        except (OSError, ValueError) as e:
+            print(f"Export to {path} failed: {e}", file=sys.stderr)
+            return 1
+
+    cells = sum(len(result) for result in results)
+    print(f"Analyzed {len(plates)} plates ({cells} cells) in {time.perf_counter() - start:.2f}s", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())